@@ -0,0 +1,102 @@
+"""Benchmark call-heavy code under "continue" with an unrelated breakpoint.
+
+Usage: python benchmarks/bench_breakpoints.py [--runs N] [--depth N]
+
+The workload (recursive calls) runs after a ``set_trace`` and "continue",
+while a breakpoint is set in another function of this file, which never gets
+hit.  The stdlib pdb traces all calls into this file then (since there is a
+breakpoint somewhere in it), while pdb++ only traces code objects containing
+breakpoints.  Reported is the median wall time (in ms) of each scenario.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import pdbpp  # noqa: E402
+
+try:
+    from io import StringIO
+except ImportError:  # Python 2.
+    from StringIO import StringIO
+
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+def unrelated():
+    return "never called"  # The breakpoint.
+
+
+BREAK_LINENO = unrelated.__code__.co_firstlineno + 1
+
+
+class Config(pdbpp.DefaultConfig):
+    use_pygments = False
+    highlight = False
+    sticky_by_default = False
+
+
+class MonitoringConfig(Config):
+    trace_backend = "monitoring"
+
+
+def run_continue(make_pdb, depth):
+    pdbpp.cleanup()
+    devnull = open(os.devnull, "w")
+    try:
+        p = make_pdb(stdin=StringIO("continue\n"), stdout=devnull)
+        p.use_rawinput = False
+        p.set_break(p.canonic(__file__), BREAK_LINENO)
+        start = time.time()
+        p.set_trace(sys._getframe())
+        fib(depth)
+        duration = time.time() - start
+        sys.settrace(None)
+        p.clear_all_breaks()
+    finally:
+        devnull.close()
+    return duration
+
+
+def run_native(depth):
+    start = time.time()
+    fib(depth)
+    return time.time() - start
+
+
+def median_ms(func, runs):
+    timings = sorted(func() for _ in range(runs))
+    return timings[len(timings) // 2] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--depth", type=int, default=22)
+    args = parser.parse_args()
+
+    scenarios = [
+        ("native", lambda: run_native(args.depth)),
+        ("pdb (stdlib)", lambda: run_continue(pdbpp.pdb.Pdb, args.depth)),
+        ("pdb++", lambda: run_continue(
+            lambda **kw: pdbpp.Pdb(Config=Config, **kw), args.depth)),
+    ]
+    if hasattr(sys, "monitoring"):
+        scenarios.append(("pdb++ (monitoring)", lambda: run_continue(
+            lambda **kw: pdbpp.Pdb(Config=MonitoringConfig, **kw), args.depth)))
+
+    for name, func in scenarios:
+        print("{:<30} {:>8.1f} ms".format(name, median_ms(func, args.runs)))
+
+
+if __name__ == "__main__":
+    main()
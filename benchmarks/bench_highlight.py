@@ -0,0 +1,103 @@
+"""Benchmark the throughput of the source highlighters.
+
+Usage: python benchmarks/bench_highlight.py [--runs N] [--formatter NAME]
+           [FILE ...]
+
+The given files (by default pdbpp.py and some large modules of the standard
+library) get highlighted completely with each highlighter:
+
+- "pygments": the Pygments lexer and formatter.
+- "builtin+pygments": the tokenize module, and the Pygments formatter.
+- "builtin": the tokenize module, without Pygments.
+
+Reported is the best throughput (in lines and KB per second) over all files,
+and the time to import what is needed in a new process.
+"""
+from __future__ import print_function
+
+import argparse
+import inspect
+import io
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import pdbpp  # noqa: E402
+
+IMPORTS = {
+    "pygments": "import pygments, pygments.lexers, pygments.formatters",
+    "builtin+pygments": "import pygments, pygments.formatters, tokenize",
+    "builtin": "import tokenize",
+}
+
+
+def get_default_files():
+    import difflib
+    import pydoc
+
+    return [inspect.getsourcefile(module)
+            for module in (pdbpp, inspect, argparse, difflib, pydoc)]
+
+
+def get_highlighters(formatter):
+    class Config(pdbpp.DefaultConfig):
+        pygments_formatter_class = "pygments.formatters." + formatter
+
+    class BuiltinConfig(Config):
+        highlighter = "builtin"
+
+    return [
+        ("pygments", pdbpp.Pdb(Config=Config)._get_highlight_function()),
+        ("builtin+pygments",
+         pdbpp.Pdb(Config=BuiltinConfig)._get_highlight_function()),
+        ("builtin", pdbpp.Pdb(Config=Config)._get_builtin_highlight_function()),
+    ]
+
+
+def get_import_ms(statement, runs):
+    def run(code):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", code])
+        return time.time() - start
+
+    base = min(run("pass") for _ in range(runs))
+    return (min(run(statement) for _ in range(runs)) - base) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--formatter", default="Terminal256Formatter")
+    parser.add_argument("files", nargs="*")
+    args = parser.parse_args()
+
+    sources = []
+    for filename in args.files or get_default_files():
+        with io.open(filename, encoding="utf-8") as f:
+            sources.append(f.read())
+    num_lines = sum(len(src.splitlines()) for src in sources)
+    num_kb = sum(len(src) for src in sources) / 1024.0
+    print("{} files, {} lines, {:.0f} KB".format(
+        len(sources), num_lines, num_kb))
+
+    print("{:<18} {:>12} {:>10} {:>12}".format(
+        "", "lines/s", "KB/s", "import ms"))
+    for name, highlight in get_highlighters(args.formatter):
+        timings = []
+        for _ in range(args.runs):
+            start = time.time()
+            for src in sources:
+                highlight(src)
+            timings.append(time.time() - start)
+        best = min(timings)
+        print("{:<18} {:>12.0f} {:>10.0f} {:>12.1f}".format(
+            name, num_lines / best, num_kb / best,
+            get_import_ms(IMPORTS[name], args.runs)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Benchmark attribute writes on classes using break_on_setattr.
+
+Usage: python benchmarks/bench_setattr.py [--number N]
+
+Reported is the best time per attribute write (in ns), for writes to the
+watched attribute (with a condition that is never true) and to another
+attribute.  "__setattr__ wrapper" is the approach used by break_on_setattr
+for classes with a custom ``__setattr__`` (and used for all classes before).
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import pdbpp  # noqa: E402
+
+
+def never(obj, value):
+    return False
+
+
+def make_class(kind):
+    class Foo(object):
+        pass
+
+    if kind == "descriptor":
+        pdbpp.break_on_setattr("watched", condition=never)(Foo)
+    elif kind == "__setattr__ wrapper":
+        # Force the fallback for custom __setattr__ methods.
+        Foo.__setattr__ = lambda self, attr, value: object.__setattr__(
+            self, attr, value)
+        pdbpp.break_on_setattr("watched", condition=never)(Foo)
+    return Foo
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=200000)
+    args = parser.parse_args()
+
+    print("{:<24} {:>12} {:>12}".format("", "unwatched", "watched"))
+    for kind in ("no break_on_setattr", "descriptor", "__setattr__ wrapper"):
+        timings = []
+        for attr in ("other", "watched"):
+            timer = timeit.Timer(
+                "obj.%s = 1" % attr,
+                "from __main__ import make_class; obj = make_class(%r)()" % kind)
+            best = min(timer.repeat(repeat=5, number=args.number))
+            timings.append(best / args.number * 1e9)
+        print("{:<24} {:>9.1f} ns {:>9.1f} ns".format(kind, *timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Benchmark the cost of importing pdb++ in a fresh interpreter.
+
+Usage: python benchmarks/bench_startup.py [--runs N]
+
+Each scenario runs a new interpreter process with the given environment and
+reports the median wall time (in ms) for ``import pdbpp`` or ``import pdb``,
+minus the one of an interpreter that imports nothing.
+
+The hijacking of ``import pdb`` (done by pdbpp_hijack_pdb.pth when installed)
+is emulated by putting ``src/_pdbpp_path_hack`` first on ``$PYTHONPATH``.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       "src")
+
+
+def time_process(code, env, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", code], env=env)
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+def get_env(hijack=False, **kwargs):
+    env = os.environ.copy()
+    # Measure with bytecode caches being written, as with a default setup.
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    paths = [SRC_DIR]
+    if hijack:
+        paths.insert(0, os.path.join(SRC_DIR, "_pdbpp_path_hack"))
+    if env.get("PYTHONPATH"):
+        paths.append(env["PYTHONPATH"])
+    env["PYTHONPATH"] = os.pathsep.join(paths)
+    env.update(kwargs)
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    cache_home = tempfile.mkdtemp(prefix="pdbpp-bench-")
+    try:
+        env = get_env(XDG_CACHE_HOME=cache_home)
+        scenarios = [
+            ("no bytecode cache", "import pdbpp",
+             get_env(XDG_CACHE_HOME=cache_home, PDBPP_BYTECODE_CACHE="0")),
+            ("bytecode cache (warm)", "import pdbpp", env),
+            ("import pdb (stdlib)", "import pdb", env),
+            ("import pdb (hijack)", "import pdb",
+             get_env(True, XDG_CACHE_HOME=cache_home)),
+            ("import pdb (lazy hijack)", "import pdb",
+             get_env(True, XDG_CACHE_HOME=cache_home, PDBPP_HIJACK_PDB_LAZY="1")),
+            ("pdb.Pdb (lazy hijack)", "import pdb; pdb.Pdb",
+             get_env(True, XDG_CACHE_HOME=cache_home, PDBPP_HIJACK_PDB_LAZY="1")),
+        ]
+        # Warm up the OS caches and the bytecode caches.
+        time_process("import pdbpp", env, 1)
+        time_process("import pdb", get_env(True, XDG_CACHE_HOME=cache_home), 1)
+
+        baseline = time_process("pass", env, args.runs)
+        print("{:<30} {:>8.1f} ms".format("interpreter startup", baseline))
+        for name, code, env in scenarios:
+            ms = time_process(code, env, args.runs) - baseline
+            print("{:<30} {:>8.1f} ms".format(name, ms))
+    finally:
+        shutil.rmtree(cache_home)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Benchmark the output written per "next" in sticky mode.
+
+Usage: python benchmarks/bench_sticky.py [--steps N] [--width N] [--height N]
+           [--pygments]
+
+A function gets stepped through with "next" in sticky mode, with output to a
+(fake) terminal of the given size.  Reported are the bytes written per "next"
+with ``sticky_redraw = "full"`` (clear the screen and print everything) and
+``"diff"`` (rewrite changed rows only).  The latter needs /proc/self/io
+(Linux), and falls back to full redraws otherwise.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import pdbpp  # noqa: E402
+
+try:
+    from io import StringIO
+except ImportError:  # Python 2.
+    from StringIO import StringIO
+
+
+def workload():
+    total = 0
+    values = []
+    for i in range(3):
+        total += i
+        values.append(total)
+        values.append(i * 2)
+        values.append(-i)
+    total += sum(values)
+    total -= len(values)
+    total *= 2
+    total //= 3
+    values.sort()
+    values.reverse()
+    total += values[0]
+    total += values[-1]
+    total += max(values)
+    total += min(values)
+    return total
+
+
+class Terminal(StringIO):
+    def isatty(self):
+        return True
+
+
+class Config(pdbpp.DefaultConfig):
+    use_pygments = False
+    highlight = True
+    sticky_by_default = False
+
+
+def run(config, steps):
+    """Return (bytes written, seconds) for stepping through workload."""
+    pdbpp.cleanup()
+    commands = ["s", "sticky"] + ["n"] * steps + ["c"]  # "s" into workload.
+    stdin = StringIO("\n".join(commands) + "\n")
+    stdout = Terminal()
+    p = pdbpp.Pdb(Config=config, stdin=stdin, stdout=stdout)
+    p.use_rawinput = False
+    start = time.time()
+    p.set_trace(sys._getframe())
+    workload()
+    duration = time.time() - start
+    sys.settrace(None)
+    return len(stdout.getvalue().encode("utf-8")), duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--width", type=int, default=200)
+    parser.add_argument("--height", type=int, default=60)
+    parser.add_argument("--pygments", action="store_true")
+    args = parser.parse_args()
+
+    size = (args.width, args.height)
+    pdbpp.Pdb.get_terminal_size = staticmethod(lambda: size)
+
+    print("{:<6} {:>14} {:>14}".format("", "bytes/next", "ms/next"))
+    for redraw in ("full", "diff"):
+        class BenchConfig(Config):
+            sticky_redraw = redraw
+            use_pygments = args.pygments
+
+        run(BenchConfig, 1)  # Warm up (imports, highlighting).
+        base_bytes, base_seconds = run(BenchConfig, 0)
+        total_bytes, total_seconds = run(BenchConfig, args.steps)
+        print("{:<6} {:>14.0f} {:>14.2f}".format(
+            redraw,
+            (total_bytes - base_bytes) / float(args.steps),
+            (total_seconds - base_seconds) / args.steps * 1000,
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Benchmark the tracing overhead of pdb++ on representative workloads.
+
+Usage: python benchmarks/bench_tracing.py [--runs N] [--scale N]
+           [--breakpoints N] [--stops N] [--trace-backend NAME] [--output FILE]
+
+Each workload runs without a debugger, and in a debugger session driven by a
+script of commands (like ``runpdb`` in the tests, i.e. without a TTY):
+
+- "set_trace+continue": ``set_trace()``, then "continue".
+- "unrelated breakpoints": N breakpoints in a function that is never called.
+- "conditional breakpoint": a breakpoint in the workload's inner loop, with a
+  condition that is never true.
+- "breakpoint stops": a breakpoint in the inner loop, continued N times.
+- "display": like "breakpoint stops", with expressions in the display list.
+
+The median wall time of each scenario and its slowdown factor (compared to
+running without a debugger) get written as JSON.
+"""
+from __future__ import print_function
+
+import argparse
+import inspect
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import pdbpp  # noqa: E402
+
+try:
+    from io import StringIO
+except ImportError:  # Python 2.
+    from StringIO import StringIO
+
+
+# Workloads: the line marked with "# hot" is where breakpoints get set.
+
+def tight_loop(scale):
+    total = 0
+    for i in range(scale * 2000):
+        total += i  # hot
+    return total
+
+
+def recursion(scale):
+    def fib(n):
+        if n < 2:  # hot
+            return n
+        return fib(n - 1) + fib(n - 2)
+
+    return sum(fib(12) for _ in range(scale))
+
+
+class Vector(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def add(self, other):
+        return Vector(self.x + other.x, self.y + other.y)
+
+    def scale(self, factor):
+        return Vector(self.x * factor, self.y * factor)
+
+
+def method_calls(scale):
+    v = Vector(0, 0)
+    for i in range(scale * 200):
+        v = v.add(Vector(i, -i)).scale(1)  # hot
+    return v
+
+
+def generators(scale):
+    def numbers(n):
+        for i in range(n):
+            yield i  # hot
+
+    squares = (x * x for x in numbers(scale * 1000))
+    evens = (x for x in squares if x % 2 == 0)
+    return sum(evens)
+
+
+WORKLOADS = [tight_loop, recursion, method_calls, generators]
+
+
+def unrelated():
+    a = 1
+    b = 2
+    c = 3
+    d = 4
+    e = 5
+    return a + b + c + d + e
+
+
+def get_lineno(func, marker="# hot"):
+    lines, lineno = inspect.getsourcelines(func)
+    for i, line in enumerate(lines):
+        if line.rstrip().endswith(marker):
+            return lineno + i
+    raise ValueError("no %r in %s" % (marker, func.__name__))
+
+
+def get_location(func, lineno):
+    return "%s:%d" % (os.path.abspath(inspect.getsourcefile(func)), lineno)
+
+
+def get_scenarios(workload, args):
+    hot = get_location(workload, get_lineno(workload))
+    unrelated_lines = list(range(
+        unrelated.__code__.co_firstlineno + 1,
+        unrelated.__code__.co_firstlineno + 7))
+    stops = ["continue"] * (args.stops - 1) + ["clear " + hot, "continue"]
+
+    return [
+        ("set_trace+continue", ["continue"]),
+        ("unrelated breakpoints", [
+            "break " + get_location(unrelated, unrelated_lines[
+                i % len(unrelated_lines)])
+            for i in range(args.breakpoints)
+        ] + ["continue"]),
+        ("conditional breakpoint", [
+            "break %s, __name__ == 'never'" % hot,
+            "continue",
+        ]),
+        ("breakpoint stops", ["break " + hot, "continue"] + stops),
+        ("display", ["break " + hot, "continue"] + [
+            "display " + expr
+            for expr in ("len(locals())", "sorted(locals())", "__name__")
+        ] + stops),
+    ]
+
+
+class Config(pdbpp.DefaultConfig):
+    use_pygments = False
+    highlight = False
+    sticky_by_default = False
+    enable_hidden_frames = False
+
+
+def runpdb(func, commands, config):
+    """Run func after set_trace, with commands as input."""
+    pdbpp.cleanup()
+    stdin = StringIO("\n".join(commands) + "\n")
+    stdout = StringIO()
+    p = pdbpp.Pdb(Config=config, stdin=stdin, stdout=stdout)
+    p.use_rawinput = False
+    start = time.time()
+    p.set_trace(sys._getframe())
+    func()
+    duration = time.time() - start
+    sys.settrace(None)
+    p.clear_all_breaks()
+    if stdin.read():
+        raise RuntimeError("not all commands were used:\n" + stdout.getvalue())
+    return duration
+
+
+def run_native(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def median(timings):
+    timings = sorted(timings)
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--scale", type=int, default=20)
+    parser.add_argument("--breakpoints", type=int, default=10)
+    parser.add_argument("--stops", type=int, default=20)
+    parser.add_argument("--trace-backend", default="settrace")
+    parser.add_argument("--output", help="file to write to (default: stdout)")
+    args = parser.parse_args()
+
+    class BenchConfig(Config):
+        trace_backend = args.trace_backend
+
+    results = {}
+    for workload in WORKLOADS:
+        def func(workload=workload):
+            return workload(args.scale)
+
+        native = median(run_native(func) for _ in range(args.runs))
+        results[workload.__name__] = workload_results = {
+            "no debugger": {"seconds": native, "slowdown": 1.0},
+        }
+        for name, commands in get_scenarios(workload, args):
+            seconds = median(
+                runpdb(func, commands, BenchConfig) for _ in range(args.runs))
+            workload_results[name] = {
+                "seconds": seconds,
+                "slowdown": seconds / native,
+            }
+
+    output = json.dumps({
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "trace_backend": args.trace_backend,
+        "args": vars(args),
+        "results": results,
+    }, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,10 @@
 This gets inserted to the beginning of sys.path via pdbpp_hijack_pdb.pth.
 
 You can set PDBPP_HIJACK_PDB=0 as an environment variable to skip it.
+
+With PDBPP_HIJACK_PDB_LAZY=1 (Python 3.7+) pdb++ only gets loaded when an
+attribute of the module is accessed first (e.g. ``pdb.set_trace``), so that
+code which imports pdb only incidentally does not pay for it.
 """
 import os
 import sys
@@ -13,8 +17,69 @@ pdb_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'pdbpp.py')
 # coverage.py to use it.
 __file__ = pdb_path
 
-with open(pdb_path) as f:
-    exec(compile(f.read(), pdb_path, 'exec'))
+# Special attributes that trigger loading with the lazy mode.  Others (e.g.
+# "__path__" looked up by the import system) raise AttributeError.
+_LOADING_DUNDERS = ("__all__", "__author__", "__url__", "__version__")
+
+
+def _load_pdbpp():
+    try:
+        from importlib.machinery import SourceFileLoader
+    except ImportError:  # Python 2.
+        with open(pdb_path) as f:
+            code = compile(f.read(), pdb_path, 'exec')
+    else:
+        # Use (and write) the same cached bytecode as with "import pdbpp",
+        # instead of compiling the source on every import.
+        code = SourceFileLoader("pdbpp", pdb_path).get_code("pdbpp")
+    exec(code, globals())
+
+
+if (
+    __name__ != "__main__"
+    and sys.version_info >= (3, 7)
+    and int(os.environ.get("PDBPP_HIJACK_PDB_LAZY", 0))
+):
+    from _thread import RLock
+
+    _load_lock = RLock()
+    _loaded = []
+    del RLock
+
+    def _ensure_pdbpp_loaded():
+        with _load_lock:
+            if not _loaded:
+                _loaded.append(True)
+                try:
+                    _load_pdbpp()
+                except BaseException:
+                    # Raise the error again on next access, instead of
+                    # using the (partially) missing globals.
+                    del _loaded[:]
+                    raise
+
+    def __getattr__(name):
+        """Load pdb++ on first access of a missing module attribute (PEP 562)."""
+        if (
+            name.startswith("__")
+            and name.endswith("__")
+            and name not in _LOADING_DUNDERS
+        ):
+            raise AttributeError(
+                "module '{}' has no attribute '{}'".format(__name__, name)
+            )
+        _ensure_pdbpp_loaded()
+        try:
+            return globals()[name]
+        except KeyError:
+            # pdb++'s own module __getattr__ (or AttributeError).
+            return globals()["__getattr__"](name)
+
+    def __dir__():
+        _ensure_pdbpp_loaded()
+        return sorted(globals())
+else:
+    _load_pdbpp()
 
 # Update/set __file__ attribute to actually sourced file, but not when not coming
 # here via "-m pdb", where __name__ is "__main__".
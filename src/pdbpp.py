@@ -9,37 +9,40 @@ more details on pdb++ features.
 
 from __future__ import print_function
 
+# Only modules needed to get to the prompt are imported here; others (e.g.
+# inspect, code, pprint, subprocess) get imported on first use.
 import sys
 import os.path
-import inspect
-import code
+import bdb
+import bisect
 import codecs
 import contextlib
 import types
 import traceback
-import subprocess
 import threading
-import pprint
 import re
 import signal
-from collections import OrderedDict
+import weakref
+from collections import Counter, OrderedDict, defaultdict, deque
 
 import fancycompleter
-import six
 from fancycompleter import Color, Completer, ConfigurableClass
 
 __author__ = 'Antonio Cuni <anto.cuni@gmail.com>'
 __url__ = 'http://github.com/antocuni/pdb'
 __version__ = fancycompleter.LazyVersion('pdbpp')
 
-try:
-    from inspect import signature  # Python >= 3.3
-except ImportError:
+
+def signature(obj):
     try:
-        from funcsigs import signature
+        from inspect import signature  # Python >= 3.3
     except ImportError:
-        def signature(obj):
+        try:
+            from funcsigs import signature
+        except ImportError:
             return ' [pip install funcsigs to show the signature]'
+    return signature(obj)
+
 
 try:
     from functools import lru_cache
@@ -68,11 +71,23 @@ except ImportError:
 
         return dec
 
+
+@lru_cache(maxsize=256)
+def compile_expr(expr):
+    """Compile an expression for eval(), cached by its source.
+
+    This is used for breakpoint conditions, the display list and "p"/"pp",
+    which get evaluated repeatedly.  Raises SyntaxError (not cached)."""
+    # Like eval() with a string.
+    return compile(expr.lstrip(" \t"), "<string>", "eval")
+
+
 # If it contains only _, digits, letters, [] or dots, it's probably side
 # effects free.
 side_effects_free = re.compile(r'^ *[_0-9a-zA-Z\[\].]* *$')
 
 RE_COLOR_ESCAPES = re.compile("(\x1b[^m]+m)+")
+RE_LEADING_WHITESPACE = re.compile(r"^(?:\x1b\[[^m]*m[ \t]*\x1b\[[^m]*m|[ \t]+)+")
 RE_REMOVE_FANCYCOMPLETER_ESCAPE_SEQS = re.compile(r"\x1b\[[\d;]+m")
 
 if sys.version_info < (3, ):
@@ -86,6 +101,10 @@ local.GLOBAL_PDB = None
 local._pdbpp_completing = False
 local._pdbpp_in_init = False
 
+# Config classes loaded from the config file (~/.pdbrc.py), by
+# (filename, DefaultConfig) --> ((mtime, size), Config).
+_config_cache = {}
+
 
 def __getattr__(name):
     """Backward compatibility (Python 3.7+)"""
@@ -94,15 +113,79 @@ def __getattr__(name):
     raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
 
 
+def _get_cache_dir():
+    """Return the user cache directory for pdb++ (following XDG)."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "pdbpp")
+
+
+def _compile_cached(pyfile):
+    """Compile the given source file, using a marshalled code object cache.
+
+    Entries are keyed by the path, mtime and size of the source file, and the
+    magic number of the interpreter.  Stale or broken entries get compiled
+    again, and any error when writing the cache is ignored.
+    The cache can be disabled by setting $PDBPP_BYTECODE_CACHE to 0.
+    """
+    import marshal
+
+    if not int(os.environ.get("PDBPP_BYTECODE_CACHE", 1)):
+        with open(pyfile) as f:
+            return compile(f.read(), pyfile, "exec", dont_inherit=True)
+
+    try:
+        from importlib.util import MAGIC_NUMBER
+    except ImportError:  # Python 2.
+        import imp
+
+        MAGIC_NUMBER = imp.get_magic()
+    import binascii
+
+    st = os.stat(pyfile)
+    key = (pyfile, st.st_mtime, st.st_size, MAGIC_NUMBER)
+    cache_dir = _get_cache_dir()
+    cache_file = os.path.join(cache_dir, "%s-%08x.pyc" % (
+        os.path.splitext(os.path.basename(pyfile))[0],
+        binascii.crc32(repr(key[::3]).encode("utf-8")) & 0xffffffff,
+    ))
+
+    try:
+        with open(cache_file, "rb") as f:
+            cached_key, co = marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+    else:
+        if cached_key == key:
+            return co
+
+    with open(pyfile) as f:
+        co = compile(f.read(), pyfile, "exec", dont_inherit=True)
+
+    if not sys.dont_write_bytecode:
+        tmp_file = "%s.%d" % (cache_file, os.getpid())
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(tmp_file, "wb") as f:
+                marshal.dump((key, co), f)
+            getattr(os, "replace", os.rename)(tmp_file, cache_file)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmp_file)
+            except (IOError, OSError):
+                pass
+    return co
+
+
 def import_from_stdlib(name):
     import code  # arbitrary module which stays in the same dir as pdb
     result = types.ModuleType(name)
 
     stdlibdir, _ = os.path.split(code.__file__)
     pyfile = os.path.join(stdlibdir, name + '.py')
-    with open(pyfile) as f:
-        src = f.read()
-    co_module = compile(src, pyfile, 'exec', dont_inherit=True)
+    co_module = _compile_cached(pyfile)
     exec(co_module, result.__dict__)
 
     return result
@@ -143,6 +226,26 @@ class DefaultConfig(object):
     use_pygments = None  # Tries to use it if available.
     pygments_formatter_class = None  # Defaults to autodetect, based on $TERM.
     pygments_formatter_kwargs = {}
+    # "pygments", or "builtin" to use the tokenize module instead of the
+    # Pygments lexer (with the Pygments formatter if available).  The latter
+    # is used if Pygments is not available.
+    highlighter = "pygments"
+    # Write the output of each command with a single write.
+    buffer_output = True
+
+    # Budgets for the repr of values with "p", "pp", "display" and return
+    # values in sticky mode (None for no limit).  "p!" and "pp!" use the full
+    # repr.
+    repr_max_chars = 10000
+    repr_max_depth = 20
+    repr_max_items = 1000
+    repr_max_seconds = 1.0
+
+    # Highlight the files of the stack in a thread while waiting for input.
+    highlight_in_background = True
+    # Cache highlighted files on disk (in $XDG_CACHE_HOME/pdbpp/highlight).
+    highlight_disk_cache = False
+    highlight_disk_cache_size = 50 * 1024 * 1024  # In bytes.
     # Legacy options.  Should use pygments_formatter_kwargs instead.
     bg = 'dark'
     colorscheme = None
@@ -164,6 +267,18 @@ class DefaultConfig(object):
     show_traceback_on_error = True
     show_traceback_on_error_limit = None
 
+    # How to redraw the screen in sticky mode: "full" (clear the screen), or
+    # "diff" to only rewrite changed rows on terminals (when possible).
+    sticky_redraw = "full"
+
+    # "settrace", or "monitoring" to use sys.monitoring (Python 3.12+).
+    trace_backend = "settrace"
+
+    # Do not stop in modules of the standard library / from site-packages
+    # (in addition to the ``skip`` patterns of Pdb).
+    skip_stdlib = False
+    skip_site_packages = False
+
     # Default keyword arguments passed to ``Pdb`` constructor.
     default_pdb_kwargs = {
     }
@@ -201,6 +316,10 @@ def setbgcolor(line, color):
 
 CLEARSCREEN = '\033[2J\033[1;1H'
 
+# Special patterns for Pdb(skip=...).
+SKIP_STDLIB = "<stdlib>"
+SKIP_SITE_PACKAGES = "<site-packages>"
+
 
 def lasti2lineno(code, lasti):
     import dis
@@ -212,6 +331,862 @@ def lasti2lineno(code, lasti):
     return 0
 
 
+def code_lines(code):
+    """Return the set of line numbers of a code object (without nested code)."""
+    try:
+        co_lines = code.co_lines
+    except AttributeError:  # Python < 3.10.
+        import dis
+        lines = set(lineno for _, lineno in dis.findlinestarts(code))
+    else:
+        lines = set(lineno for _, _, lineno in co_lines() if lineno is not None)
+    # Breakpoints for functions are on the "def" line.
+    lines.add(code.co_firstlineno)
+    return lines
+
+
+@lru_cache(maxsize=1)
+def get_python_lib_dirs():
+    """Return (stdlib dirs, site-packages dirs), ending with a separator."""
+    import site
+    import sysconfig
+
+    def normalize(paths):
+        return tuple(set(
+            os.path.join(os.path.normcase(os.path.realpath(path)), "")
+            for path in paths if path
+        ))
+
+    paths = sysconfig.get_paths()
+    site_packages = [paths.get("purelib"), paths.get("platlib")]
+    site_packages.extend(getattr(site, "getsitepackages", list)())
+    site_packages.append(getattr(site, "getusersitepackages", str)())
+    stdlib = [paths.get("stdlib"), paths.get("platstdlib")]
+    return normalize(stdlib), normalize(site_packages)
+
+
+RE_TOPLEVEL_STATEMENT = re.compile(r"[A-Za-z_@]")
+RE_STRING_OR_COMMENT_START = re.compile(r"#|\"\"\"|'''|\"|'")
+RE_STRING_ENDS = {
+    '"""': re.compile(r'\\.|"""', re.S),
+    "'''": re.compile(r"\\.|'''", re.S),
+    '"': re.compile(r'\\.|"|\n', re.S),
+    "'": re.compile(r"\\.|'|\n", re.S),
+}
+
+
+def get_multiline_string_ranges(source):
+    """Return the first and last line numbers of strings spanning lines.
+
+    This is a cheap scan (only for string delimiters and comments), used to
+    find where highlighting has to start for a part of a file."""
+    starts = []
+    ends = []
+    lineno = 1
+    pos = 0
+    while True:
+        m = RE_STRING_OR_COMMENT_START.search(source, pos)
+        if m is None:
+            break
+        lineno += source.count("\n", pos, m.start())
+        delimiter = m.group()
+        if delimiter == "#":
+            pos = source.find("\n", m.end())
+            if pos == -1:
+                break
+            continue
+
+        pos = m.end()
+        end_re = RE_STRING_ENDS[delimiter]
+        while True:
+            end = end_re.search(source, pos)
+            if end is None:
+                pos = len(source)
+                break
+            if end.group()[0] != "\\":
+                # Unterminated single quoted strings end at the newline.
+                pos = end.start() if end.group() == "\n" else end.end()
+                break
+            pos = end.end()
+        num_newlines = source.count("\n", m.end(), pos)
+        if num_newlines:
+            starts.append(lineno)
+            ends.append(lineno + num_newlines)
+            lineno += num_newlines
+    return starts, ends
+
+
+RE_LINES = re.compile(r"[^\n]*\n|[^\n]+")
+RE_UNTERMINATED_STRING = re.compile(
+    r"""([ \t]*)[A-Za-z]{0,2}(\"\"\"|'''|"|')""")
+
+# Pygments token types for keywords (others are "Keyword").
+KEYWORD_TOKEN_TYPES = {
+    "True": "Keyword.Constant",
+    "False": "Keyword.Constant",
+    "None": "Keyword.Constant",
+    "import": "Keyword.Namespace",
+    "from": "Keyword.Namespace",
+    "and": "Operator.Word",
+    "or": "Operator.Word",
+    "not": "Operator.Word",
+    "in": "Operator.Word",
+    "is": "Operator.Word",
+}
+
+# SGR codes for Pygments token types (for light and dark backgrounds), like
+# with Pygments' TerminalFormatter (TERMINAL_COLORS).
+BUILTIN_TERMINAL_COLORS = {
+    "Comment": ("37", "90"),
+    "Keyword": ("34", "94"),
+    "Operator.Word": ("35", "95"),
+    "Name.Builtin": ("36", "96"),
+    "Name.Function": ("32", "92"),
+    "Name.Namespace": ("04;36", "04;96"),
+    "Name.Class": ("04;32", "04;92"),
+    "Name.Exception": ("36", "96"),
+    "Name.Decorator": ("90", "37"),
+    "Literal.String": ("33", "33"),
+    "Literal.Number": ("34", "94"),
+    "Error": ("04;91", "04;91"),
+}
+
+
+@lru_cache(maxsize=1)
+def _get_builtin_token_types():
+    """Return Pygments token types for names of builtins."""
+    try:
+        import builtins
+    except ImportError:  # Python 2.
+        import __builtin__ as builtins
+
+    token_types = {"self": "Name.Builtin.Pseudo", "cls": "Name.Builtin.Pseudo"}
+    for name, value in vars(builtins).items():
+        if name.startswith("_"):
+            continue
+        if isinstance(value, type) and issubclass(value, BaseException):
+            token_types[name] = "Name.Exception"
+        else:
+            token_types[name] = "Name.Builtin"
+    return token_types
+
+
+def tokenize_source(src):
+    """Generate (token type, text) for Python source, using tokenize.
+
+    Token types are the names of Pygments token types (e.g. "Keyword"), and
+    the texts add up to the source.  Errors (e.g. with parts of files) get
+    handled by continuing with the next line."""
+    import keyword
+    import tokenize
+
+    builtin_token_types = _get_builtin_token_types()
+    fstring_start = getattr(tokenize, "FSTRING_START", None)
+    fstring_middle_end = (getattr(tokenize, "FSTRING_MIDDLE", None),
+                          getattr(tokenize, "FSTRING_END", None))
+
+    lines = RE_LINES.findall(src)
+    starts = [0]
+    for line in lines:
+        starts.append(starts[-1] + len(line))
+
+    pos = 0  # Where the next text starts.
+    first_row = 0  # The line where the tokenizer (re)started.
+    while pos < len(src):
+        prev = None
+        at_line_start = True
+        in_import = None
+        string_type = "Literal.String.Double"
+        readline = iter(lines[first_row:]).__next__ if sys.version_info >= (
+            3,) else iter(lines[first_row:]).next
+        try:
+            for tok in tokenize.generate_tokens(readline):
+                tok_type, string, (srow, scol), (erow, ecol) = tok[:4]
+                start = starts[first_row + srow - 1] + scol
+                end = min(starts[first_row + erow - 1] + ecol, len(src))
+                if start > pos:
+                    yield "Text", src[pos:start]
+                    pos = start
+                if end <= pos:
+                    continue
+                text = src[start:end]
+                pos = end
+
+                if tok_type == tokenize.NAME:
+                    if keyword.iskeyword(text):
+                        token_type = KEYWORD_TOKEN_TYPES.get(text, "Keyword")
+                        if text == "from" and at_line_start:
+                            in_import = "from"
+                        elif text == "import":
+                            in_import = None if in_import == "from" else text
+                    elif prev == "def":
+                        token_type = "Name.Function"
+                    elif prev == "class":
+                        token_type = "Name.Class"
+                    elif prev == "@":
+                        token_type = "Name.Decorator"
+                    elif in_import:
+                        token_type = "Name.Namespace"
+                    elif prev != ".":
+                        token_type = builtin_token_types.get(text, "Name")
+                    else:
+                        token_type = "Name"
+                elif tok_type == tokenize.STRING or tok_type == fstring_start:
+                    quote = text.lstrip("bBfFrRuU")
+                    affix = text[:len(text) - len(quote)]
+                    if affix:
+                        yield "Literal.String.Affix", affix
+                        text = quote
+                    if quote[:1] == "'":
+                        string_type = "Literal.String.Single"
+                    else:
+                        string_type = "Literal.String.Double"
+                    token_type = string_type
+                    if at_line_start and quote[:3] in ('"""', "'''"):
+                        token_type = "Literal.String.Doc"
+                elif tok_type in fstring_middle_end:
+                    token_type = string_type
+                elif tok_type == tokenize.NUMBER:
+                    if re.search(r"^0[xX]", text):
+                        token_type = "Literal.Number.Hex"
+                    elif re.search(r"[.eEjJ]", text):
+                        token_type = "Literal.Number.Float"
+                    else:
+                        token_type = "Literal.Number.Integer"
+                elif tok_type == tokenize.COMMENT:
+                    token_type = "Comment.Single"
+                elif tok_type == tokenize.OP:
+                    if text == "@" and at_line_start:
+                        token_type = "Name.Decorator"
+                    elif text in "()[]{},:;":
+                        token_type = "Punctuation"
+                    else:
+                        token_type = "Operator"
+                elif tok_type == tokenize.ERRORTOKEN and text.strip():
+                    token_type = "Error"
+                else:
+                    token_type = "Text"
+                yield token_type, text
+
+                if tok_type in (tokenize.NEWLINE, tokenize.INDENT,
+                                tokenize.DEDENT):
+                    prev = in_import = None
+                    at_line_start = True
+                elif tok_type not in (tokenize.NL, tokenize.COMMENT):
+                    prev = text
+                    at_line_start = False
+            break
+        except (tokenize.TokenError, SyntaxError) as exc:
+            row = bisect.bisect_right(starts, pos) - 1
+            if (
+                isinstance(exc, IndentationError)
+                and starts[row] == pos
+                and row > first_row
+            ):
+                # E.g. a dedent in a part of a file, restart there.
+                first_row = row
+                continue
+
+            m = RE_UNTERMINATED_STRING.match(src, pos)
+            if m and len(m.group(2)) == 3:
+                yield "Text", m.group(1)
+                yield "Literal.String", src[m.end(1):]
+                pos = len(src)
+                break
+            eol = starts[min(row + 1, len(lines))]
+            if m:
+                yield "Text", m.group(1)
+                yield "Literal.String", src[m.end(1):eol]
+            elif eol > pos:
+                yield "Text", src[pos:eol]
+            pos = eol
+            first_row = row + 1
+    if pos < len(src):
+        yield "Text", src[pos:]
+
+
+def format_tokens(tokens, colors):
+    """Format (token type, text) with SGR codes per token type.
+
+    Like Pygments' TerminalFormatter, each line gets colored on its own."""
+    output = []
+    token_colors = {}
+    for token_type, text in tokens:
+        color = token_colors.get(token_type)
+        if color is None:
+            parent = token_type
+            while parent and parent not in colors:
+                parent = parent.rpartition(".")[0]
+            color = token_colors[token_type] = colors.get(parent, "")
+        if not color:
+            output.append(text)
+            continue
+        for line in RE_LINES.findall(text):
+            content = line.rstrip("\n")
+            if content:
+                output.append("\x1b[%sm%s\x1b[39;49;00m" % (color, content))
+            output.append(line[len(content):])
+    return "".join(output)
+
+
+def get_pygments_version():
+    """Return the version of Pygments, without importing it.
+
+    Returns None if it is not available."""
+    module = sys.modules.get("pygments")
+    if module is None:
+        try:
+            from importlib.util import find_spec
+        except ImportError:  # Python 2.
+            import imp
+
+            try:
+                path = os.path.join(imp.find_module("pygments")[1],
+                                    "__init__.py")
+            except ImportError:
+                return None
+        else:
+            spec = find_spec("pygments")
+            if spec is None or not spec.origin:
+                return None
+            path = spec.origin
+        try:
+            with open(path) as f:
+                m = re.search(r"^__version__ = ['\"]([^'\"]+)['\"]", f.read(),
+                              re.M)
+        except (IOError, OSError):
+            m = None
+        if m:
+            return m.group(1)
+        try:
+            import pygments as module
+        except ImportError:
+            return None
+    return getattr(module, "__version__", "unknown")
+
+
+class HighlightUnavailable(Exception):
+    """Raised by highlight functions for the HighlightCache when they cannot
+    highlight (e.g. when Pygments could not be set up)."""
+
+
+class HighlightDiskCache(object):
+    """Highlighted lines of files on disk, for use across sessions.
+
+    Entries are files named by a hash of the source and the highlight key,
+    with the offsets of lines followed by the lines (UTF-8 encoded).  They get
+    read via mmap, decoding only the lines requested.  The least recently
+    used ones are removed when writing, if there are more than ``max_size``
+    bytes in total.  Errors (e.g. with permissions) are ignored, and corrupt
+    entries removed.
+    """
+
+    magic = b"PHL1"
+
+    def __init__(self, path, max_size=50 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+
+    @staticmethod
+    def get_name(lines, highlight_key):
+        import hashlib
+
+        src = "".join(lines)
+        if not isinstance(src, bytes):
+            src = src.encode("utf-8", "replace")
+        digest = hashlib.sha1(highlight_key.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(src)
+        return digest.hexdigest()
+
+    def get(self, name, first=1, last=None):
+        """Return the lines first to last (1-based) of an entry, or None."""
+        import mmap
+        import struct
+
+        path = os.path.join(self.path, name)
+        try:
+            with open(path, "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            magic, num_lines = struct.unpack_from("<4sI", m, 0)
+            if magic != self.magic:
+                return None
+            if last is None or last > num_lines:
+                last = num_lines
+            if first > last:
+                return []
+            start, = struct.unpack_from("<I", m, 8 + 4 * (first - 1))
+            end, = struct.unpack_from("<I", m, 8 + 4 * last)
+            offset = 8 + 4 * (num_lines + 1)
+            data = m[offset + start:offset + end - 1]
+            lines = data.decode("utf-8").split("\n")
+        except (struct.error, ValueError):
+            lines = None
+        finally:
+            m.close()
+
+        try:
+            if lines is None:
+                os.remove(path)  # Corrupt.
+            else:
+                os.utime(path, None)  # For eviction.
+        except OSError:
+            pass
+        return lines
+
+    def set(self, name, highlighted):
+        """Store highlighted lines (without line endings) as an entry."""
+        import struct
+        import tempfile
+
+        if not highlighted:
+            return
+        encoded = [
+            line if isinstance(line, bytes) else line.encode("utf-8")
+            for line in highlighted
+        ]
+        offsets = [0]
+        for line in encoded:
+            offsets.append(offsets[-1] + len(line) + 1)
+        header = struct.pack("<4sI%dI" % len(offsets), self.magic,
+                             len(encoded), *offsets)
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                f.write(b"\n".join(encoded) + b"\n")
+            getattr(os, "replace", os.rename)(
+                tmp_path, os.path.join(self.path, name))
+        except (IOError, OSError):
+            return
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith("."):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+class HighlightCache(object):
+    """Highlighted lines of source files, highlighted completely once.
+
+    Parts of files can be highlighted on their own (``get_window``), using an
+    index of multi-line strings, unless the whole file is highlighted already.
+    Entries are valid for the source they were highlighted from (its size and
+    mtime in linecache, or hash), and the key of the highlight function (its
+    formatter).  The least recently used ones are removed when there are more
+    than ``max_lines`` lines in total.
+
+    It can be filled from another thread (see ``HighlightWorker``).
+    """
+
+    def __init__(self, max_lines=100000, max_indexes=100):
+        self.max_lines = max_lines
+        self.max_indexes = max_indexes
+        self._entries = OrderedDict()  # filename --> (key, lines)
+        # filename --> (source key, multi-line string ranges)
+        self._indexes = OrderedDict()
+        # filename --> ((source key, highlight key), name on disk)
+        self._disk_names = OrderedDict()
+        self._num_lines = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_source_key(filename, lines):
+        import linecache
+
+        entry = linecache.cache.get(filename)
+        if entry is not None and len(entry) == 4 and entry[2] is lines:
+            size, mtime = entry[:2]
+            if mtime is not None:
+                return size, mtime
+        return hash("".join(lines))
+
+    @staticmethod
+    def _highlight(lines, highlight):
+        highlighted = highlight("".join(lines)).split("\n")
+        if highlighted and not highlighted[-1]:
+            highlighted.pop()
+        return highlighted
+
+    def _lookup(self, filename, key):
+        with self._lock:
+            entry = self._entries.pop(filename, None)
+            if entry is None:
+                return None
+            if entry[0] != key:
+                self._num_lines -= len(entry[1])
+                return None
+            self._entries[filename] = entry
+            return entry[1]
+
+    def _store(self, filename, key, highlighted):
+        with self._lock:
+            entry = self._entries.pop(filename, None)
+            if entry is not None:
+                self._num_lines -= len(entry[1])
+            self._entries[filename] = (key, highlighted)
+            self._num_lines += len(highlighted)
+            while self._num_lines > self.max_lines and len(self._entries) > 1:
+                _, (_, old) = self._entries.popitem(last=False)
+                self._num_lines -= len(old)
+
+    def get(self, filename, lines, highlight, highlight_key, disk=None):
+        """Return the highlighted lines (without line endings) of a file.
+
+        ``disk`` is a HighlightDiskCache to use in addition (for string
+        keys)."""
+        source_key = self.get_source_key(filename, lines)
+        key = (source_key, highlight_key)
+        highlighted = self._lookup(filename, key)
+        if highlighted is None:
+            disk, name = self._get_disk_entry(disk, filename, lines, key)
+            if disk is not None:
+                highlighted = disk.get(name)
+            if highlighted is None:
+                highlighted = self._highlight(lines, highlight)
+                if disk is not None:
+                    disk.set(name, highlighted)
+            self._store(filename, key, highlighted)
+        return highlighted
+
+    def _get_disk_entry(self, disk, filename, lines, key):
+        """Return disk and the name of the entry (hashing the source once)."""
+        highlight_key = key[1]
+        if disk is None or not isinstance(highlight_key, str):
+            return None, None
+        with self._lock:
+            entry = self._disk_names.pop(filename, None)
+        if entry is None or entry[0] != key:
+            entry = (key, disk.get_name(lines, highlight_key))
+        with self._lock:
+            self._disk_names[filename] = entry
+            while len(self._disk_names) > self.max_indexes:
+                self._disk_names.popitem(last=False)
+        return disk, entry[1]
+
+    def get_window(self, filename, lines, first, last, highlight,
+                   highlight_key, disk=None):
+        """Return the highlighted lines first to last (1-based) of a file.
+
+        These are taken from the highlighted file if it is cached (also on
+        ``disk``), otherwise only the lines from the start of a multi-line
+        string containing the first line (if any) get highlighted."""
+        source_key = self.get_source_key(filename, lines)
+        key = (source_key, highlight_key)
+        highlighted = self._lookup(filename, key)
+        if highlighted is not None:
+            return highlighted[first - 1:last]
+        disk, name = self._get_disk_entry(disk, filename, lines, key)
+        if disk is not None:
+            highlighted = disk.get(name, first, last)
+            if highlighted is not None:
+                return highlighted
+
+        start = first
+        starts, ends = self._get_string_ranges(filename, lines, source_key)
+        i = bisect.bisect_right(starts, first) - 1
+        if i >= 0 and ends[i] >= first:
+            start = starts[i]
+        return self._highlight(lines[start - 1:last], highlight)[first - start:]
+
+    def fill(self, filename, lines, highlight, highlight_key, cancelled=None,
+             part_size=500, disk=None):
+        """Highlight a file completely, in parts of about part_size lines.
+
+        The parts start at top-level statements outside of multi-line
+        strings.  ``cancelled`` gets called before each part, and returning
+        True from it stops highlighting.  Returns True if the file is in the
+        cache then."""
+        source_key = self.get_source_key(filename, lines)
+        key = (source_key, highlight_key)
+        if self._lookup(filename, key) is not None:
+            return True
+        disk, name = self._get_disk_entry(disk, filename, lines, key)
+        if disk is not None:
+            highlighted = disk.get(name)
+            if highlighted is not None:
+                self._store(filename, key, highlighted)
+                return True
+
+        starts, ends = self._get_string_ranges(filename, lines, source_key)
+        highlighted = []
+        start = 1
+        while start <= len(lines):
+            if cancelled is not None and cancelled():
+                return False
+            end = min(start + part_size - 1, len(lines))
+            i = bisect.bisect_right(starts, end) - 1
+            if i >= 0 and ends[i] > end:
+                end = ends[i]
+            # Prefer to end before a top-level statement.
+            candidates = range(end, max(start, end - 100), -1)
+            if end == len(lines):
+                candidates = ()
+            for candidate in candidates:
+                if RE_TOPLEVEL_STATEMENT.match(lines[candidate]):
+                    i = bisect.bisect_right(starts, candidate + 1) - 1
+                    if i < 0 or ends[i] < candidate + 1:
+                        end = candidate
+                        break
+            part = self._highlight(lines[start - 1:end], highlight)
+            if len(part) != end - start + 1:
+                return False
+            highlighted.extend(part)
+            start = end + 1
+        if disk is not None:
+            disk.set(name, highlighted)
+        self._store(filename, key, highlighted)
+        return True
+
+    def _get_string_ranges(self, filename, lines, source_key):
+        with self._lock:
+            index = self._indexes.pop(filename, None)
+        if index is None or index[0] != source_key:
+            index = (source_key, get_multiline_string_ranges("".join(lines)))
+        with self._lock:
+            self._indexes[filename] = index
+            while len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+        return index[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._indexes.clear()
+            self._disk_names.clear()
+            self._num_lines = 0
+
+
+_highlight_cache = HighlightCache()
+
+
+class HighlightWorker(object):
+    """Fill the HighlightCache with files in a background thread.
+
+    This is meant to run only while waiting for input: ``cancel`` stops it
+    (between parts of files, see ``HighlightCache.fill``), and waits for the
+    thread.  It starts after ``delay`` seconds, and highlights at most
+    ``max_lines`` lines (of files in the given order).
+    """
+
+    def __init__(self, delay=0.2, max_lines=50000):
+        self.delay = delay
+        self.max_lines = max_lines
+        self._thread = None
+        self._cancelled = None
+
+    def start(self, files, highlight, highlight_key, disk=None):
+        """Start highlighting files, a list of (filename, lines)."""
+        self.cancel()
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(files, highlight, highlight_key, disk, self._cancelled),
+            name="pdbpp-highlight",
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        if self._thread is None:
+            return
+        self._cancelled.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self, files, highlight, highlight_key, disk, cancelled):
+        if cancelled.wait(self.delay):
+            return
+        num_lines = 0
+        for filename, lines in files:
+            if num_lines + len(lines) > self.max_lines:
+                continue
+            num_lines += len(lines)
+            try:
+                done = _highlight_cache.fill(
+                    filename, lines, highlight, highlight_key,
+                    cancelled=cancelled.is_set, disk=disk)
+            except HighlightUnavailable:
+                # Not highlighted in the foreground yet, but might be on disk.
+                continue
+            except Exception:
+                # Errors get reported when highlighting in the foreground.
+                return
+            if not done:
+                return
+
+
+def get_write_count():
+    """Return the number of bytes written by the process, or None if unknown.
+
+    This uses /proc/self/io, i.e. is only available on Linux."""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class StickyScreen(object):
+    """Model of the screen in sticky mode, for sticky_redraw = "diff".
+
+    It remembers the rows of the last rendering (from the top of the screen),
+    the state they were rendered for (frame, range, terminal size), and the
+    number of bytes written by the process when resuming the program.  Only
+    changed rows get rewritten then (using cursor addressing), if nothing
+    else has been written in between.
+    """
+
+    def __init__(self):
+        self.rows = None  # None if the screen is not known.
+        self.key = None
+        self.write_count = None
+        self.rendered = False  # Rendered during the current command.
+
+    def invalidate(self):
+        self.rows = None
+
+    def end_command(self, output):
+        """Handle the end of a command (not resuming the program).
+
+        The screen stays known only if it was rendered last, i.e. the
+        command did not produce other output."""
+        if output or not self.rendered:
+            self.rows = None
+        self.rendered = False
+
+    def resume(self):
+        """Remember the number of bytes written when resuming the program."""
+        self.write_count = get_write_count()
+        self.rendered = False
+
+    def render(self, lines, key, width, clear=True):
+        """Return the output for rendering lines, with the prompt after them.
+
+        Without ``clear`` the lines get appended to the screen (if it is not
+        known), instead of clearing it first."""
+        rows = self.rows
+        write_count = get_write_count()
+        if (
+            rows is None
+            or key != self.key
+            or write_count is None
+            or write_count != self.write_count
+        ):
+            rows = None
+        self.write_count = None
+        self.key = key
+        self.rendered = True
+        visible_lengths = [len(RE_COLOR_ESCAPES.sub("", line)) for line in lines]
+        if any(length > width for length in visible_lengths):
+            # Wrapped lines cannot be addressed.
+            self.rows = None
+            rows = None
+        else:
+            self.rows = list(lines)
+
+        if rows is None:
+            output = "".join(line + "\n" for line in lines)
+            if clear:
+                return CLEARSCREEN + output
+            self.rows = None  # Not from the top.
+            return output
+
+        output = []
+        for i, line in enumerate(lines):
+            if i >= len(rows) or line != rows[i]:
+                output.append("\033[%d;1H%s" % (i + 1, line))
+                if visible_lengths[i] < width:
+                    # Clear the rest of the row (not the last column when
+                    # using all columns).
+                    output.append("\033[K")
+        # Clear the remaining rows (and the previous prompt/input).
+        output.append("\033[%d;1H\033[J" % (len(lines) + 1))
+        return "".join(output)
+
+
+class OutputBuffer(object):
+    """Collect the output for a stream, to write it with a single write.
+
+    Pending output gets written when flushing (e.g. before running code of
+    the program, to keep the order with its output), or with ``end``.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._pending = []
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def write(self, data):
+        self._pending.append(data)
+
+    def writelines(self, lines):
+        self._pending.extend(lines)
+
+    def write_pending(self):
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = []
+        try:
+            data = "".join(pending)
+        except UnicodeDecodeError:  # Python 2, mixed bytes and unicode.
+            for data in pending:
+                self.stream.write(data)
+        else:
+            self.stream.write(data)
+
+    def flush(self):
+        self.write_pending()
+        self.stream.flush()
+
+    def end(self, interrupted=False):
+        """Write pending output.
+
+        When ``interrupted`` (e.g. via KeyboardInterrupt while rendering),
+        colors get reset and the line gets ended."""
+        if interrupted and self._pending:
+            if any("\x1b[" in data for data in self._pending):
+                self._pending.append("\x1b[0m")
+            if not self._pending[-1].endswith("\n"):
+                self._pending.append("\n")
+        self.flush()
+
+
 class Undefined:
     def __repr__(self):
         return '<undefined>'
@@ -220,6 +1195,258 @@ class Undefined:
 undefined = Undefined()
 
 
+if sys.version_info < (3, ):
+    from collections import Mapping, MappingView
+
+    REPR_STRING_TYPES = (str, unicode, bytearray)  # noqa: F821
+    REPR_BUILTIN_DELIMITERS = {
+        list: ("[", "]"),
+        tuple: ("(", ")"),
+        dict: ("{", "}"),
+        set: ("set([", "])"),
+        frozenset: ("frozenset([", "])"),
+    }
+else:
+    from collections.abc import Mapping, MappingView
+
+    REPR_STRING_TYPES = (str, bytes, bytearray)
+    REPR_BUILTIN_DELIMITERS = {
+        list: ("[", "]"),
+        tuple: ("(", ")"),
+        dict: ("{", "}"),
+        set: ("{", "}"),
+        frozenset: ("frozenset({", "})"),
+    }
+
+
+# Repr methods of classes (and subclasses) that BudgetedRepr walks.
+REPR_WALKED_REPRS = tuple(set(
+    cls.__repr__ for cls in [
+        object, dict, list, tuple, set, frozenset, OrderedDict, deque,
+        defaultdict, Counter, type({}.keys()), type({}.values()),
+        type({}.items()),
+    ]
+))
+
+
+class BudgetedRepr(object):
+    """Create the repr of objects within budgets (None for no limit).
+
+    Containers (mappings, lists, tuples, sets, deques, and subclasses) get
+    walked up to ``max_depth`` levels, with up to ``max_items`` items each,
+    and strings get cut after ``max_chars``.  Other objects use their repr.
+    The output gets generated in chunks, and stops after ``max_chars``, or
+    when it took more than ``max_seconds``, which is checked between chunks.
+    Truncated parts are shown as "...".
+
+    Subclasses are shown with their name, e.g. ``OrderedDict({'a': 1})``,
+    unless they have a custom repr.
+    """
+
+    def __init__(self, max_chars=None, max_depth=None, max_items=None,
+                 max_seconds=None):
+        self.max_chars = max_chars
+        self.max_depth = max_depth
+        self.max_items = max_items
+        self.max_seconds = max_seconds
+        self._deadline = None
+
+    def repr(self, obj):
+        return "".join(self.iter_repr(obj))
+
+    def pformat(self, obj, width=80):
+        return "".join(self.iter_pformat(obj, width))
+
+    def iter_repr(self, obj):
+        """Generate the repr of obj in chunks."""
+        return self._limit(self._iter_repr(obj, 0, set()))
+
+    def iter_pformat(self, obj, width=80):
+        """Generate obj pretty-printed in chunks, similar to pprint."""
+        return self._limit(self._iter_pformat(obj, 0, set(), 0, 0, width))
+
+    def _limit(self, chunks):
+        if self.max_seconds is None:
+            self._deadline = None
+        else:
+            import time
+
+            self._deadline = time.time() + self.max_seconds
+        remaining = self.max_chars
+        for chunk in chunks:
+            if self._is_over_time():
+                yield "..."
+                return
+            if remaining is not None:
+                if len(chunk) > remaining:
+                    yield chunk[:remaining] + "..."
+                    return
+                remaining -= len(chunk)
+            yield chunk
+
+    def _is_over_time(self):
+        if self._deadline is None:
+            return False
+        import time
+
+        return time.time() > self._deadline
+
+    def _get_delimiters(self, obj, level, seen):
+        """Return (start, end) for containers to walk, None otherwise.
+
+        Containers that are too deep (or recursive) are walked without
+        items."""
+        if isinstance(obj, REPR_STRING_TYPES):
+            return None
+        delimiters = REPR_BUILTIN_DELIMITERS.get(type(obj))
+        if delimiters is not None:
+            pass
+        elif isinstance(obj, tuple) and hasattr(obj, "_fields"):
+            delimiters = (type(obj).__name__ + "(", ")")  # namedtuple
+        elif type(obj).__repr__ not in REPR_WALKED_REPRS:
+            return None  # Custom repr.
+        elif isinstance(obj, (Mapping, set, frozenset)):
+            delimiters = (type(obj).__name__ + "({", "})")
+        elif isinstance(obj, (list, tuple, deque, MappingView)):
+            delimiters = (type(obj).__name__ + "([", "])")
+        else:
+            return None
+        try:
+            if not len(obj):
+                return None
+        except Exception:
+            return None
+        if (id(obj) in seen
+                or (self.max_depth is not None and level >= self.max_depth)
+                or self._is_over_time()):
+            return delimiters[0] + "...", delimiters[1]
+        return delimiters
+
+    def _iter_items(self, obj):
+        """Return an iterator for (key prefix, item) tuples.
+
+        The prefix is a (key, value) tuple for mappings, a field name for
+        namedtuples, and None otherwise."""
+        if isinstance(obj, Mapping):
+            return ((item, item[1]) for item in
+                    getattr(obj, "iteritems", obj.items)())
+        if isinstance(obj, tuple) and hasattr(obj, "_fields"):
+            return iter(zip(obj._fields, obj))
+        return ((None, item) for item in obj)
+
+    def _iter_key(self, key, level, seen):
+        if isinstance(key, tuple):
+            for chunk in self._iter_repr(key[0], level, seen):
+                yield chunk
+            yield ": "
+        else:
+            yield key + "="
+
+    def _iter_repr(self, obj, level, seen):
+        delimiters = self._get_delimiters(obj, level, seen)
+        if delimiters is None:
+            if (isinstance(obj, REPR_STRING_TYPES)
+                    and self.max_chars is not None
+                    and len(obj) > self.max_chars):
+                yield repr(obj[:self.max_chars]) + "..."
+            else:
+                yield repr(obj)
+            return
+        start, end = delimiters
+        yield start
+        if start.endswith("..."):
+            yield end
+            return
+        seen.add(id(obj))
+        try:
+            for i, (key, item) in enumerate(self._iter_items(obj)):
+                if i:
+                    yield ", "
+                if self.max_items is not None and i >= self.max_items:
+                    yield "..."
+                    break
+                if key is not None:
+                    for chunk in self._iter_key(key, level + 1, seen):
+                        yield chunk
+                for chunk in self._iter_repr(item, level + 1, seen):
+                    yield chunk
+            if type(obj) is tuple and len(obj) == 1:
+                yield ","
+            yield end
+        finally:
+            seen.discard(id(obj))
+
+    def _get_line(self, obj, level, seen, max_len):
+        """Return the repr of obj, or None if it is longer than max_len."""
+        chunks = []
+        length = 0
+        for chunk in self._iter_repr(obj, level, seen):
+            length += len(chunk)
+            if length > max_len or self._is_over_time():
+                return None
+            chunks.append(chunk)
+        return "".join(chunks)
+
+    def _iter_pformat(self, obj, level, seen, indent, allowance, width):
+        """Generate obj pretty-printed, starting at column ``indent``.
+
+        ``allowance`` is the number of characters to keep free after it,
+        e.g. for closing brackets."""
+        line = self._get_line(obj, level, seen,
+                              max(width - indent - allowance, 0))
+        if line is not None:
+            yield line
+            return
+        delimiters = self._get_delimiters(obj, level, seen)
+        if delimiters is None or delimiters[0].endswith("..."):
+            for chunk in self._iter_repr(obj, level, seen):
+                yield chunk
+            return
+        start, end = delimiters
+        yield start
+        indent += len(start)
+        items = self._iter_items(obj)
+        num_items = len(obj)
+        if type(obj) is dict and (
+            self.max_items is None or num_items <= self.max_items
+        ):
+            # Sorted like with pprint, if all items are shown.
+            try:
+                items = iter(sorted(items, key=lambda item: item[0][0]))
+            except TypeError:
+                items = self._iter_items(obj)
+        seen.add(id(obj))
+        try:
+            for i, (key, item) in enumerate(items):
+                if i:
+                    yield ",\n" + " " * indent
+                if self.max_items is not None and i >= self.max_items:
+                    yield "..."
+                    break
+                item_indent = indent
+                if key is not None:
+                    key = "".join(self._iter_key(key, level + 1, seen))
+                    item_indent += len(key)
+                    yield key
+                is_last = i == num_items - 1 and not (
+                    self.max_items is not None and i + 1 >= self.max_items)
+                for chunk in self._iter_pformat(
+                    item, level + 1, seen, item_indent,
+                    allowance + len(end) if is_last else 1, width,
+                ):
+                    yield chunk
+            if type(obj) is tuple and num_items == 1:
+                yield ","
+            yield end
+        finally:
+            seen.discard(id(obj))
+
+
+# Code flags of frames which might get resumed after a "return" event.
+GENERATOR_AND_COROUTINE_FLAGS = getattr(
+    bdb, "GENERATOR_AND_COROUTINE_FLAGS", 0x20)
+
+
 class ArgWithCount(str):
     """Extend arguments with a count, e.g. "10pp …"."""
     def __new__(cls, value, count, **kwargs):
@@ -235,6 +1462,270 @@ class ArgWithCount(str):
         )
 
 
+class MonitoringTracer(object):
+    """Tracing backend using sys.monitoring (PEP 669, Python 3.12+).
+
+    Events get dispatched to the Bdb instance like with ``sys.settrace``,
+    but are only enabled where the debugger might stop: LINE events are
+    enabled for the code objects of frames being stepped through, or which
+    might contain breakpoints.  With breakpoints, PY_START events are used to
+    find code objects containing them when being called.  Other events get
+    disabled per location (via ``sys.monitoring.DISABLE``).
+
+    Only events from the thread where tracing was started are handled.
+    """
+
+    tool_name = "pdbpp"
+
+    # The instance using the (process-wide) tool id currently.
+    _current = None
+
+    def __init__(self, pdb_):
+        self.pdb = pdb_
+        self.active = False
+        self.frame = None  # The frame of the last event.
+        self.thread_id = None
+        self._local_events = {}  # code --> events
+
+    def acquire(self):
+        """Acquire the debugger tool id, returns False if used by another tool."""
+        mon = sys.monitoring
+        current = MonitoringTracer._current
+        if current is not None and current is not self:
+            current.stop()
+
+        owner = mon.get_tool(mon.DEBUGGER_ID)
+        if owner is None:
+            mon.use_tool_id(mon.DEBUGGER_ID, self.tool_name)
+        elif owner != self.tool_name:
+            return False
+
+        E = mon.events
+        for event, callback in (
+            (E.PY_START, self._on_call),
+            (E.PY_RESUME, self._on_call),
+            (E.LINE, self._on_line),
+            (E.PY_RETURN, self._on_return),
+            (E.PY_YIELD, self._on_return),
+            (E.RAISE, self._on_raise),
+            (E.PY_UNWIND, self._on_unwind),
+        ):
+            mon.register_callback(mon.DEBUGGER_ID, event, callback)
+        MonitoringTracer._current = self
+        return True
+
+    def start(self, frame):
+        """Start tracing from the given frame (like ``sys.settrace``)."""
+        self.active = True
+        self.frame = frame
+        self.thread_id = threading.current_thread().ident
+        self.update_events()
+
+    def stop(self):
+        """Stop tracing (like ``sys.settrace(None)``) and free the tool id."""
+        mon = sys.monitoring
+        if MonitoringTracer._current is self:
+            for code in self._local_events:
+                mon.set_local_events(mon.DEBUGGER_ID, code, 0)
+            mon.set_events(mon.DEBUGGER_ID, 0)
+            for event in mon.events.__dict__.values():
+                if isinstance(event, int) and event and not event & (event - 1):
+                    mon.register_callback(mon.DEBUGGER_ID, event, None)
+            mon.free_tool_id(mon.DEBUGGER_ID)
+            MonitoringTracer._current = None
+        self._local_events = {}
+        self.active = False
+
+    def update_events(self):
+        """Enable events according to the stepping state of the debugger."""
+        mon = sys.monitoring
+        E = mon.events
+        pdb_ = self.pdb
+        if pdb_.quitting or MonitoringTracer._current is not self:
+            self.stop()
+            return
+
+        step_events = E.LINE | E.PY_RETURN | E.PY_YIELD
+        local_events = {}
+        global_events = 0
+
+        def add(code, events):
+            local_events[code] = local_events.get(code, 0) | events
+
+        if pdb_.stopframe is None:
+            # step: stop anywhere.
+            if self.frame is not None:
+                add(self.frame.f_code, step_events)
+            global_events |= E.PY_START | E.PY_RESUME | E.RAISE | E.PY_UNWIND
+        elif pdb_.stoplineno != -1:
+            # next, until, return: stop in stopframe.
+            add(pdb_.stopframe.f_code, step_events)
+            global_events |= E.RAISE | E.PY_UNWIND
+        if pdb_.returnframe is not None:
+            add(pdb_.returnframe.f_code, E.PY_RETURN | E.PY_YIELD)
+        if pdb_.breaks:
+            global_events |= E.PY_START | E.PY_RESUME
+            frame = self.frame
+            while frame is not None:
+                if pdb_.break_anywhere(frame):
+                    add(frame.f_code, E.LINE)
+                frame = frame.f_back
+        for watchpoint in pdb_._expr_watchpoints:
+            add(watchpoint.frame.f_code, step_events)
+            if watchpoint.callees:
+                global_events |= E.PY_START | E.PY_RESUME
+
+        if not global_events and not local_events:
+            self.stop()
+            return
+
+        for code in self._local_events:
+            if code not in local_events:
+                mon.set_local_events(mon.DEBUGGER_ID, code, 0)
+        for code, events in local_events.items():
+            mon.set_local_events(mon.DEBUGGER_ID, code, events)
+        self._local_events = local_events
+        mon.set_events(mon.DEBUGGER_ID, global_events)
+        mon.restart_events()
+
+    def _enable_local_events(self, code, events):
+        events |= self._local_events.get(code, 0)
+        if self._local_events.get(code) != events:
+            sys.monitoring.set_local_events(sys.monitoring.DEBUGGER_ID, code, events)
+            self._local_events[code] = events
+
+    def _get_frame(self):
+        """Get the frame for the current event, or None to ignore it."""
+        if (
+            not self.active
+            or self.pdb._in_interaction
+            or threading.current_thread().ident != self.thread_id
+        ):
+            return None
+        # The frame of the code calling the callback (via _get_frame).
+        self.frame = sys._getframe(2)
+        return self.frame
+
+    def _can_disable_line(self, frame):
+        pdb_ = self.pdb
+        if pdb_.stopframe is None or pdb_._expr_watchpoints:
+            return False
+        code = frame.f_code
+        if pdb_.stoplineno != -1 and code is pdb_.stopframe.f_code:
+            return False
+        if pdb_.returnframe is not None and code is pdb_.returnframe.f_code:
+            return False
+        lines = pdb_.breaks.get(pdb_.canonic(code.co_filename))
+        return not lines or (
+            frame.f_lineno not in lines and code.co_firstlineno not in lines
+        )
+
+    def _on_call(self, code, instruction_offset):
+        frame = self._get_frame()
+        if frame is None:
+            return
+        pdb_ = self.pdb
+        if pdb_.trace_dispatch(frame, "call", None) is not None:
+            # Trace lines in this code (as with a local trace function).
+            E = sys.monitoring.events
+            if (
+                pdb_.stopframe is not None
+                and pdb_.stoplineno == -1
+                and not pdb_._watch_callees
+            ):
+                self._enable_local_events(code, E.LINE)
+            else:
+                self._enable_local_events(code, E.LINE | E.PY_RETURN | E.PY_YIELD)
+        if pdb_.stopframe is not None and not pdb_._watch_callees:
+            return sys.monitoring.DISABLE
+
+    def _on_line(self, code, line_number):
+        frame = self._get_frame()
+        if frame is None:
+            return
+        self.pdb.trace_dispatch(frame, "line", None)
+        if self.active and self._can_disable_line(frame):
+            return sys.monitoring.DISABLE
+
+    def _on_return(self, code, instruction_offset, retval):
+        frame = self._get_frame()
+        if frame is None:
+            return
+        self._dispatch_return(frame, retval)
+
+    def _dispatch_return(self, frame, retval):
+        pdb_ = self.pdb
+        pdb_.trace_dispatch(frame, "return", retval)
+        if self.active and pdb_.stopframe is None and frame.f_back is not None:
+            # Continue stepping in the caller.
+            E = sys.monitoring.events
+            self.frame = frame.f_back
+            self._enable_local_events(
+                frame.f_back.f_code, E.LINE | E.PY_RETURN | E.PY_YIELD
+            )
+
+    def _on_raise(self, code, instruction_offset, exc):
+        frame = self._get_frame()
+        if frame is None:
+            return
+        self.pdb.trace_dispatch(
+            frame, "exception", (type(exc), exc, exc.__traceback__)
+        )
+
+    def _on_unwind(self, code, instruction_offset, exc):
+        frame = self._get_frame()
+        if frame is None:
+            return
+        # A "return" event like with sys.settrace (RAISE is emitted for
+        # the caller then).
+        self._dispatch_return(frame, None)
+
+
+class ExprWatchpoint(object):
+    """An expression watched for changes, from the "watch" command.
+
+    It gets evaluated in the frame where it was set, but only checked for
+    (line and return) events in that frame, or in frames called from it with
+    ``callees``.
+    """
+
+    def __init__(self, number, expr, frame, callees, value):
+        self.number = number
+        self.expr = expr
+        self.code = compile_expr(expr)
+        self.frame = frame
+        self.callees = callees
+        self.value = value
+        # (filename, lineno) of the line executed before the next check.
+        self.location = (frame.f_code.co_filename, frame.f_lineno)
+
+    def applies_to(self, frame):
+        while frame is not None:
+            if frame is self.frame:
+                return True
+            if not self.callees:
+                return False
+            frame = frame.f_back
+        return False
+
+    def update(self):
+        """Evaluate the expression again, returns True if the value changed."""
+        oldvalue = self.value
+        try:
+            self.value = value = eval(
+                self.code, self.frame.f_globals, self.frame.f_locals)
+        except Exception:
+            self.value = value = undefined
+        # Check for identity first, to not call a custom __eq__ for every
+        # line while it is unchanged.
+        if value is oldvalue:
+            return False
+        try:
+            return bool(value != oldvalue)
+        except Exception:
+            return True
+
+
 class PdbMeta(type):
     def __call__(cls, *args, **kwargs):
         """Reuse an existing instance with ``pdb.set_trace()``."""
@@ -321,6 +1812,8 @@ class PdbMeta(type):
         if getattr(obj, "_use_global_pdb_for_class", None) == C:
             return True
         if sys.version_info < (3, 3):
+            import inspect
+
             return inspect.getsourcelines(obj.__class__) == inspect.getsourcelines(C)
         return C.__qualname__ == obj.__class__.__qualname__
 
@@ -340,7 +1833,19 @@ class PdbMeta(type):
         return called_for_set_trace
 
 
-@six.add_metaclass(PdbMeta)
+def _add_metaclass(metaclass):
+    """Class decorator for creating a class with a metaclass (from six)."""
+    def wrapper(cls):
+        orig_vars = cls.__dict__.copy()
+        orig_vars.pop('__dict__', None)
+        orig_vars.pop('__weakref__', None)
+        if hasattr(cls, '__qualname__'):
+            orig_vars['__qualname__'] = cls.__qualname__
+        return metaclass(cls.__name__, cls.__bases__, orig_vars)
+    return wrapper
+
+
+@_add_metaclass(PdbMeta)
 class Pdb(pdb.Pdb, ConfigurableClass, object):
 
     DefaultConfig = DefaultConfig
@@ -349,6 +1854,8 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
     fancycompleter = None
 
     _in_interaction = False
+    _monitoring_tracer = None
+    _previous_trace = None  # Trace function before set_trace.
 
     def __init__(self, *args, **kwds):
         self.ConfigFactory = kwds.pop('Config', None)
@@ -371,6 +1878,21 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
         self.display_list = {}  # frame --> (name --> last seen value)
         self.tb_lineno = {}  # frame --> lineno where the exception raised
         self.history = []
+        # code --> (filename, lines) of breakpoints
+        self._code_breaks = weakref.WeakKeyDictionary()
+        self._bp_counts = {}  # breakpoint --> [evaluated, stopped]
+        self._expr_watchpoints = []
+        self._watch_callees = False  # Any watchpoint includes callees.
+        self._watch_number = 0
+        # code --> (hidden, uses __tracebackhide__)
+        self._code_hidden = weakref.WeakKeyDictionary()
+        self._skip_matcher = None  # (tuple(skip), match, memo)
+        if self.config.skip_stdlib or self.config.skip_site_packages:
+            self.skip = set(self.skip or ())
+            if self.config.skip_stdlib:
+                self.skip.add(SKIP_STDLIB)
+            if self.config.skip_site_packages:
+                self.skip.add(SKIP_SITE_PACKAGES)
         self.show_hidden_frames = False
         self._hidden_frames = []
 
@@ -381,9 +1903,46 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
         self._sticky_messages = []  # Message queue for sticky mode.
         self._sticky_need_cls = False
         self._sticky_skip_cls = False
+        self._sticky_screen = StickyScreen()
+        self._highlight_worker = HighlightWorker()
+        self._highlight_disk_cache = None
+        self._output_buffer = None  # OutputBuffer, while buffering.
+        self._terminal_size = None  # Cached during an interaction.
+        self._sigwinch_handler = None  # (handler, previous handler).
 
         self._setup_streams(stdout=self.stdout)
 
+    def get_config(self, Config):
+        """Get config, re-using the Config class loaded from the config file.
+
+        The class gets cached per process, and is loaded again when the
+        mtime or size of the file changes.
+        """
+        if Config is not None:
+            return Config()
+
+        rcfile = os.path.normpath(
+            os.path.expanduser("~/" + self.config_filename)
+        )
+        try:
+            st = os.stat(rcfile)
+        except OSError:
+            return super(Pdb, self).get_config(Config)
+
+        key = (rcfile, self.DefaultConfig)
+        stat_key = (st.st_mtime, st.st_size)
+        try:
+            cached_stat_key, Config = _config_cache[key]
+        except KeyError:
+            pass
+        else:
+            if cached_stat_key == stat_key:
+                return Config()
+
+        config = super(Pdb, self).get_config(None)
+        _config_cache[key] = (stat_key, type(config))
+        return config
+
     @property
     def prompt(self):
         return self._prompt
@@ -400,6 +1959,44 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
     def _setup_streams(self, stdout):
         self.stdout = self.ensure_file_can_write_unicode(stdout)
 
+    def _begin_output_buffer(self):
+        """Collect output, to write it at once with _end_output_buffer.
+
+        This is used for the output of each command (and when stopping), to
+        avoid many small writes, e.g. via codecs.getwriter."""
+        if self._output_buffer is not None or not self.config.buffer_output:
+            return
+        self._output_buffer = OutputBuffer(self.stdout)
+        self.stdout = self._output_buffer
+
+    def _end_output_buffer(self, interrupted=False):
+        output_buffer = self._output_buffer
+        if output_buffer is None:
+            return
+        self._output_buffer = None
+        if self.stdout is output_buffer:
+            self.stdout = output_buffer.stream
+        output_buffer.end(interrupted=interrupted)
+
+    def _flush_output_buffer(self):
+        """Write the collected output, before running code of the program.
+
+        Returns the stream to use for it (instead of the buffer)."""
+        if self._output_buffer is not None:
+            self._output_buffer.flush()
+            if self.stdout is self._output_buffer:
+                return self._output_buffer.stream
+        return self.stdout  # E.g. a StringIO with "paste".
+
+    def cmdloop(self, intro=None):
+        try:
+            return super(Pdb, self).cmdloop(intro)
+        except KeyboardInterrupt:
+            self._end_output_buffer(interrupted=True)
+            raise
+        finally:
+            self._end_output_buffer()
+
     def ensure_file_can_write_unicode(self, f):
         # Wrap with an encoder, but only if not already wrapped
         if (not hasattr(f, 'stream')
@@ -465,6 +2062,13 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
                 pass
             else:
                 pdb.Pdb._previous_sigint_handler = None
+        self._install_sigwinch_handler()
+        try:
+            return self._interaction_with_sigwinch_handler(frame, traceback)
+        finally:
+            self._uninstall_sigwinch_handler()
+
+    def _interaction_with_sigwinch_handler(self, frame, traceback):
         ret = self.setup(frame, traceback)
         if ret:
             # no interaction desired at this time (happens if .pdbrc contains
@@ -492,10 +2096,13 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
             else:
                 self.cmdloop()
 
+        self._highlight_worker.cancel()
         self.forget()
 
     def break_here(self, frame):
-        ret = super(Pdb, self).break_here(frame)
+        ret = self._break_here(frame)
+        if self._expr_watchpoints and self._check_expr_watchpoints(frame):
+            ret = True
         if ret:
             # Skip clearing screen if invoked via breakpoint, which e.g.
             # might execute/display output from commands.
@@ -518,11 +2125,29 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
         stop = super(Pdb, self).postcmd(stop, line)
         if self.sticky:
             if stop and not self.commands_defining:
-                self._sticky_handle_cls()
+                if self._use_sticky_screen():
+                    # Cleared when rendering again, if necessary.
+                    self._end_output_buffer()
+                    self.stdout.flush()
+                    self._sticky_screen.resume()
+                else:
+                    self._sticky_handle_cls()
             else:
+                self._sticky_screen.end_command(self._sticky_messages)
                 self._flush_sticky_messages()
+        self._end_output_buffer()
+        if not stop:
+            self._start_highlight_worker()
         return stop
 
+    def _use_sticky_screen(self):
+        if self.config.sticky_redraw != "diff":
+            return False
+        try:
+            return self.stdout.isatty()
+        except Exception:
+            return False
+
     def _flush_sticky_messages(self):
         if self._sticky_messages:
             for msg in self._sticky_messages:
@@ -533,12 +2158,299 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
     def set_continue(self):
         if self.sticky:
             self._sticky_skip_cls = True
+        if self._expr_watchpoints:
+            # Keep tracing (Bdb.set_continue stops without breakpoints).
+            self._set_stopinfo(self.botframe, None, -1)
+            return
         super(Pdb, self).set_continue()
+        if not self.breaks:
+            self._teardown_trace()
+
+    def _teardown_trace(self):
+        """Remove the trace function from the frames of all threads.
+
+        Bdb.set_continue only removes it from the frames up to botframe in
+        the current thread, and leaves sys.settrace(None).  This also handles
+        e.g. the bottom frame (an event loop), and restores the trace
+        function from before set_trace (e.g. coverage.py)."""
+        trace_dispatch = self.trace_dispatch
+        for frame in sys._current_frames().values():
+            while frame is not None:
+                if frame.f_trace == trace_dispatch:
+                    del frame.f_trace
+                frame = frame.f_back
+        # The dispatch_* methods return self.trace_dispatch, which would get
+        # set as f_trace of the current frame again (and called with the
+        # previous trace function).  Shadow it until the next reset().
+        self.trace_dispatch = None
+        sys.settrace(self._previous_trace)
+        self._previous_trace = None
 
     def set_quit(self):
         if self.sticky:
             self._sticky_skip_cls = True
         super(Pdb, self).set_quit()
+        del self._expr_watchpoints[:]
+        self._watch_callees = False
+        if self._monitoring_tracer is not None:
+            self._monitoring_tracer.stop()
+
+    def _set_stopinfo(self, stopframe, returnframe, *args, **kwargs):
+        # Python 3.13 added the "opcode" argument.
+        super(Pdb, self)._set_stopinfo(stopframe, returnframe, *args, **kwargs)
+        if self._monitoring_tracer is not None and self._monitoring_tracer.active:
+            self._monitoring_tracer.update_events()
+
+    def _get_monitoring_tracer(self):
+        """Get the tracer for the "monitoring" trace_backend, if used."""
+        if (
+            self.config.trace_backend != "monitoring"
+            or not hasattr(sys, "monitoring")
+        ):
+            return None
+        if self._monitoring_tracer is None:
+            self._monitoring_tracer = MonitoringTracer(self)
+        return self._monitoring_tracer
+
+    def break_anywhere(self, frame):
+        """Return True if there is any breakpoint in the code of the frame.
+
+        This overrides Bdb.break_anywhere, which considers breakpoints in the
+        whole file.  With this, calls to code without breakpoints do not get
+        traced (no local trace function in dispatch_call).
+
+        Frames called from frames with watchpoints for callees are traced
+        also."""
+        if self._get_code_breaks(frame.f_code) is not None:
+            return True
+        return self._watch_callees and any(
+            watchpoint.callees and watchpoint.applies_to(frame)
+            for watchpoint in self._expr_watchpoints
+        )
+
+    def _get_code_breaks(self, code):
+        """Return (filename, lines) of breakpoints in code, or None."""
+        try:
+            return self._code_breaks[code]
+        except KeyError:
+            pass
+        filename = self.canonic(code.co_filename)
+        lines = self.breaks.get(filename)
+        if lines:
+            lines = code_lines(code).intersection(lines)
+        code_breaks = (filename, frozenset(lines)) if lines else None
+        self._code_breaks[code] = code_breaks
+        return code_breaks
+
+    def dispatch_call(self, frame, arg):
+        # Fast path for "continue" (where stop_here is False) into code
+        # known to have no breakpoints.
+        if (
+            self.stoplineno == -1
+            and self.stopframe is self.botframe
+            and self._code_breaks.get(frame.f_code, True) is None
+            and not self._watch_callees
+        ):
+            return None
+        return super(Pdb, self).dispatch_call(frame, arg)
+
+    def dispatch_return(self, frame, arg):
+        if self._expr_watchpoints:
+            if self._check_expr_watchpoints(frame, returning=True):
+                # Stop at the return, like when stepping.
+                self._set_stopinfo(None, None)
+                self._sticky_skip_cls = True
+            self._forget_expr_watchpoints(frame)
+        return super(Pdb, self).dispatch_return(frame, arg)
+
+    def _check_expr_watchpoints(self, frame, returning=False):
+        """Check the watchpoints for a line or return event in frame.
+
+        Returns True if a value changed, after reporting it."""
+        changed = False
+        location = (frame.f_code.co_filename, frame.f_lineno)
+        for watchpoint in self._expr_watchpoints:
+            if not watchpoint.applies_to(frame):
+                continue
+            if returning:
+                # The line has been executed already.
+                watchpoint.location = location
+            oldvalue = watchpoint.value
+            if watchpoint.update():
+                changed = True
+                self._report_expr_watchpoint(watchpoint, oldvalue)
+            watchpoint.location = location
+        return changed
+
+    def _report_expr_watchpoint(self, watchpoint, oldvalue):
+        import linecache
+
+        filename, lineno = watchpoint.location
+        self.message("Watchpoint %d: %s: %r --> %r" % (
+            watchpoint.number, watchpoint.expr, oldvalue, watchpoint.value))
+        self.message("Changed by %s:%d: %s" % (
+            filename, lineno, linecache.getline(filename, lineno).strip()))
+
+    def _forget_expr_watchpoints(self, frame):
+        """Remove the watchpoints of a returning frame."""
+        if frame.f_code.co_flags & GENERATOR_AND_COROUTINE_FLAGS:
+            return  # Might get resumed.
+        for watchpoint in list(self._expr_watchpoints):
+            if watchpoint.frame is frame:
+                self._remove_expr_watchpoint(watchpoint)
+                self.message("Watchpoint %d deleted: %s() returned" % (
+                    watchpoint.number, frame.f_code.co_name))
+                if not self._expr_watchpoints and self.stoplineno == -1:
+                    # Stop tracing, as with "continue" without them.
+                    self.set_continue()
+
+    def _remove_expr_watchpoint(self, watchpoint):
+        self._expr_watchpoints.remove(watchpoint)
+        self._watch_callees = any(
+            watchpoint.callees for watchpoint in self._expr_watchpoints)
+
+    def _refresh_expr_watchpoints(self):
+        """Update the watched values when stopping, e.g. after stepping."""
+        frame = self.stack[-1][0] if self.stack else None
+        for watchpoint in self._expr_watchpoints:
+            watchpoint.update()
+            if frame is not None and watchpoint.applies_to(frame):
+                watchpoint.location = (frame.f_code.co_filename, frame.f_lineno)
+
+    def set_break(self, *args, **kwargs):
+        self._code_breaks.clear()
+        return super(Pdb, self).set_break(*args, **kwargs)
+
+    def clear_break(self, *args, **kwargs):
+        self._code_breaks.clear()
+        result = super(Pdb, self).clear_break(*args, **kwargs)
+        self._prune_bp_counts()
+        return result
+
+    def clear_all_file_breaks(self, *args, **kwargs):
+        self._code_breaks.clear()
+        result = super(Pdb, self).clear_all_file_breaks(*args, **kwargs)
+        self._prune_bp_counts()
+        return result
+
+    def clear_all_breaks(self, *args, **kwargs):
+        self._code_breaks.clear()
+        result = super(Pdb, self).clear_all_breaks(*args, **kwargs)
+        self._prune_bp_counts()
+        return result
+
+    def clear_bpbynumber(self, *args, **kwargs):
+        self._code_breaks.clear()
+        result = super(Pdb, self).clear_bpbynumber(*args, **kwargs)
+        self._prune_bp_counts()
+        return result
+
+    def _prune_breaks(self, *args, **kwargs):
+        # Used with "clear N" and temporary breakpoints (Python 3).
+        self._code_breaks.clear()
+        result = super(Pdb, self)._prune_breaks(*args, **kwargs)
+        self._prune_bp_counts()
+        return result
+
+    def _prune_bp_counts(self):
+        """Remove the counts of deleted breakpoints."""
+        bpbynumber = bdb.Breakpoint.bpbynumber
+        for bp in list(self._bp_counts):
+            if bp.number >= len(bpbynumber) or bpbynumber[bp.number] is not bp:
+                del self._bp_counts[bp]
+
+    def _break_here(self, frame):
+        """Same as Bdb.break_here, but using effective_breakpoint.
+
+        Lines are looked up in the breakpoints of the frame's code, without
+        canonicalizing its filename for every line."""
+        code_breaks = self._get_code_breaks(frame.f_code)
+        if code_breaks is None:
+            return False
+        filename, lines = code_breaks
+        lineno = frame.f_lineno
+        if lineno not in lines:
+            lineno = frame.f_code.co_firstlineno
+            if lineno not in lines:
+                return False
+
+        bp, flag = self.effective_breakpoint(filename, lineno, frame)
+        if bp:
+            self._bp_counts[bp][1] += 1
+            self.currentbp = bp.number
+            if flag and bp.temporary:
+                self.do_clear(str(bp.number))
+            return True
+        return False
+
+    def effective_breakpoint(self, filename, lineno, frame):
+        """Return (breakpoint, delete temporary flag) or (None, None).
+
+        Same as bdb.effective, but using compiled conditions."""
+        for bp in bdb.Breakpoint.bplist.get((filename, lineno), ()):
+            if not bp.enabled:
+                continue
+            if not bdb.checkfuncname(bp, frame):
+                continue
+            bp.hits += 1
+            try:
+                self._bp_counts[bp][0] += 1
+            except KeyError:
+                self._bp_counts[bp] = [1, 0]
+            if not bp.cond:
+                if bp.ignore > 0:
+                    bp.ignore -= 1
+                    continue
+                return bp, True
+            try:
+                val = eval(compile_expr(bp.cond), frame.f_globals, frame.f_locals)
+            except:
+                # Stop (regardless of ignore count) if the condition fails,
+                # but do not delete temporary breakpoints.
+                return bp, False
+            if val:
+                if bp.ignore > 0:
+                    bp.ignore -= 1
+                else:
+                    return bp, True
+        return None, None
+
+    def do_break(self, arg, temporary=0):
+        comma = arg.find(",")
+        if comma > 0:
+            if not self._check_expr(arg[comma + 1:].lstrip(), "condition"):
+                return
+        return super(Pdb, self).do_break(arg, temporary)
+    do_break.__doc__ = pdb.Pdb.do_break.__doc__
+    do_b = do_break
+
+    def do_info(self, arg):
+        """info breakpoints
+        List breakpoints with the number of times they were evaluated
+        (i.e. reached while being enabled), and did stop."""
+        if arg.strip() not in ("b", "break", "breakpoints"):
+            self.error("Usage: info breakpoints")
+            return
+        bps = [bp for bp in bdb.Breakpoint.bpbynumber if bp]
+        if not bps:
+            self.message("No breakpoints.")
+            return
+        wheres = ["%s:%d" % (bp.file, bp.line) for bp in bps]
+        width = max(len(where) for where in wheres)
+        self.message("%-4s %-*s %9s %7s" % (
+            "Num", width, "Where", "Evaluated", "Stopped"))
+        for bp, where in zip(bps, wheres):
+            evaluated, stopped = self._bp_counts.get(bp, (0, 0))
+            self.message("%-4d %-*s %9d %7d" % (
+                bp.number, width, where, evaluated, stopped))
+
+    def do_condition(self, arg):
+        args = arg.split(" ", 1)
+        if len(args) > 1 and args[1].strip():
+            if not self._check_expr(args[1], "condition"):
+                return
+        return super(Pdb, self).do_condition(arg)
+    do_condition.__doc__ = pdb.Pdb.do_condition.__doc__
 
     def _setup_fancycompleter(self):
         """Similar to fancycompleter.setup(), but returning the old completer."""
@@ -599,27 +2511,47 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
         if not self.config.enable_hidden_frames:
             return False
 
+        code = frame.f_code
+        try:
+            hidden_code, tbh_local = self._code_hidden[code]
+        except KeyError:
+            hidden_code, tbh_local = self._code_hidden[code] = (
+                self._classify_code(code))
+
         # Decorated code is always considered to be hidden.
-        consts = frame.f_code.co_consts
-        if consts and consts[-1] is _HIDE_FRAME:
+        if hidden_code:
             return True
 
         # Do not hide if this frame contains the initial set_trace.
         if frame is getattr(self, "_via_set_trace_frame", None):
             return False
 
-        if frame.f_globals.get('__unittest'):
+        f_globals = frame.f_globals
+        if f_globals.get('__unittest'):
             return True
 
+        # Only look at (a snapshot of) the locals if the code uses the name.
         # `f_locals` might be a list (checked via PyMapping_Check).
-        try:
-            tbh = frame.f_locals["__tracebackhide__"]
-        except (TypeError, KeyError):
+        if tbh_local:
             try:
-                tbh = frame.f_globals["__tracebackhide__"]
+                return bool(frame.f_locals["__tracebackhide__"])
             except (TypeError, KeyError):
-                return False
-        return bool(tbh)
+                pass
+        try:
+            return bool(f_globals["__tracebackhide__"])
+        except (TypeError, KeyError):
+            return False
+
+    @staticmethod
+    def _classify_code(code):
+        """Return (hidden, uses __tracebackhide__) for a code object."""
+        consts = code.co_consts
+        hidden = bool(consts) and consts[-1] is _HIDE_FRAME
+        name = "__tracebackhide__"
+        tbh_local = name in code.co_varnames or name in code.co_cellvars
+        if not code.co_flags & 0x1:  # not CO_OPTIMIZED, i.e. a locals dict.
+            tbh_local = tbh_local or name in code.co_names
+        return hidden, tbh_local
 
     def get_stack(self, f, t):
         # show all the frames, except the ones that explicitly ask to be hidden
@@ -666,6 +2598,7 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
         """Set values of attributes as ready to start debugging.
 
         This overrides Bdb.reset to not clear the linecache (bpo-39967)."""
+        self.__dict__.pop("trace_dispatch", None)  # See _teardown_trace.
         self.botframe = None
         self._set_stopinfo(None, None)
         self.forget()
@@ -816,7 +2749,9 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
         if self.config.use_pygments is not False:
             loc, _, source = entry.rpartition(lprefix)
             if _:
-                entry = loc + _ + self.format_source(source).rstrip()
+                frame, lineno = frame_lineno
+                entry = loc + _ + self._highlight_stack_entry_source(
+                    source, frame, lineno)
         return entry
 
     def try_to_decode(self, s):
@@ -850,13 +2785,52 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
             ))
             return False
 
-        lexer = pygments.lexers.PythonLexer(stripnl=False)
+        if self.config.highlighter == "builtin":
+            from pygments.token import string_to_tokentype
 
-        def syntax_highlight(src):
-            return pygments.highlight(src, lexer, pygments_formatter)
+            def syntax_highlight(src):
+                return pygments.format((
+                    (string_to_tokentype(token_type), text)
+                    for token_type, text in tokenize_source(src)
+                ), pygments_formatter)
+        else:
+            lexer = pygments.lexers.PythonLexer(stripnl=False)
 
+            def syntax_highlight(src):
+                return pygments.highlight(src, lexer, pygments_formatter)
+
+        # For HighlightCache, shared by instances with the same formatter.
+        syntax_highlight.cache_key = self._get_highlight_key()
         return syntax_highlight
 
+    def _get_pygments_formatter_path(self):
+        """Return the dotted path of the Pygments formatter class to use."""
+        if self.config.pygments_formatter_class:
+            return self.config.pygments_formatter_class
+
+        if getattr(self.config, "use_terminal256formatter", None) is not None:
+            # Deprecated, never really documented (only changelog).
+            if self.config.use_terminal256formatter:
+                return "pygments.formatters.Terminal256Formatter"
+            return "pygments.formatters.TerminalFormatter"
+
+        term = os.environ.get("TERM", "")
+        if term in ("xterm-kitty",):
+            return "pygments.formatters.TerminalTrueColorFormatter"
+        elif "256color" in term:
+            return "pygments.formatters.Terminal256Formatter"
+        return "pygments.formatters.TerminalFormatter"
+
+    def _get_pygments_formatter_kwargs(self):
+        formatter_kwargs = {
+            # Only used by TerminalFormatter.
+            "bg": self.config.bg,
+            "colorscheme": self.config.colorscheme,
+            "style": "default",
+        }
+        formatter_kwargs.update(self.config.pygments_formatter_kwargs)
+        return formatter_kwargs
+
     def _get_pygments_formatter(self):
         if hasattr(self.config, 'formatter'):
             # Deprecated, never documented.
@@ -864,62 +2838,173 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
             # the config already, although it might never be used.
             return self.config.formatter
 
+        module_path, class_name = self._get_pygments_formatter_path().rsplit(
+            '.', 1)
         if self.config.pygments_formatter_class:
             from importlib import import_module
 
-            def import_string(dotted_path):
-                module_path, class_name = dotted_path.rsplit('.', 1)
-                module = import_module(module_path)
-                return getattr(module, class_name)
+            module = import_module(module_path)
+        else:
+            import pygments.formatters as module
+
+        Formatter = getattr(module, class_name)
+        return Formatter(**self._get_pygments_formatter_kwargs())
+
+    def _get_highlight_key(self):
+        """Return the key for source highlighted with the configuration.
 
-            Formatter = import_string(self.config.pygments_formatter_class)
+        This is a string with the Pygments version and formatter (class and
+        options), which gets determined without importing Pygments."""
+        version = get_pygments_version()
+        if version is None:
+            return self._get_builtin_highlight_key()
+        if hasattr(self.config, 'formatter'):
+            formatter = self.config.formatter
+            path = "%s.%s" % (type(formatter).__module__,
+                              type(formatter).__name__)
+            options = getattr(formatter, "options", {})
         else:
-            import pygments.formatters
-
-            if getattr(self.config, "use_terminal256formatter", None) is not None:
-                # Deprecated, never really documented (only changelog).
-                if self.config.use_terminal256formatter:
-                    Formatter = pygments.formatters.Terminal256Formatter
-                else:
-                    Formatter = pygments.formatters.TerminalFormatter
-            else:
-                term = os.environ.get("TERM", "")
-                if term in ("xterm-kitty",):
-                    Formatter = pygments.formatters.TerminalTrueColorFormatter
-                elif "256color" in term:
-                    Formatter = pygments.formatters.Terminal256Formatter
-                else:
-                    Formatter = pygments.formatters.TerminalFormatter
+            path = self._get_pygments_formatter_path()
+            options = self._get_pygments_formatter_kwargs()
+        key = (version, path, sorted(options.items()))
+        if self.config.highlighter == "builtin":
+            key = ("builtin",) + key
+        return repr(key)
+
+    def _get_builtin_highlight_key(self):
+        return repr(("builtin", self.config.bg))
+
+    def _get_builtin_highlight_function(self):
+        """Return a function to highlight source without Pygments.
+
+        It uses tokenize, and colors like Pygments' TerminalFormatter."""
+        colors = dict(
+            (token_type, codes[self.config.bg == "dark"])
+            for token_type, codes in BUILTIN_TERMINAL_COLORS.items()
+        )
 
-        formatter_kwargs = {
-            # Only used by TerminalFormatter.
-            "bg": self.config.bg,
-            "colorscheme": self.config.colorscheme,
-            "style": "default",
-        }
-        formatter_kwargs.update(self.config.pygments_formatter_kwargs)
+        def syntax_highlight(src):
+            return format_tokens(tokenize_source(src), colors)
 
-        return Formatter(**formatter_kwargs)
+        syntax_highlight.cache_key = self._get_builtin_highlight_key()
+        return syntax_highlight
 
-    def format_source(self, src):
+    def _get_highlight_function(self):
+        """Return the function to highlight source, or None if disabled."""
         if self.config.use_pygments is False:
-            return src
+            return None
 
         if not hasattr(self, "_highlight"):
             self._highlight = self._get_source_highlight_function()
 
             if self._highlight is False:
                 if self.config.use_pygments is True:
-                    self.message("Could not import pygments, disabling.")
-                self.config.use_pygments = False
-                return src
+                    self.message("Could not import pygments, using the "
+                                 "builtin highlighter.")
+                self._highlight = self._get_builtin_highlight_function()
+
+        return self._highlight
+
+    def format_source(self, src):
+        highlight = self._get_highlight_function()
+        if highlight is None:
+            return src
+        return highlight(self.try_to_decode(src))
+
+    def _get_cache_highlight(self, setup=True):
+        """Return the highlight function and its key for the HighlightCache.
+
+        Unless the highlight function is set up already, Pygments only gets
+        imported when highlighting (i.e. not for source cached on disk).
+        Without ``setup`` it raises HighlightUnavailable then instead (for
+        use in threads).  Returns (None, None) without highlighting."""
+        if self.config.use_pygments is False:
+            return None, None
+
+        if not hasattr(self, "_highlight"):
+            key = self._get_highlight_key()
+            if key is not None:
+                def highlight(src):
+                    if setup or hasattr(self, "_highlight"):
+                        func = self._get_highlight_function()
+                        if func is not None:
+                            return func(self.try_to_decode(src))
+                    raise HighlightUnavailable()
+
+                return highlight, key
+
+        func = self._get_highlight_function()
+        if func is None:
+            return None, None
+        return (
+            lambda src: func(self.try_to_decode(src)),
+            getattr(func, "cache_key", func),
+        )
+
+    def _get_highlight_disk_cache(self):
+        """Return the HighlightDiskCache, if enabled in the config."""
+        if not self.config.highlight_disk_cache:
+            return None
+        if self._highlight_disk_cache is None:
+            self._highlight_disk_cache = HighlightDiskCache(
+                os.path.join(_get_cache_dir(), "highlight"),
+                self.config.highlight_disk_cache_size,
+            )
+        return self._highlight_disk_cache
+
+    def _get_highlighted_file(self, filename, module_globals=None, lines=None):
+        """Return the highlighted lines of a file, via the HighlightCache.
 
-        return self._highlight_cached(src)
+        Returns None without highlighting, or if there is no source."""
+        highlight, key = self._get_cache_highlight()
+        if highlight is None:
+            return None
+        if lines is None:
+            import linecache
+
+            lines = linecache.getlines(filename, module_globals)
+        if not lines:
+            return None
+        try:
+            return _highlight_cache.get(
+                filename, lines, highlight, key,
+                disk=self._get_highlight_disk_cache())
+        except HighlightUnavailable:
+            return None
+
+    def _highlight_lines(self, lines, lineno, filename=None,
+                         module_globals=None):
+        """Highlight lines (without line endings), starting at lineno.
+
+        They are taken from the highlighted file if they match its source,
+        otherwise they get highlighted on their own."""
+        if filename is not None and lines:
+            highlighted = self._get_highlighted_file(filename, module_globals)
+            if highlighted is not None and lineno > 0:
+                part = highlighted[lineno - 1:lineno - 1 + len(lines)]
+                if len(part) == len(lines) and all(
+                    RE_COLOR_ESCAPES.sub("", hl_line) == line
+                    for hl_line, line in zip(part, lines)
+                ):
+                    return part
+        return self.format_source("\n".join(lines)).splitlines()
+
+    def _highlight_stack_entry_source(self, source, frame, lineno):
+        """Highlight the (stripped) source line of a stack entry."""
+        import linecache
 
-    @lru_cache(maxsize=64)
-    def _highlight_cached(self, src):
-        src = self.try_to_decode(src)
-        return self._highlight(src)
+        filename = frame.f_code.co_filename
+        lines = linecache.getlines(filename, frame.f_globals)
+        highlighted = None
+        if 0 < lineno <= len(lines):
+            highlighted = self._get_highlighted_window(
+                filename, lines, lineno, lineno)
+        if highlighted is not None:
+            line = RE_LEADING_WHITESPACE.sub("", highlighted[0])
+            line = line.rstrip()
+            if RE_COLOR_ESCAPES.sub("", line) == source:
+                return line
+        return self.format_source(source).rstrip()
 
     def _format_line(self, lineno, marker, line, lineno_width):
         lineno = ('%%%dd' % lineno_width) % lineno
@@ -1016,6 +3101,8 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
         self._do_inspect(arg, with_source=True)
 
     def _do_inspect(self, arg, with_source=False):
+        import inspect
+
         try:
             obj = self._getval(arg)
         except Exception:
@@ -1075,12 +3162,13 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
 
         if with_source:
             self.stdout.write("%-28s" % Color.set(Color.red, "Source:"))
-            _, lineno, lines = self._get_position_of_obj(obj, quiet=True)
+            filename, lineno, lines = self._get_position_of_obj(obj, quiet=True)
             if lines is None:
                 self.stdout.write(" -\n")
             else:
                 self.stdout.write("\n")
-                self._print_lines_pdbpp(lines, lineno, print_markers=False)
+                self._print_lines_pdbpp(lines, lineno, print_markers=False,
+                                        filename=filename)
 
     def default(self, line):
         """Patched version to fix namespace with list comprehensions.
@@ -1100,7 +3188,7 @@ class Pdb(pdb.Pdb, ConfigurableClass, object):
             save_displayhook = sys.displayhook
             try:
                 sys.stdin = self.stdin
-                sys.stdout = self.stdout
+                sys.stdout = self._flush_output_buffer()
                 sys.displayhook = self.displayhook
                 exec(code, ns, locals)
             finally:
@@ -1185,6 +3273,8 @@ except for when using the function decorator.
     do_ll = do_longlist
 
     def _printlonglist(self, linerange=None, max_lines=None):
+        import inspect
+
         try:
             if self.curframe.f_code.co_name == '<module>':
                 # inspect.getsourcelines is buggy in this case: if we just
@@ -1209,7 +3299,9 @@ except for when using the function decorator.
             end = min(end, lineno+len(lines))
             lines = lines[start-lineno:end-lineno]
             lineno = start
-        self._print_lines_pdbpp(lines, lineno, max_lines=max_lines)
+        self._print_lines_pdbpp(lines, lineno, max_lines=max_lines,
+                                filename=self.curframe.f_code.co_filename,
+                                module_globals=self.curframe.f_globals)
 
     @staticmethod
     def _truncate_to_visible_length(s, maxlength):
@@ -1315,15 +3407,15 @@ except for when using the function decorator.
                 break
             yield lineno + i, line
 
-    def _print_lines_pdbpp(self, lines, lineno, print_markers=True, max_lines=None):
+    def _print_lines_pdbpp(self, lines, lineno, print_markers=True, max_lines=None,
+                           filename=None, module_globals=None):
         lines = [line[:-1] for line in lines]  # remove the trailing '\n'
-        lines = [line.replace('\t', '    ')
-                 for line in lines]  # force tabs to 4 spaces
-        width, height = self.get_terminal_size()
+        width, height = self.terminal_size
 
         if self.config.use_pygments is not False:
-            src = self.format_source('\n'.join(lines))
-            lines = src.splitlines()
+            lines = self._highlight_lines(lines, lineno, filename, module_globals)
+        lines = [line.replace('\t', '    ')
+                 for line in lines]  # force tabs to 4 spaces
 
         if self.config.truncate_long_lines:
             maxlength = max(width - 9, 16)
@@ -1360,78 +3452,106 @@ except for when using the function decorator.
                 lineno += 1
         print('\n'.join(new_lines), file=self.stdout)
 
-    def _format_color_prefixes(self, lines):
-        if not lines:
-            return lines
-
-        if self.config.use_pygments is False and not self.config.highlight:
-            return lines
-
-        # Format source without prefixes added by pdb, including line numbers.
-        prefixes = []
-        src_lines = []
-
-        for x in lines:
-            prefix, _, src = x.partition('\t')
-            prefixes.append(prefix)
-            src_lines.append(src)
-
-        RE_LNUM_PREFIX = re.compile(r"^\d+")
-        if self.config.highlight:
-            prefixes = [
-                RE_LNUM_PREFIX.sub(
-                    lambda m: Color.set(self.config.line_number_color, m.group(0)),
-                    prefix
-                )
-                for prefix in prefixes
-            ]
-
-        return [
-            "%s\t%s" % (prefix, src)
-            for (prefix, src) in zip(prefixes, src_lines)
-        ]
-
-    @contextlib.contextmanager
-    def _patch_linecache_for_source_highlight(self):
-        orig = pdb.linecache.getlines
-
-        def wrapped_getlines(filename, globals):
-            """Wrap linecache.getlines to highlight source (for do_list)."""
-            lines = orig(filename, globals)
-            source = self.format_source("".join(lines))
-
-            if sys.version_info < (3,):
-                source = self.try_to_encode(source)
-
-            return source.splitlines(True)
-
-        pdb.linecache.getlines = wrapped_getlines
+    def _get_highlighted_window(self, filename, lines, first, last):
+        """Return the highlighted lines first to last (1-based) of a file.
 
+        Returns None without highlighting, or if they do not match."""
+        highlight, key = self._get_cache_highlight()
+        if highlight is None:
+            return None
         try:
-            yield
-        finally:
-            pdb.linecache.getlines = orig
+            highlighted = _highlight_cache.get_window(
+                filename, lines, first, last, highlight, key,
+                disk=self._get_highlight_disk_cache())
+        except HighlightUnavailable:
+            return None
+        if len(highlighted) != len(lines[first - 1:last]):
+            return None
+        if sys.version_info < (3,):
+            highlighted = [self.try_to_encode(x) for x in highlighted]
+        return highlighted
 
     def do_list(self, arg):
-        """Enhance original do_list with highlighting."""
+        """Enhance original do_list with highlighting.
+
+        Only the listed lines get highlighted (unless the whole file is
+        highlighted already), and line numbers get colored."""
         if not (self.config.use_pygments is not False or self.config.highlight):
             return super(Pdb, self).do_list(arg)
 
-        with self._patch_linecache_for_source_highlight():
-
-            oldstdout = self.stdout
-            self.stdout = StringIO()
-            ret = super(Pdb, self).do_list(arg)
-            orig_pdb_lines = self.stdout.getvalue().splitlines()
-            self.stdout = oldstdout
+        import linecache
 
-        for line in self._format_color_prefixes(orig_pdb_lines):
-            print(line, file=self.stdout)
-        return ret
+        self.lastcmd = 'list'
+        last = None
+        if arg and arg != '.':
+            try:
+                if ',' in arg:
+                    first, last = arg.split(',')
+                    first = int(first.strip())
+                    last = int(last.strip())
+                    if last < first:
+                        # assume it's a count
+                        last = first + last
+                else:
+                    first = int(arg.strip())
+                    first = max(1, first - 5)
+            except ValueError:
+                self.error('Error in argument: %r' % arg)
+                return
+        elif self.lineno is None or arg == '.':
+            first = max(1, self.curframe.f_lineno - 5)
+        else:
+            first = self.lineno + 1
+        if last is None:
+            last = first + 10
+        filename = self.curframe.f_code.co_filename
+        # Like pdb (gh-93696): frozen stdlib modules provide a useful __file__.
+        if filename.startswith("<frozen"):
+            tmp = self.curframe.f_globals.get("__file__")
+            if isinstance(tmp, str):
+                filename = tmp
+        breaklist = self.get_file_breaks(filename)
+        try:
+            lines = linecache.getlines(filename, self.curframe.f_globals)
+            window = lines[first - 1:last]
+            if window and self.config.use_pygments is not False:
+                highlighted = self._get_highlighted_window(
+                    filename, lines, first, last)
+                if highlighted is not None:
+                    window = highlighted
+            self._print_list_lines(window, first, breaklist, self.curframe)
+            self.lineno = min(last, len(lines))
+            if len(lines) < last:
+                self.message('[EOF]')
+        except KeyboardInterrupt:
+            pass
 
     do_list.__doc__ = pdb.Pdb.do_list.__doc__
     do_l = do_list
 
+    def _print_list_lines(self, lines, start, breaks=(), frame=None):
+        """Print lines like pdb.Pdb._print_lines, with colored line numbers."""
+        if frame:
+            current_lineno = frame.f_lineno
+            exc_lineno = self.tb_lineno.get(frame, -1)
+        else:
+            current_lineno = exc_lineno = -1
+        for lineno, line in enumerate(lines, start):
+            s = str(lineno).rjust(3)
+            if self.config.highlight:
+                s = Color.set(self.config.line_number_color, s)
+            if lineno < 1000:
+                s += ' '
+            if lineno in breaks:
+                s += 'B'
+            else:
+                s += ' '
+            if lineno == current_lineno:
+                s += '->'
+            elif lineno == exc_lineno:
+                s += '>>'
+            self.message(s + '\t' + line.rstrip())
+
     def _select_frame(self, number):
         """Same as pdb.Pdb, but uses print_current_stack_entry (for sticky)."""
         assert 0 <= number < len(self.stack), (number, len(self.stack))
@@ -1451,41 +3571,72 @@ except for when using the function decorator.
     do_continue.__doc__ = pdb.Pdb.do_continue.__doc__
     do_c = do_cont = do_continue
 
+    def _get_budgeted_repr(self, max_chars=None):
+        """Return a BudgetedRepr, with max_chars lowering repr_max_chars."""
+        if max_chars is None or (self.config.repr_max_chars is not None
+                                 and self.config.repr_max_chars < max_chars):
+            max_chars = self.config.repr_max_chars
+        return BudgetedRepr(
+            max_chars=max_chars,
+            max_depth=self.config.repr_max_depth,
+            max_items=self.config.repr_max_items,
+            max_seconds=self.config.repr_max_seconds,
+        )
+
+    def _budgeted_repr(self, obj, max_chars=None):
+        return self._get_budgeted_repr(max_chars).repr(obj)
+
     def do_p(self, arg):
-        """p expression
-        Print the value of the expression.
+        """p[!] expression
+        Print the value of the expression.  The repr gets truncated
+        according to the repr_max_* options, unless "p!" is used.
         """
+        full = arg.startswith("!")
+        if full:
+            arg = arg[1:]
         try:
             val = self._getval(arg)
         except:
             return
         try:
-            self.message(repr(val))
+            self.message(repr(val) if full else self._budgeted_repr(val))
         except:
             exc_info = sys.exc_info()[:2]
             self.error(traceback.format_exception_only(*exc_info)[-1].strip())
 
     def do_pp(self, arg):
-        """[width]pp expression
-        Pretty-print the value of the expression.
+        """[width]pp[!] expression
+        Pretty-print the value of the expression.  The value gets truncated
+        according to the repr_max_* options, unless "pp!" is used.
         """
         width = getattr(arg, "cmd_count", None)
+        full = arg.startswith("!")
+        if full:
+            arg = arg[1:]
         try:
             val = self._getval(arg)
         except:
             return
         if width is None:
             try:
-                width, _ = self.get_terminal_size()
+                width, _ = self.terminal_size
             except Exception as exc:
                 self.message("warning: could not get terminal size ({})".format(exc))
                 width = None
         try:
-            pprint.pprint(val, self.stdout, width=width)
+            if full:
+                import pprint
+
+                pprint.pprint(val, self.stdout, width=width)
+            else:
+                for chunk in self._get_budgeted_repr().iter_pformat(
+                    val, width=80 if width is None else width
+                ):
+                    self.stdout.write(chunk)
+                self.stdout.write("\n")
         except:
             exc_info = sys.exc_info()[:2]
             self.error(traceback.format_exception_only(*exc_info)[-1].strip())
-    do_pp.__doc__ = pdb.Pdb.do_pp.__doc__
 
     def do_debug(self, arg):
         """debug code
@@ -1493,6 +3644,8 @@ except for when using the function decorator.
         argument (which is an arbitrary expression or statement to be
         executed in the current environment).
         """
+        # The recursive debugger uses the stream itself.
+        self._end_output_buffer()
         orig_trace = sys.gettrace()
         if orig_trace:
             sys.settrace(None)
@@ -1539,8 +3692,11 @@ except for when using the function decorator.
         Start an interactive interpreter whose global namespace
         contains all the names found in the current scope.
         """
+        self._end_output_buffer()
         ns = self.curframe.f_globals.copy()
         ns.update(self.curframe_locals)
+        import code
+
         code.interact("*interactive*", local=ns)
 
     def do_track(self, arg):
@@ -1567,13 +3723,31 @@ except for when using the function decorator.
     def _get_display_list(self):
         return self.display_list.setdefault(self.curframe, {})
 
+    def _getval(self, arg):
+        try:
+            code = compile_expr(arg)
+        except SyntaxError:
+            code = arg  # Reported by pdb.
+        self._flush_output_buffer()
+        return super(Pdb, self)._getval(code)
+
     def _getval_or_undefined(self, arg):
+        self._flush_output_buffer()
         try:
-            return eval(arg, self.curframe.f_globals,
+            return eval(compile_expr(arg), self.curframe.f_globals,
                         self.curframe_locals)
         except NameError:
             return undefined
 
+    def _check_expr(self, expr, what):
+        """Report a syntax error with an expression, returns False then."""
+        try:
+            compile_expr(expr)
+        except SyntaxError as exc:
+            self.error("Invalid %s %s: %s" % (what, expr, exc))
+            return False
+        return True
+
     def do_display(self, arg):
         """
         display expression
@@ -1586,6 +3760,8 @@ except for when using the function decorator.
         attention not to put expressions with side-effects in the
         display list.
         """
+        if not self._check_expr(arg, "expression"):
+            return
         try:
             value = self._getval_or_undefined(arg)
         except:
@@ -1603,82 +3779,223 @@ except for when using the function decorator.
         except KeyError:
             print('** %s not in the display list **' % arg, file=self.stdout)
 
+    def _parse_watch_attr(self, arg):
+        """Return (expression, attrname) for "expression.attrname", or None."""
+        import ast
+
+        match = re.match(r"(.+)\.\s*([A-Za-z_]\w*)$", arg)
+        if match is None:
+            return None
+        try:
+            if not isinstance(ast.parse(arg, mode="eval").body, ast.Attribute):
+                return None
+        except SyntaxError:
+            return None
+        return match.group(1), match.group(2)
+
+    def do_watch(self, arg):
+        """watch [-c] [expression] | watch -a obj.attr
+        Stop when the value of the expression changes.  It is evaluated in
+        the current frame, but only checked for lines executed there (and
+        in frames called from it with "-c"), until the frame returns.
+
+        With "-a", stop when the attribute gets set on the object instead
+        (i.e. this instance only, from anywhere).  This watchpoint gets
+        removed with the object, or "unwatch obj.attr".
+
+        Without argument, list the watchpoints."""
+        arg = arg.strip()
+        if not arg:
+            self._list_watchpoints()
+            return
+        option = arg.split(None, 1)[0]
+        if option == "-a":
+            self._watch_attr(arg[2:].strip())
+            return
+        callees = option == "-c"
+        if callees:
+            arg = arg[2:].strip()
+            if not arg:
+                self.error("Usage: watch [-c] [expression]")
+                return
+
+        if not self._check_expr(arg, "expression"):
+            return
+        try:
+            value = self._getval_or_undefined(arg)
+        except Exception:
+            exc_info = sys.exc_info()[:2]
+            self.error(traceback.format_exception_only(*exc_info)[-1].strip())
+            return
+        self._watch_number += 1
+        watchpoint = ExprWatchpoint(
+            self._watch_number, arg, self.curframe, callees, value)
+        self._expr_watchpoints.append(watchpoint)
+        self._watch_callees = self._watch_callees or callees
+        self.message("Watchpoint %d: %s = %r" % (watchpoint.number, arg, value))
+
+    def _watch_attr(self, arg):
+        parsed = self._parse_watch_attr(arg)
+        if parsed is None:
+            self.error("Usage: watch -a obj.attr")
+            return
+        try:
+            obj = self._getval(parsed[0])
+        except Exception:
+            return  # Reported by _getval.
+        try:
+            watch_attr(obj, parsed[1], Pdb=self.__class__)
+        except TypeError:
+            self.error("Cannot watch attributes of %s objects" % (
+                type(obj).__name__))
+            return
+        self.message("Watching %s" % arg)
+
+    def _list_watchpoints(self):
+        for watchpoint in self._expr_watchpoints:
+            self.message("Watchpoint %d: %s = %r in %s()%s" % (
+                watchpoint.number, watchpoint.expr, watchpoint.value,
+                watchpoint.frame.f_code.co_name,
+                " and callees" if watchpoint.callees else ""))
+        watched = [
+            ("%s.%s" % (cls.__name__, attrname), ref())
+            for (cls, attrname), descriptor in _attr_watchpoints.items()
+            for ref, _ in list(descriptor.instances.values())
+        ]
+        if not watched and not self._expr_watchpoints:
+            self.message("No watchpoints.")
+        for where, obj in sorted(watched, key=lambda x: x[0]):
+            if obj is not None:
+                self.message("%s at 0x%x" % (where, id(obj)))
+
+    def do_unwatch(self, arg):
+        """unwatch number|obj.attr
+        Remove a watchpoint set with "watch" or "watch -a"."""
+        arg = arg.strip()
+        if arg.isdigit():
+            for watchpoint in self._expr_watchpoints:
+                if watchpoint.number == int(arg):
+                    self._remove_expr_watchpoint(watchpoint)
+                    return
+            self.error("No watchpoint number %s" % arg)
+            return
+        parsed = self._parse_watch_attr(arg)
+        if parsed is None:
+            self.error("Usage: unwatch number|obj.attr")
+            return
+        try:
+            obj = self._getval(parsed[0])
+        except Exception:
+            return  # Reported by _getval.
+        if not unwatch_attr(obj, parsed[1]):
+            self.error("%s is not watched" % arg)
+
     def _print_if_sticky(self):
-        if self.sticky and not self.commands_defining:
+        if not self.sticky or self.commands_defining:
+            return
+        if not self._use_sticky_screen():
             self._sticky_handle_cls()
-            width, height = self.get_terminal_size()
+            self._print_sticky()
+            return
 
-            frame, lineno = self.stack[self.curindex]
-            stack_entry = self._get_formatted_stack_entry(
-                self.stack[self.curindex], "__CUTOFF_MARKER__"
-            )
-            s = stack_entry.split("__CUTOFF_MARKER__")[0]  # hack
-            top_lines = []
-            if self._sticky_messages:
-                for msg in self._sticky_messages:
-                    if msg == "--Return--" and (
-                        "__return__" in frame.f_locals
-                        or "__exception__" in frame.f_locals
-                    ):
-                        # Handled below.
-                        continue
-                    if msg.startswith("--") and msg.endswith("--"):
-                        s += ", {}".format(msg)
-                    else:
-                        top_lines.append(msg)
-                self._sticky_messages = []
-
-            if self.config.show_hidden_frames_count:
-                n = len(self._hidden_frames)
-                if n:
-                    plural = n > 1 and "s" or ""
-                    s += ", %d frame%s hidden" % (n, plural)
-            top_lines.append(s)
-
-            sticky_range = self.sticky_ranges.get(self.curframe, None)
-
-            after_lines = []
-            if '__exception__' in frame.f_locals:
-                s = self._format_exc_for_sticky(frame.f_locals['__exception__'])
-                if s:
-                    after_lines.append(s)
-
-            elif getattr(sys, "last_value", None):
-                s = self._format_exc_for_sticky((type(sys.last_value), sys.last_value))
-                if s:
-                    after_lines.append(s)
-
-            elif '__return__' in frame.f_locals:
-                rv = frame.f_locals['__return__']
-                try:
-                    s = repr(rv)
-                except KeyboardInterrupt:
-                    raise
-                except:
-                    s = '(unprintable return value)'
-
-                s = ' return ' + s
-                if self.config.highlight:
-                    s = Color.set(self.config.line_number_color, s)
+        # Render into the StickyScreen, which writes changed rows only.
+        clear = not self._sticky_skip_cls
+        self._sticky_skip_cls = False
+        for stream in (sys.stdout, sys.stderr, self.stdout):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        width, height = self.terminal_size
+        stdout = self.stdout
+        self.stdout = StringIO()
+        try:
+            self._print_sticky()
+            lines = self.stdout.getvalue().split("\n")[:-1]
+        finally:
+            self.stdout = stdout
+        key = (self.curframe, self.sticky_ranges.get(self.curframe),
+               width, height)
+        self.stdout.write(
+            self._sticky_screen.render(lines, key, width, clear=clear))
+        self.stdout.flush()
+
+    def _print_sticky(self):
+        width, height = self.terminal_size
+
+        frame, lineno = self.stack[self.curindex]
+        stack_entry = self._get_formatted_stack_entry(
+            self.stack[self.curindex], "__CUTOFF_MARKER__"
+        )
+        s = stack_entry.split("__CUTOFF_MARKER__")[0]  # hack
+        top_lines = []
+        if self._sticky_messages:
+            for msg in self._sticky_messages:
+                if msg == "--Return--" and (
+                    "__return__" in frame.f_locals
+                    or "__exception__" in frame.f_locals
+                ):
+                    # Handled below.
+                    continue
+                if msg.startswith("--") and msg.endswith("--"):
+                    s += ", {}".format(msg)
+                else:
+                    top_lines.append(msg)
+            self._sticky_messages = []
+
+        if self.config.show_hidden_frames_count:
+            n = len(self._hidden_frames)
+            if n:
+                plural = n > 1 and "s" or ""
+                s += ", %d frame%s hidden" % (n, plural)
+        top_lines.append(s)
+
+        sticky_range = self.sticky_ranges.get(self.curframe, None)
+
+        after_lines = []
+        if '__exception__' in frame.f_locals:
+            s = self._format_exc_for_sticky(frame.f_locals['__exception__'])
+            if s:
+                after_lines.append(s)
+
+        elif getattr(sys, "last_value", None):
+            s = self._format_exc_for_sticky((type(sys.last_value), sys.last_value))
+            if s:
                 after_lines.append(s)
 
-            top_extra_lines = 0
-            for line in top_lines:
-                print(line, file=self.stdout)
-                len_visible = len(RE_COLOR_ESCAPES.sub("", line))
-                top_extra_lines += (len_visible - 1) // width + 2
-            print(file=self.stdout)
+        elif '__return__' in frame.f_locals:
+            rv = frame.f_locals['__return__']
+            try:
+                # Fit on a line (with "..."), for max_lines below.
+                s = self._budgeted_repr(
+                    rv, max_chars=max(width - len(" return ..."), 1))
+            except KeyboardInterrupt:
+                raise
+            except:
+                s = '(unprintable return value)'
 
-            # Arrange for prompt and extra lines on top (location + newline
-            # typically), and keep an empty line at the end (after prompt), so
-            # that any output shows up at the top.
-            max_lines = height - top_extra_lines - len(after_lines) - 2
+            s = ' return ' + s
+            if self.config.highlight:
+                s = Color.set(self.config.line_number_color, s)
+            after_lines.append(s)
 
-            self._printlonglist(sticky_range, max_lines=max_lines)
+        top_extra_lines = 0
+        for line in top_lines:
+            print(line, file=self.stdout)
+            len_visible = len(RE_COLOR_ESCAPES.sub("", line))
+            top_extra_lines += (len_visible - 1) // width + 2
+        print(file=self.stdout)
 
-            for line in after_lines:
-                print(line, file=self.stdout)
-            self._sticky_need_cls = True
+        # Arrange for prompt and extra lines on top (location + newline
+        # typically), and keep an empty line at the end (after prompt), so
+        # that any output shows up at the top.
+        max_lines = height - top_extra_lines - len(after_lines) - 2
+
+        self._printlonglist(sticky_range, max_lines=max_lines)
+
+        for line in after_lines:
+            print(line, file=self.stdout)
+        self._sticky_need_cls = True
 
     def _format_exc_for_sticky(self, exc):
         if len(exc) != 2:
@@ -1704,7 +4021,7 @@ except for when using the function decorator.
         else:
             # Use first line only, limited to terminal width.
             s = s.replace("\r", r"\r").replace("\n", r"\n")
-            width, _ = self.get_terminal_size()
+            width, _ = self.terminal_size
             if len(s) > width:
                 s = s[:width - 1] + "…"
 
@@ -1794,7 +4111,10 @@ except for when using the function decorator.
             self.print_stack_entry(self.stack[self.curindex])
 
     def preloop(self):
+        self._begin_output_buffer()
         self._print_if_sticky()
+        if self._expr_watchpoints:
+            self._refresh_expr_watchpoints()
 
         display_list = self._get_display_list()
         for expr, oldvalue in display_list.items():
@@ -1804,12 +4124,60 @@ except for when using the function decorator.
             # whose fields are changed to be displayed
             if newvalue is not oldvalue or newvalue != oldvalue:
                 display_list[expr] = newvalue
-                print('%s: %r --> %r' % (expr, oldvalue, newvalue),
-                      file=self.stdout)
+                print('%s: %s --> %s' % (
+                    expr,
+                    self._budgeted_repr(oldvalue),
+                    self._budgeted_repr(newvalue),
+                ), file=self.stdout)
+                self._sticky_screen.invalidate()
+        self._end_output_buffer()
+        self._start_highlight_worker()
+
+    def precmd(self, line):
+        self._highlight_worker.cancel()
+        if self._sigwinch_handler is None:
+            # The terminal might have been resized at the prompt.
+            self._terminal_size = None
+        self._begin_output_buffer()
+        return super(Pdb, self).precmd(line)
+
+    def _start_highlight_worker(self):
+        """Highlight the files of the stack while waiting for input.
+
+        Nearest frames come first.  This is only done when reading input
+        from a terminal (via input(), i.e. readline or pyrepl)."""
+        if not self.config.highlight_in_background or not self.use_rawinput:
+            return
+        try:
+            if not self.stdin.isatty():
+                return
+        except Exception:
+            return
+        highlight, key = self._get_cache_highlight(setup=False)
+        if highlight is None:
+            return
+
+        import linecache
+
+        files = []
+        seen = set()
+        for i in sorted(range(len(self.stack)),
+                        key=lambda i: abs(i - self.curindex)):
+            frame = self.stack[i][0]
+            filename = frame.f_code.co_filename
+            if filename in seen:
+                continue
+            seen.add(filename)
+            lines = linecache.getlines(filename, frame.f_globals)
+            if lines:
+                files.append((filename, lines))
+        self._highlight_worker.start(
+            files, highlight, key, disk=self._get_highlight_disk_cache())
 
     def _get_position_of_arg(self, arg, quiet=False):
         try:
-            obj = eval(arg, self.curframe.f_globals, self.curframe_locals)
+            obj = eval(compile_expr(arg), self.curframe.f_globals,
+                       self.curframe_locals)
         except:
             if not quiet:
                 exc_info = sys.exc_info()[:2]
@@ -1843,6 +4211,8 @@ except for when using the function decorator.
         return filename, lineno
 
     def _get_position_of_obj(self, obj, quiet=False):
+        import inspect
+
         if hasattr(inspect, "unwrap"):
             obj = inspect.unwrap(obj)
         if isinstance(obj, str):
@@ -1857,10 +4227,11 @@ except for when using the function decorator.
         return filename, lineno, lines
 
     def do_source(self, arg):
-        _, lineno, lines = self._get_position_of_arg(arg)
+        filename, lineno, lines = self._get_position_of_arg(arg)
         if lineno is None:
             return
-        self._print_lines_pdbpp(lines, lineno, print_markers=False)
+        self._print_lines_pdbpp(lines, lineno, print_markers=False,
+                                filename=filename)
 
     def do_frame(self, arg):
         """f(rame) [index]
@@ -1946,6 +4317,53 @@ except for when using the function decorator.
         self._select_frame(len(self.stack) - 1)
     do_bottom = do_bottom
 
+    @property
+    def terminal_size(self):
+        """The size of the terminal, as (width, height).
+
+        It is cached during an interaction, and invalidated when the terminal
+        gets resized (SIGWINCH), or at the prompt if the signal handler cannot
+        be used (e.g. when not in the main thread, or with readline, which
+        handles SIGWINCH itself)."""
+        if self._terminal_size is None:
+            self._terminal_size = tuple(self.get_terminal_size())
+        return self._terminal_size
+
+    def _install_sigwinch_handler(self):
+        self._terminal_size = None
+        if self._sigwinch_handler is not None or not hasattr(signal, "SIGWINCH"):
+            return
+        previous = signal.getsignal(signal.SIGWINCH)
+        if not callable(previous) and (
+            previous not in (signal.SIG_DFL, signal.SIG_IGN)
+            # readline installs its handler from C, which getsignal does not
+            # know about (SIG_DFL), and which could not be restored.
+            or "readline" in sys.modules
+        ):
+            # The size gets queried once per prompt then.
+            return
+
+        def handler(signum, frame):
+            self._terminal_size = None
+            if callable(previous):
+                previous(signum, frame)
+
+        try:
+            signal.signal(signal.SIGWINCH, handler)
+        except ValueError:  # ValueError: signal only works in main thread
+            return
+        # Do not interrupt reading input (Python 2).
+        signal.siginterrupt(signal.SIGWINCH, False)
+        self._sigwinch_handler = (handler, previous)
+
+    def _uninstall_sigwinch_handler(self):
+        if self._sigwinch_handler is None:
+            return
+        handler, previous = self._sigwinch_handler
+        self._sigwinch_handler = None
+        if signal.getsignal(signal.SIGWINCH) is handler:
+            signal.signal(signal.SIGWINCH, previous)
+
     @staticmethod
     def get_terminal_size():
         fallback = (80, 24)
@@ -1972,6 +4390,8 @@ except for when using the function decorator.
 
     def _open_editor(self, editcmd):
         """Extra method to allow for easy override in tests."""
+        import subprocess
+
         subprocess.Popen(editcmd, shell=True).communicate()
 
     def _get_current_position(self):
@@ -2035,6 +4455,7 @@ except for when using the function decorator.
             filename = match.group(1)
             lineno = int(match.group(2))
 
+        self._end_output_buffer()
         try:
             self._open_editor(self._get_editor_cmd(filename, lineno))
         except Exception as exc:
@@ -2054,6 +4475,8 @@ except for when using the function decorator.
         return '\n'.join(history) + '\n'
 
     def _open_stdin_paste(self, stdin_paste, lineno, filename, text):
+        import subprocess
+
         proc = subprocess.Popen([stdin_paste, '+%d' % lineno, filename],
                                 stdin=subprocess.PIPE)
         proc.stdin.write(text)
@@ -2121,16 +4544,88 @@ except for when using the function decorator.
         self.start_filename = frame.f_code.co_filename
         self.start_lineno = frame.f_lineno
 
+        # Restored with "continue" (but not another/this debugger's).
+        self._previous_trace = sys.gettrace()
+        if isinstance(getattr(self._previous_trace, "__self__", None), bdb.Bdb):
+            self._previous_trace = None
+
+        tracer = self._get_monitoring_tracer()
+        if tracer is not None and tracer.acquire():
+            # Same as Bdb.set_trace, but using the tracer.
+            self.reset()
+            self.botframe = frame
+            while self.botframe.f_back:
+                self.botframe = self.botframe.f_back
+            self.set_step()
+            tracer.start(frame)
+            return
+
         return super(Pdb, self).set_trace(frame)
 
     def is_skipped_module(self, module_name):
-        """Backport for https://bugs.python.org/issue36130.
+        """Return True if module_name matches any of the skip patterns.
 
-        Fixed in Python 3.8+.
+        This overrides Bdb.is_skipped_module, which uses fnmatch with every
+        pattern: the patterns are compiled into a single regular expression,
+        and the result is cached per module name.  SKIP_STDLIB and
+        SKIP_SITE_PACKAGES are special patterns matching modules from the
+        standard library / site-packages (by their files).
+
+        It also handles module_name being None (bpo-36130, fixed in Python
+        3.8+).
         """
-        if module_name is None:
+        skip = self.skip
+        if module_name is None or not skip:
+            return False
+        # Compared by value, since skip might get changed in place.
+        key = tuple(skip)
+        matcher = self._skip_matcher
+        if matcher is None or matcher[0] != key:
+            matcher = self._skip_matcher = (
+                key, self._compile_skip_patterns(skip), {})
+        memo = matcher[2]
+        try:
+            return memo[module_name]
+        except KeyError:
+            pass
+        match = matcher[1]
+        skipped = bool(match and match(os.path.normcase(module_name)))
+        if not skipped and (SKIP_STDLIB in skip or SKIP_SITE_PACKAGES in skip):
+            skipped = self._is_lib_module(module_name, skip)
+            if skipped is None:
+                return False  # Not imported (yet), not cached.
+        memo[module_name] = skipped
+        return skipped
+
+    @staticmethod
+    def _compile_skip_patterns(skip):
+        import fnmatch
+
+        patterns = [
+            fnmatch.translate(os.path.normcase(pattern))
+            for pattern in skip
+            if pattern not in (SKIP_STDLIB, SKIP_SITE_PACKAGES)
+        ]
+        if not patterns:
+            return None
+        return re.compile("|".join("(?:%s)" % x for x in patterns)).match
+
+    @staticmethod
+    def _is_lib_module(module_name, skip):
+        """Return None for modules that are not imported."""
+        module = sys.modules.get(module_name)
+        if module is None:
+            return None
+        filename = getattr(module, "__file__", None)
+        if not filename:
             return False
-        return super(Pdb, self).is_skipped_module(module_name)
+        filename = os.path.normcase(os.path.realpath(filename))
+        stdlib_dirs, site_packages_dirs = get_python_lib_dirs()
+        if filename.startswith(site_packages_dirs):
+            return SKIP_SITE_PACKAGES in skip
+        if filename.startswith(stdlib_dirs):
+            return SKIP_STDLIB in skip
+        return False
 
     def message(self, msg):
         if self.sticky:
@@ -2305,18 +4800,221 @@ def always(obj, value):
     return True
 
 
+def _break_for_setattr(frame, Pdb):
+    """Stop in frame (where an attribute is set), reusing the global Pdb."""
+    global_pdb = getattr(local, "GLOBAL_PDB", None)
+    if (
+        global_pdb
+        and not global_pdb._in_interaction
+        and os.environ.get("PDBPP_REUSE_GLOBAL_PDB", "1") == "1"
+        and PdbMeta.use_global_pdb_for_class(global_pdb, Pdb)
+    ):
+        pdb_ = global_pdb
+        pdb_._setup_streams(stdout=sys.stdout)
+    else:
+        pdb_ = Pdb()
+    pdb_.set_trace(frame)
+    pdb_.stopframe = frame
+    pdb_.interaction(frame, None)
+
+
+_missing = object()
+
+
+class SetattrBreakpoint(object):
+    """Data descriptor for break_on_setattr/watch_attr, for a single attribute.
+
+    Values are stored in the instance's __dict__, or by the descriptor the
+    attribute had on the class already (e.g. a property or __slots__).
+
+    With ``instances`` (for watch_attr) it only breaks for those, which are
+    looked up by identity (id --> (weakref, condition)), using the condition
+    given for the instance.
+    For classes with a custom ``__setattr__`` (which might bypass the
+    descriptor) it wraps ``__setattr__`` instead, via ``wrap_setattr``.
+    """
+
+    def __init__(self, attrname, condition, Pdb, previous=_missing,
+                 instances=None):
+        self.attrname = attrname
+        self.condition = condition
+        self.Pdb = Pdb
+        self.previous = previous
+        self.instances = instances
+        self._previous_get = getattr(previous, "__get__", None)
+        self._previous_set = getattr(previous, "__set__", None)
+        self._previous_delete = getattr(previous, "__delete__", None)
+        self._setattr_wrapper = None
+        self._previous_setattr = _missing
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            if self.previous is _missing:
+                return self
+        elif self._previous_set is None:
+            try:
+                return obj.__dict__[self.attrname]
+            except KeyError:
+                if self.previous is _missing:
+                    raise AttributeError("'%s' object has no attribute '%s'" % (
+                        type(obj).__name__, self.attrname))
+        if self._previous_get is None:
+            return self.previous
+        return self._previous_get(obj, objtype)
+
+    def _should_break(self, obj, value):
+        if self.instances is None:
+            return self.condition(obj, value)
+        ref, condition = self.instances.get(id(obj), (None, None))
+        return ref is not None and ref() is obj and condition(obj, value)
+
+    @hideframe
+    def __set__(self, obj, value):
+        if self._should_break(obj, value):
+            _break_for_setattr(sys._getframe().f_back, self.Pdb)
+        if self._previous_set is None:
+            obj.__dict__[self.attrname] = value
+        else:
+            self._previous_set(obj, value)
+
+    def __delete__(self, obj):
+        if self._previous_delete is not None:
+            self._previous_delete(obj)
+            return
+        try:
+            del obj.__dict__[self.attrname]
+        except KeyError:
+            raise AttributeError(self.attrname)
+
+    def add_instance(self, obj, cls, condition):
+        """Watch obj, until it gets garbage collected."""
+        key = id(obj)
+
+        def remove(ref):
+            if self.instances.get(key, (None,))[0] is ref:
+                del self.instances[key]
+                if not self.instances:
+                    self.uninstall(cls)
+
+        self.instances[key] = (weakref.ref(obj, remove), condition)
+
+    def remove_instance(self, obj, cls):
+        ref = self.instances.get(id(obj), (None,))[0]
+        if ref is None or ref() is not obj:
+            return False
+        ref.__callback__(ref)
+        return True
+
+    def wrap_setattr(self, cls):
+        """Install on cls by wrapping its (custom) __setattr__."""
+        old___setattr__ = cls.__setattr__
+
+        @hideframe
+        def __setattr__(obj, attr, value):
+            if attr == self.attrname and self._should_break(obj, value):
+                _break_for_setattr(sys._getframe().f_back, self.Pdb)
+            old___setattr__(obj, attr, value)
+
+        self._previous_setattr = cls.__dict__.get("__setattr__", _missing)
+        self._setattr_wrapper = __setattr__
+        cls.__setattr__ = __setattr__
+
+    def uninstall(self, cls):
+        """Restore the previous class attribute."""
+        if self._setattr_wrapper is not None:
+            # Without instances a wrapper that got wrapped again does not
+            # break anymore.
+            if cls.__dict__.get("__setattr__") is self._setattr_wrapper:
+                if self._previous_setattr is _missing:
+                    del cls.__setattr__
+                else:
+                    cls.__setattr__ = self._previous_setattr
+            if _attr_watchpoints.get((cls, self.attrname)) is self:
+                del _attr_watchpoints[cls, self.attrname]
+            return
+        if cls.__dict__.get(self.attrname) is self:
+            if self.previous is _missing:
+                delattr(cls, self.attrname)
+            else:
+                setattr(cls, self.attrname, self.previous)
+            _attr_watchpoints.pop((cls, self.attrname), None)
+
+
+# (class, attrname) --> SetattrBreakpoint with instances.
+_attr_watchpoints = {}
+
+
+def _get_class_attr(cls, attrname):
+    for klass in cls.__mro__:
+        if attrname in klass.__dict__:
+            return klass.__dict__[attrname]
+    return _missing
+
+
+def _compile_condition(condition):
+    if isinstance(condition, str):
+        code = compile_expr(condition)
+
+        def condition(obj, value):
+            return eval(code, {"obj": obj, "value": value})
+
+    return condition
+
+
+def watch_attr(obj, attrname, condition=always, Pdb=Pdb):
+    """Break when the attribute gets set on obj (but not other instances).
+
+    Can be called for several instances (of the same class), which are
+    watched until they get garbage collected, or unwatch_attr is used.
+    ``condition`` is the same as with break_on_setattr, but only called for
+    the instance it was given with (calling it again for the same instance
+    replaces it).  Like there, a custom ``__setattr__`` gets wrapped.
+    """
+    cls = type(obj)
+    weakref.ref(obj)  # Raises TypeError if not supported.
+    descriptor = _attr_watchpoints.get((cls, attrname))
+    if descriptor is None:
+        descriptor = SetattrBreakpoint(
+            attrname, None, Pdb,
+            previous=_get_class_attr(cls, attrname), instances={})
+        if cls.__setattr__ is object.__setattr__:
+            setattr(cls, attrname, descriptor)
+        else:
+            descriptor.wrap_setattr(cls)
+        _attr_watchpoints[(cls, attrname)] = descriptor
+    descriptor.add_instance(obj, cls, _compile_condition(condition))
+
+
+def unwatch_attr(obj, attrname):
+    """Remove a watchpoint from watch_attr, returns False if there is none."""
+    cls = type(obj)
+    descriptor = _attr_watchpoints.get((cls, attrname))
+    return descriptor is not None and descriptor.remove_instance(obj, cls)
+
+
 def break_on_setattr(attrname, condition=always, Pdb=Pdb):
+    """Class decorator to break when the attribute gets set on instances.
+
+    ``condition`` is called with the instance and the value, or can be an
+    expression (using ``obj`` and ``value``).
+
+    A data descriptor is used for the attribute, so that setting other
+    attributes is not affected.  With a custom ``__setattr__`` it gets
+    wrapped instead (to stop where the attribute is set).
+    """
+    condition = _compile_condition(condition)
+
     def decorator(cls):
         old___setattr__ = cls.__setattr__
+        if old___setattr__ is object.__setattr__:
+            setattr(cls, attrname, SetattrBreakpoint(
+                attrname, condition, Pdb, _get_class_attr(cls, attrname)))
+            return cls
 
         @hideframe
         def __setattr__(self, attr, value):
             if attr == attrname and condition(self, value):
-                frame = sys._getframe().f_back
-                pdb_ = Pdb()
-                pdb_.set_trace(frame)
-                pdb_.stopframe = frame
-                pdb_.interaction(frame, None)
+                _break_for_setattr(sys._getframe().f_back, Pdb)
             old___setattr__(self, attr, value)
         cls.__setattr__ = __setattr__
         return cls
@@ -1,3 +1,4 @@
+import bdb
 import functools
 import os
 import sys
@@ -136,6 +137,13 @@ def monkeypatch_pdb_methods(monkeypatch):
         )
 
 
+@pytest.fixture
+def fresh_breakpoints(monkeypatch):
+    """Number breakpoints from 1, without clobbering existing ones."""
+    monkeypatch.setattr(bdb.Breakpoint, "next", 1)
+    monkeypatch.setattr(bdb.Breakpoint, "bpbynumber", [None])
+
+
 @pytest.fixture
 def patched_completions(monkeypatch):
     import fancycompleter
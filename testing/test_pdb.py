@@ -2,15 +2,19 @@
 from __future__ import print_function
 
 import bdb
+import gc
 import inspect
 import io
 import os
 import os.path
+import pprint
 import re
+import signal
 import subprocess
 import sys
 import textwrap
 import traceback
+import types
 from io import BytesIO
 
 import pdbpp
@@ -443,19 +447,28 @@ def test_config_missing_pygments(use_pygments, monkeypatch_importerror):
 
     pdb_ = PdbForMessage(Config=Config)
 
+    # The builtin highlighter gets used instead.
+    if use_pygments is False:
+        expected = "print(42)"
+    else:
+        expected = (
+            "\x1b[96mprint\x1b[39;49;00m(\x1b[94m42\x1b[39;49;00m)"
+        )
+
     with monkeypatch_importerror(('pygments', 'pygments.formatters')):
         with pytest.raises(ImportError):
             pdb_._get_pygments_formatter()
         assert pdb_._get_source_highlight_function() is False
-        assert pdb_.format_source("print(42)") == "print(42)"
+        assert pdb_.format_source("print(42)") == expected
 
     if use_pygments is True:
-        assert pdb_.messages == ['Could not import pygments, disabling.']
+        assert pdb_.messages == [
+            'Could not import pygments, using the builtin highlighter.']
     else:
         assert pdb_.messages == []
 
     # Cover branch for cached _highlight property.
-    assert pdb_.format_source("print(42)") == "print(42)"
+    assert pdb_.format_source("print(42)") == expected
 
 
 def test_config_pygments_deprecated_use_terminal256formatter(monkeypatch):
@@ -478,6 +491,52 @@ def test_config_pygments_deprecated_use_terminal256formatter(monkeypatch):
     )
 
 
+def test_tokenize_source():
+    src = "\n".join([
+        "@dec",
+        "def fn(self, a=1.5):",
+        '    """doc',
+        '    string"""',
+        "    from os import path  # comment",
+        "    return len(a) and not b'x'",
+        "  x = 'unterminated",
+        "y = '''still",
+    ])
+    tokens = list(pdbpp.tokenize_source(src))
+    assert "".join(text for _, text in tokens) == src
+    token_types = dict((text, token_type) for token_type, text in tokens
+                       if text.strip())
+    assert token_types["dec"] == "Name.Decorator"
+    assert token_types["def"] == "Keyword"
+    assert token_types["fn"] == "Name.Function"
+    assert token_types["self"] == "Name.Builtin.Pseudo"
+    assert token_types["1.5"] == "Literal.Number.Float"
+    assert token_types['"""doc\n    string"""'] == "Literal.String.Doc"
+    assert token_types["from"] == "Keyword.Namespace"
+    assert token_types["os"] == "Name.Namespace"
+    assert token_types["path"] == "Name"
+    assert token_types["# comment"] == "Comment.Single"
+    assert token_types["len"] == "Name.Builtin"
+    assert token_types["not"] == "Operator.Word"
+    assert token_types["b"] == "Literal.String.Affix"
+    assert token_types["'x'"] == "Literal.String.Single"
+    # Errors (indentation, unterminated strings) are handled per line.
+    assert token_types["x"] == "Name"
+    assert token_types["'''still"] == "Literal.String"
+
+
+def test_builtin_highlighter_with_pygments_formatter():
+    pytest.importorskip("pygments")
+
+    class Config(ConfigWithPygments):
+        highlighter = "builtin"
+
+    p = Pdb(Config=Config)
+    assert p.format_source("return a\n") == (
+        "\x1b[38;5;28;01mreturn\x1b[39;00m a\n")
+    assert "builtin" in p._get_highlight_function().cache_key
+
+
 def test_runpdb():
     def fn():
         set_trace()
@@ -2072,6 +2131,232 @@ def test_longlist_with_highlight():
 """)  # noqa: E501
 
 
+class UpperHighlight(object):
+    """Highlight function recording its calls."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, src):
+        self.calls.append(src)
+        return src.upper()
+
+
+def record_source_highlights(monkeypatch):
+    """Record calls to the source highlight function, with an empty cache."""
+    calls = []
+    orig_get_func = pdbpp.Pdb._get_source_highlight_function
+
+    def get_func(self):
+        orig_highlight = orig_get_func(self)
+
+        def new_highlight(src):
+            calls.append(src)
+            return orig_highlight(src)
+
+        new_highlight.cache_key = orig_highlight.cache_key
+        return new_highlight
+
+    monkeypatch.setattr(pdbpp.Pdb, "_get_source_highlight_function", get_func)
+    monkeypatch.setattr(pdbpp, "_highlight_cache", pdbpp.HighlightCache())
+    return calls
+
+
+def test_highlight_cache():
+    highlight = UpperHighlight()
+    calls = highlight.calls
+
+    cache = pdbpp.HighlightCache(max_lines=3)
+    lines = ["a\n", "b\n"]
+    assert cache.get("f1", lines, highlight, "key") == ["A", "B"]
+    assert cache.get("f1", lines, highlight, "key") == ["A", "B"]
+    assert calls == ["a\nb\n"]
+
+    # Invalidated by another highlight function or source.
+    assert cache.get("f1", lines, highlight, "other") == ["A", "B"]
+    assert cache.get("f1", ["c\n"], highlight, "other") == ["C"]
+    assert len(calls) == 3
+
+    # Bounded by the total number of lines.
+    assert cache.get("f2", ["x\n", "y\n"], highlight, "other") == ["X", "Y"]
+    assert cache.get("f1", ["c\n"], highlight, "other") == ["C"]
+    assert len(calls) == 4
+    assert cache.get("f3", ["z\n"], highlight, "other") == ["Z"]
+    assert cache.get("f1", ["c\n"], highlight, "other") == ["C"]
+    assert len(calls) == 5
+    assert cache.get("f2", ["x\n", "y\n"], highlight, "other") == ["X", "Y"]
+    assert len(calls) == 6
+
+
+def test_longlist_highlights_file_once(monkeypatch):
+    pytest.importorskip("pygments")
+    calls = record_source_highlights(monkeypatch)
+
+    def fn():
+        a = 1
+        set_trace(Config=ConfigWithPygments)
+        return a
+
+    _, lines = run_func(fn, '# ll\n# ll\n# c')
+    assert "a ^[[38;5;241m=^[[39m ^[[38;5;241m1^[[39m" in "\n".join(lines)
+    # The stack entry gets highlighted on its own, "ll" the whole file.
+    assert calls[0] == "        return a\n"
+    assert len(calls) == 2
+    assert "def test_longlist_highlights_file_once" in calls[1]
+
+
+def test_get_multiline_string_ranges():
+    source = "\n".join([
+        "a = '''1",             # 1
+        "2'''",                 # 2
+        "# '''",                # 3
+        "b = 'x' \"y\"",        # 4
+        "c = \"\"\"\\\"\"\"",   # 5
+        "\"\"\"",               # 6
+        "d = 'e\\",             # 7
+        "f'",                   # 8
+        "g = '",                # 9
+        "h = '''",              # 10
+    ])
+    assert pdbpp.get_multiline_string_ranges(source) == (
+        [1, 5, 7], [2, 6, 8])
+
+
+def test_highlight_cache_get_window():
+    highlight = UpperHighlight()
+    calls = highlight.calls
+
+    cache = pdbpp.HighlightCache()
+    lines = ["a\n", "'''b\n", "c\n", "d'''\n", "e\n", "f\n"]
+    assert cache.get_window("f1", lines, 5, 6, highlight, "key") == ["E", "F"]
+    assert cache.get_window("f1", lines, 3, 5, highlight, "key") == [
+        "C", "D'''", "E"]
+    assert calls == ["e\nf\n", "'''b\nc\nd'''\ne\n"]
+
+    # Taken from the highlighted file.
+    cache.get("f1", lines, highlight, "key")
+    del calls[:]
+    assert cache.get_window("f1", lines, 1, 2, highlight, "key") == [
+        "A", "'''B"]
+    assert calls == []
+
+
+def test_shortlist_highlights_window(monkeypatch):
+    pytest.importorskip("pygments")
+    calls = record_source_highlights(monkeypatch)
+
+    def fn():
+        a = 1
+        set_trace(Config=ConfigWithPygments)
+        return a
+
+    _, lines = run_func(fn, '# l\n# c')
+    assert "a ^[[38;5;241m=^[[39m ^[[38;5;241m1^[[39m" in "\n".join(lines)
+    listed = [x for x in calls if "set_trace(Config=ConfigWithPygments)" in x]
+    assert len(listed) == 1
+    assert len(listed[0].splitlines()) == 11
+
+
+def test_highlight_cache_fill():
+    highlight = UpperHighlight()
+    calls = highlight.calls
+
+    cache = pdbpp.HighlightCache()
+    lines = ["a\n", "'''b\n", "c'''\n", "d\n", "  e\n", "f\n"]
+    assert not cache.fill("f1", lines, highlight, "key", part_size=2,
+                          cancelled=lambda: True)
+    assert calls == []
+    assert cache.fill("f1", lines, highlight, "key", part_size=2)
+    # Parts do not end in strings, nor before indented lines.
+    assert calls == ["a\n'''b\nc'''\n", "d\n  e\n", "f\n"]
+    del calls[:]
+    assert cache.get("f1", lines, highlight, "key") == [
+        "A", "'''B", "C'''", "D", "  E", "F"]
+    assert calls == []
+
+
+def test_highlight_worker(monkeypatch):
+    cache = pdbpp.HighlightCache()
+    monkeypatch.setattr(pdbpp, "_highlight_cache", cache)
+    highlight = UpperHighlight()
+    calls = highlight.calls
+
+    worker = pdbpp.HighlightWorker(delay=0, max_lines=3)
+    files = [("f1", ["a\n", "b\n"]), ("f2", ["c\n", "d\n"]), ("f3", ["e\n"])]
+    worker.start(files, highlight, "key")
+    worker._thread.join()
+    # f2 exceeds max_lines.
+    assert calls == ["a\nb\n", "e\n"]
+    worker.cancel()
+
+    worker = pdbpp.HighlightWorker(delay=60)
+    worker.start([("f4", ["x\n"])], highlight, "key")
+    worker.cancel()
+    assert worker._thread is None
+    assert calls == ["a\nb\n", "e\n"]
+
+
+def test_highlight_disk_cache(tmpdir):
+    disk = pdbpp.HighlightDiskCache(str(tmpdir.join("cache")), max_size=80)
+    name = disk.get_name(["a\n", "b\n"], "key")
+    assert name != disk.get_name(["a\n", "b\n"], "other key")
+    assert disk.get(name) is None
+
+    disk.set(name, ["A", "", "ä"])
+    assert disk.get(name) == ["A", "", "ä"]
+    assert disk.get(name, 2, 3) == ["", "ä"]
+    assert disk.get(name, 3, 10) == ["ä"]
+    assert disk.get(name, 4, 10) == []
+
+    # Corrupt entries get removed.
+    path = os.path.join(disk.path, name)
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data.replace("ä".encode("utf-8"), b"\xff\xfe"))
+    assert disk.get(name, 1, 1) == ["A"]
+    assert disk.get(name) is None
+    assert not os.path.exists(path)
+    disk.set(name, ["A", "", "ä"])
+
+    # The least recently used entries get removed.
+    os.utime(os.path.join(disk.path, name), (0, 0))
+    disk.set("other", ["x" * 50])
+    assert disk.get(name) is None
+    assert disk.get("other") == ["x" * 50]
+
+
+def test_highlight_cache_with_disk_cache(tmpdir, monkeypatch):
+    highlight = UpperHighlight()
+
+    disk = pdbpp.HighlightDiskCache(str(tmpdir))
+    names = []
+    orig_get_name = disk.get_name
+
+    def get_name(lines, highlight_key):
+        names.append(highlight_key)
+        return orig_get_name(lines, highlight_key)
+
+    monkeypatch.setattr(disk, "get_name", get_name)
+    lines = ["a\n", "b\n", "c\n"]
+    assert pdbpp.HighlightCache().get(
+        "f1", lines, highlight, "key", disk=disk) == ["A", "B", "C"]
+    assert len(highlight.calls) == 1
+
+    def unavailable(src):
+        raise pdbpp.HighlightUnavailable()
+
+    cache = pdbpp.HighlightCache()
+    assert cache.get_window(
+        "f1", lines, 2, 3, unavailable, "key", disk=disk) == ["B", "C"]
+    assert cache.fill("f1", lines, unavailable, "key", disk=disk)
+    assert cache.get("f1", lines, unavailable, "key") == ["A", "B", "C"]
+    with pytest.raises(pdbpp.HighlightUnavailable):
+        cache.get("f1", lines, unavailable, "other key", disk=disk)
+    # The source gets hashed once per cache and highlight key.
+    assert names == ["key", "key", "other key"]
+
+
 def test_display():
     def fn():
         a = 1
@@ -2124,6 +2409,26 @@ b: <undefined> --> 42
 """)
 
 
+def test_display_invalid():
+    def fn():
+        set_trace()
+        b = 42
+        return b
+
+    check(fn, """
+[NUM] > .*fn()
+-> b = 42
+   5 frames hidden .*
+# display b =
+\\*\\*\\* Invalid expression b =: .*
+# n
+[NUM] > .*fn()
+-> return b
+   5 frames hidden .*
+# c
+""")
+
+
 def test_sticky():
     def fn():
         set_trace()
@@ -2485,6 +2790,40 @@ NUM  ->             return 40 \\+ 2
     ))
 
 
+def test_sticky_dunder_return_fits_line():
+    def fn():
+        def returns():
+            return [0] * 10**6
+
+        set_trace()
+        returns()
+
+    check(fn, """
+[NUM] > .*fn()
+-> returns()
+   5 frames hidden (try 'help hidden_frames')
+# s
+--Call--
+[NUM] > .*returns()
+-> def returns()
+   5 frames hidden .*
+# sticky
+<CLEARSCREEN>
+[NUM] > .*(NUM)returns(), 5 frames hidden
+
+NUM  ->         def returns():
+NUM                 return [0] \\* 10\\*\\*6
+# r
+<CLEARSCREEN><PY27_MSG>
+[NUM] > .*(NUM)returns()->[0, 0, 0, 0, 0, 0, ...], 5 frames hidden
+
+NUM             def returns():
+NUM  ->             return [0] \\* 10\\*\\*6
+ return [0, 0, 0, 0, 0, 0, 0, 0, 0, 0\\.\\.\\.$
+# c
+""", terminal_size=(40, 30))
+
+
 def test_sticky_with_user_exception():
     def fn():
         def throws():
@@ -2870,6 +3209,72 @@ NUM             # 2
 """, terminal_size=(len(__file__) + 50, 3))
 
 
+def test_sticky_redraw_diff(monkeypatch):
+    monkeypatch.setattr(pdbpp.Pdb, "_use_sticky_screen",
+                        lambda self: self.config.sticky_redraw == "diff")
+    monkeypatch.setattr(pdbpp, "get_write_count", lambda: 0)
+
+    class Config(ConfigTest):
+        sticky_redraw = "diff"
+
+    def fn():
+        set_trace(Config=Config)
+        a = 1
+        b = 2
+        return a + b
+
+    lineno = fn.__code__.co_firstlineno
+    output = "\n".join(runpdb(fn, ["sticky", "n", "n", "p a", "n", "c"]))
+    output = re.sub(r"\[\d+\] >", "[N] >", output)
+    header = "[N] > %s(%d)fn(), 5 frames hidden" % (__file__, lineno + 3)
+    assert output.count("<CLEARSCREEN>") == 2
+    # Only rows with changes get rewritten for "next".
+    assert (
+        "# n\n^[[1;1H%s^[[K" % header
+        + "^[[5;1H%d             a = 1^[[K" % (lineno + 2)
+        + "^[[6;1H%d  ->         b = 2^[[K" % (lineno + 3)
+        + "^[[8;1H^[[J# n\n"
+    ) in output
+    assert "^[[7;1H%d  ->         return a + b^[[K^[[8;1H^[[J# p a\n1\n" % (
+        lineno + 4) in output
+    # Redrawn completely after output from "p a".
+    assert output.endswith("""# n
+<CLEARSCREEN>
+[N] > %s(%d)fn()->3, 5 frames hidden
+
+%d         def fn():
+%d             set_trace(Config=Config)
+%d             a = 1
+%d             b = 2
+%d  ->         return a + b
+ return 3
+# c""" % ((__file__, lineno + 4) + tuple(range(lineno, lineno + 5))))
+
+
+def test_sticky_screen():
+    screen = pdbpp.StickyScreen()
+    assert screen.render(["a", "b"], "key", 10) == pdbpp.CLEARSCREEN + "a\nb\n"
+    screen.end_command([])
+    screen.resume()
+    assert screen.render(["a", "c", "d"], "key", 10) == (
+        "\033[2;1Hc\033[K\033[3;1Hd\033[K\033[4;1H\033[J")
+    screen.end_command([])
+    screen.resume()
+    # Full redraw for another key, and with wrapped lines.
+    assert screen.render(["a"], "other", 10) == pdbpp.CLEARSCREEN + "a\n"
+    screen.resume()
+    assert screen.render(["a" * 11], "other", 10) == (
+        pdbpp.CLEARSCREEN + "a" * 11 + "\n")
+    screen.resume()
+    assert screen.render(["a"], "other", 10, clear=False) == "a\n"
+    screen.resume()
+    assert screen.render(["a"], "other", 10) == pdbpp.CLEARSCREEN + "a\n"
+    # Output from a command.
+    screen.end_command(["message"])
+    screen.resume()
+    assert screen.render(["a"], "other", 10) == pdbpp.CLEARSCREEN + "a\n"
+
+
 def test_exception_lineno():
     def bar():
         assert False
@@ -3611,7 +4016,55 @@ def test_disable_hidden_frames():
 """)
 
 
+def test_is_hidden_uses_locals_only_with_tracebackhide():
+    class Frame(object):
+        f_globals = {}
+        locals_used = 0
+
+        def __init__(self, code, f_locals):
+            self.f_code = code
+            self._f_locals = f_locals
+
+        @property
+        def f_locals(self):
+            self.locals_used += 1
+            return self._f_locals
+
+    def visible():
+        pass
+
+    def hidden():
+        __tracebackhide__ = True  # noqa: F841
+
+    p = PdbTest()
+    frame = Frame(visible.__code__, {"__tracebackhide__": True})
+    assert not p._is_hidden(frame)
+    assert frame.locals_used == 0
+
+    frame = Frame(hidden.__code__, {"__tracebackhide__": True})
+    assert p._is_hidden(frame)
+    assert frame.locals_used == 1
+    frame = Frame(hidden.__code__, {"__tracebackhide__": False})
+    assert not p._is_hidden(frame)
+    assert list(p._code_hidden) == [visible.__code__, hidden.__code__]
+
+    frame = Frame(visible.__code__, {})
+    frame.f_globals = {"__tracebackhide__": True}
+    assert p._is_hidden(frame)
+
+    # Code objects are not kept alive.
+    ns = {}
+    exec("def temporary():\n    pass\n", ns)
+    assert not p._is_hidden(Frame(ns["temporary"].__code__, {}))
+    assert len(p._code_hidden) == 3
+    del ns
+    gc.collect()
+    assert list(p._code_hidden) == [visible.__code__, hidden.__code__]
+
+
 def test_break_on_setattr():
+    pdbpp.cleanup()  # Not reusing the global Pdb from other tests.
+
     # we don't use a class decorator to keep 2.5 compatibility
     class Foo(object):
         pass
@@ -3639,6 +4092,7 @@ False
 
 
 def test_break_on_setattr_without_hidden_frames():
+    pdbpp.cleanup()
 
     class PdbWithConfig(PdbTest):
         def __init__(self, *args, **kwargs):
@@ -3671,6 +4125,8 @@ False
 
 
 def test_break_on_setattr_condition():
+    pdbpp.cleanup()
+
     def mycond(obj, value):
         return value == 42
 
@@ -3702,6 +4158,8 @@ def test_break_on_setattr_condition():
 
 
 def test_break_on_setattr_non_decorator():
+    pdbpp.cleanup()
+
     class Foo(object):
         pass
 
@@ -3725,6 +4183,8 @@ def test_break_on_setattr_non_decorator():
 
 
 def test_break_on_setattr_overridden():
+    pdbpp.cleanup()
+
     # we don't use a class decorator to keep 2.5 compatibility
     class Foo(object):
         def __setattr__(self, attr, value):
@@ -3755,139 +4215,548 @@ False
 """)
 
 
-def test_track_with_no_args():
-    pytest.importorskip('rpython.translator.tool.reftracker')
+def test_break_on_setattr_descriptor():
+    class Foo(object):
+        __slots__ = ("y",)
+
+    class Bar(object):
+        z = "default"
+
+        @property
+        def x(self):
+            return self._x * 2
+
+        @x.setter
+        def x(self, value):
+            self._x = value
+
+    for cls in (Foo, Bar):
+        pdbpp.break_on_setattr("x", condition=lambda obj, value: False)(cls)
+        assert cls.__setattr__ is object.__setattr__
+    pdbpp.break_on_setattr("y", condition="value < 0")(Foo)
+    pdbpp.break_on_setattr("z", condition="value < 0")(Bar)
+
+    foo = Foo()
+    with pytest.raises(AttributeError):
+        foo.y
+    foo.y = 1
+    assert foo.y == 1
+    del foo.y
+    assert not hasattr(foo, "y")
+    with pytest.raises(AttributeError):
+        foo.x = 1
+
+    bar = Bar()
+    bar.x = 21
+    assert bar.x == 42
+    assert bar.z == Bar.z == "default"
+    bar.z = 1
+    assert bar.z == 1
+    assert bar.__dict__ == {"_x": 21, "z": 1}
+    del bar.z
+    assert bar.z == "default"
+
+
+def test_break_on_setattr_reuses_global_pdb():
+    pdbpp.cleanup()
+    instances = []
+
+    class PdbCountingInstances(PdbTest):
+        def __init__(self, *args, **kwargs):
+            instances.append(self)
+            super(PdbCountingInstances, self).__init__(*args, **kwargs)
+
+    class Foo(object):
+        pass
+    pdbpp.break_on_setattr(
+        "x", condition="value > 0", Pdb=PdbCountingInstances)(Foo)
 
     def fn():
-        set_trace()
-        return 42
+        obj = Foo()
+        obj.x = 1
+        obj.x = 0
+        obj.x = 2
+        return obj.x
 
     check(fn, """
 [NUM] > .*fn()
--> return 42
-# track
-... SyntaxError:
+-> obj.x = 1
+   5 frames hidden .*
+# c
+[NUM] > .*fn()
+-> obj.x = 2
+   5 frames hidden .*
 # c
 """)
+    assert len(instances) == 1
 
 
-def test_utf8():
-    def fn():
-        # тест
-        a = 1
-        set_trace(Config=ConfigWithHighlight)
-        return a
-
-    # we cannot easily use "check" because the output is full of ANSI escape
-    # sequences
-    expected, lines = run_func(fn, '# ll\n# c')
-    assert u'тест' in lines[5]
-
+def test_watch_attr():
+    pdbpp.cleanup()
 
-def test_debug_normal():
-    def g():
-        a = 1
-        return a
+    class Foo(object):
+        pass
 
     def fn():
-        g()
+        a = Foo()
+        b = Foo()
         set_trace()
-        return 1
+        b.x = 1
+        a.x = 2
+        a.x = 3
+        return a.x + b.x
 
     check(fn, """
 [NUM] > .*fn()
--> return 1
+-> b.x = 1
    5 frames hidden .*
-# debug g()
-ENTERING RECURSIVE DEBUGGER
-[NUM] > .*
-(#) s
---Call--
-[NUM] > .*g()
--> def g():
-(#) ll
-NUM  ->     def g():
-NUM             a = 1
-NUM             return a
-(#) c
-LEAVING RECURSIVE DEBUGGER
-# sticky
-<CLEARSCREEN>
-[NUM] > .*(), 5 frames hidden
-
-NUM         def fn():
-NUM             g()
-NUM             set_trace()
-NUM  ->         return 1
-# debug g()
-ENTERING RECURSIVE DEBUGGER
-[1] > <string>(1)<module>()
-(#) c
-LEAVING RECURSIVE DEBUGGER
+# watch
+No watchpoints.
+# watch -a a
+\\*\\*\\* Usage: watch -a obj.attr
+# watch -a (1).real
+\\*\\*\\* Cannot watch attributes of int objects
+# watch -a a.x
+Watching a.x
+# watch
+Foo.x at 0x.*
+# c
+[NUM] > .*fn()
+-> a.x = 2
+   5 frames hidden .*
+# unwatch a.x
+# unwatch a.x
+\\*\\*\\* a.x is not watched
+# unwatch a
+\\*\\*\\* Usage: unwatch number|obj.attr
 # c
 """)
+    assert "x" not in Foo.__dict__
 
 
-def test_debug_thrice():
+def test_watch_attr_removed_with_instance():
+    class Foo(object):
+        x = "class attribute"
+
+    calls = []
+
+    def condition(obj, value):
+        calls.append(value)
+        return False
+
+    a = Foo()
+    b = Foo()
+    pdbpp.watch_attr(a, "x", condition=condition)
+    pdbpp.watch_attr(b, "x", condition=condition)
+    assert isinstance(Foo.__dict__["x"], pdbpp.SetattrBreakpoint)
+    Foo().x = 1
+    a.x = 2
+    assert calls == [2]
+    assert a.x == 2
+    assert Foo().x == "class attribute"
+
+    del a
+    gc.collect()
+    assert isinstance(Foo.__dict__["x"], pdbpp.SetattrBreakpoint)
+    del b
+    gc.collect()
+    assert Foo.__dict__["x"] == "class attribute"
+    assert (Foo, "x") not in pdbpp._attr_watchpoints
+
+
+def test_watch_attr_condition_per_instance(monkeypatch):
+    class Foo(object):
+        pass
+
+    breaks = []
+    monkeypatch.setattr(pdbpp, "_break_for_setattr",
+                        lambda frame, Pdb: breaks.append(frame.f_lineno))
+    calls = []
+    a = Foo()
+    b = Foo()
+    pdbpp.watch_attr(a, "x", condition=lambda obj, value: calls.append(value))
+    pdbpp.watch_attr(b, "x", condition="value == 2")
+    try:
+        a.x = 1
+        b.x = 1
+        assert calls == [1]
+        assert breaks == []
+        b.x = 2
+        assert calls == [1]
+        assert len(breaks) == 1
+    finally:
+        assert pdbpp.unwatch_attr(a, "x")
+        assert pdbpp.unwatch_attr(b, "x")
+    assert "x" not in Foo.__dict__
+
+
+def test_watch_attr_with_custom_setattr():
+    class Foo(object):
+        def __setattr__(self, attr, value):
+            self.__dict__[attr] = value
+
+    orig___setattr__ = Foo.__dict__["__setattr__"]
+
     def fn():
+        a = Foo()
+        b = Foo()
         set_trace()
+        b.x = 1
+        a.x = 2
+        return a.x + b.x
 
     check(fn, """
---Return--
 [NUM] > .*fn()
--> set_trace()
+-> b.x = 1
    5 frames hidden .*
-# debug 1
-ENTERING RECURSIVE DEBUGGER
-[NUM] > .*
-(#) debug 2
-ENTERING RECURSIVE DEBUGGER
-[NUM] > .*
-((#)) debug 34
-ENTERING RECURSIVE DEBUGGER
-[NUM] > .*
-(((#))) p 42
-42
-(((#))) c
-LEAVING RECURSIVE DEBUGGER
-((#)) c
-LEAVING RECURSIVE DEBUGGER
-(#) c
-LEAVING RECURSIVE DEBUGGER
+# watch -a a.x
+Watching a.x
 # c
-""")
-
-
-def test_syntaxerror_in_command():
-    def f():
-        set_trace()
-
-    check(f, """
---Return--
-[NUM] > .*f()
--> set_trace
+[NUM] > .*fn()
+-> a.x = 2
    5 frames hidden .*
-# print(
-\\*\\*\\* SyntaxError: .*
-# debug print(
-ENTERING RECURSIVE DEBUGGER
-\\*\\*\\* SyntaxError: .*
-LEAVING RECURSIVE DEBUGGER
+# unwatch a.x
 # c
 """)
+    assert Foo.__dict__["__setattr__"] is orig___setattr__
+    assert "x" not in Foo.__dict__
+    assert (Foo, "x") not in pdbpp._attr_watchpoints
+    obj = Foo()
+    obj.x = 1
+    assert obj.x == 1
 
 
-def test_debug_with_overridden_continue():
-    class CustomPdb(PdbTest, object):
-        """CustomPdb that overrides do_continue like with pytest's wrapper."""
+def test_watch_attr_filters_by_identity():
+    class Unhashable(object):
+        def __eq__(self, other):
+            raise AssertionError("compared")
 
-        def do_continue(self, arg):
-            global count_continue
-            count_continue += 1
-            print("do_continue_%d" % count_continue)
-            return super(CustomPdb, self).do_continue(arg)
+        __hash__ = None
 
-        do_c = do_cont = do_continue
+    calls = []
+    obj = Unhashable()
+    pdbpp.watch_attr(obj, "x", condition=lambda obj, value: calls.append(1))
+    try:
+        Unhashable().x = 1
+        assert calls == []
+        obj.x = 1
+        assert calls == [1]
+    finally:
+        assert pdbpp.unwatch_attr(obj, "x")
+    assert "x" not in Unhashable.__dict__
+    assert not pdbpp.unwatch_attr(obj, "x")
+
+
+def test_watch_expression():
+    def inc(x):
+        return x + 1
+
+    def fn():
+        a = 1
+        set_trace()
+        b = 2
+        a = inc(a)
+        c = a
+        a = a
+        return a + b + c
+
+    check(fn, """
+[NUM] > .*fn()
+-> b = 2
+   5 frames hidden .*
+# watch a
+Watchpoint 1: a = 1
+# watch a + b
+Watchpoint 2: a \\+ b = <undefined>
+# watch
+Watchpoint 1: a = 1 in fn()
+Watchpoint 2: a \\+ b = <undefined> in fn()
+# c
+Watchpoint 2: a \\+ b: <undefined> --> 3
+Changed by .*:NUM: b = 2
+[NUM] > .*fn()
+-> a = inc(a)
+   5 frames hidden .*
+# unwatch 2
+# unwatch 2
+\\*\\*\\* No watchpoint number 2
+# c
+Watchpoint 1: a: 1 --> 2
+Changed by .*:NUM: a = inc(a)
+[NUM] > .*fn()
+-> c = a
+   5 frames hidden .*
+# c
+Watchpoint 1 deleted: fn() returned
+""")
+
+
+def test_watch_expression_with_attribute():
+    class Foo(object):
+        x = 1
+
+    def fn():
+        obj = Foo()
+        set_trace()
+        obj.x = 2
+        return obj.x
+
+    check(fn, """
+[NUM] > .*fn()
+-> obj.x = 2
+   5 frames hidden .*
+# watch obj.x
+Watchpoint 1: obj.x = 1
+# c
+Watchpoint 1: obj.x: 1 --> 2
+Changed by .*:NUM: obj.x = 2
+[NUM] > .*fn()
+-> return obj.x
+   5 frames hidden .*
+# c
+Watchpoint 1 deleted: fn() returned
+""")
+    assert Foo.__dict__["x"] == 1
+
+
+def test_watch_expression_callees():
+    items = []
+
+    def g():
+        items.append(1)
+        return 1
+
+    def fn():
+        lst = items
+        set_trace()
+        g()
+        g()
+        return len(lst)
+
+    check(fn, """
+[NUM] > .*fn()
+-> g()
+   5 frames hidden .*
+# watch len(lst)
+Watchpoint 1: len(lst) = 0
+# c
+Watchpoint 1: len(lst): 0 --> 1
+Changed by .*:NUM: g()
+[NUM] > .*fn()
+-> g()
+   5 frames hidden .*
+# unwatch 1
+# watch -c len(lst)
+Watchpoint 2: len(lst) = 1
+# c
+Watchpoint 2: len(lst): 1 --> 2
+Changed by .*:NUM: items.append(1)
+[NUM] > .*g()
+-> return 1
+   5 frames hidden .*
+# c
+Watchpoint 2 deleted: fn() returned
+""")
+
+
+def test_watch_expression_evaluated_in_frame_only():
+    evaluations = []
+
+    def g():
+        for i in range(100):
+            pass
+
+    def fn():
+        ev = evaluations
+        x = 1
+        set_trace()
+        g()
+        x = 2
+        return ev and x
+
+    check(fn, """
+[NUM] > .*fn()
+-> g()
+   5 frames hidden .*
+# watch ev.append(1) or x
+Watchpoint 1: ev.append(1) or x = 1
+# c
+Watchpoint 1: ev.append(1) or x: 1 --> 2
+Changed by .*:NUM: x = 2
+[NUM] > .*fn()
+-> return ev and x
+   5 frames hidden .*
+# c
+Watchpoint 1 deleted: fn() returned
+""")
+    assert len(evaluations) < 10
+
+
+@pytest.mark.skipif(not hasattr(sys, "monitoring"),
+                    reason="sys.monitoring is Python 3.12+")
+def test_monitoring_backend_watch_expression_callees():
+    items = []
+
+    def g():
+        items.append(1)
+        return 1
+
+    def fn():
+        lst = items
+        set_trace(Config=ConfigWithMonitoring)
+        g()
+        return len(lst)
+
+    check(fn, """
+[NUM] > .*fn()
+-> g()
+   5 frames hidden .*
+# watch -c len(lst)
+Watchpoint 1: len(lst) = 0
+# c
+Watchpoint 1: len(lst): 0 --> 1
+Changed by .*:NUM: items.append(1)
+[NUM] > .*g()
+-> return 1
+   5 frames hidden .*
+# c
+Watchpoint 1 deleted: fn() returned
+""")
+
+
+def test_track_with_no_args():
+    pytest.importorskip('rpython.translator.tool.reftracker')
+
+    def fn():
+        set_trace()
+        return 42
+
+    check(fn, """
+[NUM] > .*fn()
+-> return 42
+# track
+... SyntaxError:
+# c
+""")
+
+
+def test_utf8():
+    def fn():
+        # тест
+        a = 1
+        set_trace(Config=ConfigWithHighlight)
+        return a
+
+    # we cannot easily use "check" because the output is full of ANSI escape
+    # sequences
+    expected, lines = run_func(fn, '# ll\n# c')
+    assert u'тест' in lines[5]
+
+
+def test_debug_normal():
+    def g():
+        a = 1
+        return a
+
+    def fn():
+        g()
+        set_trace()
+        return 1
+
+    check(fn, """
+[NUM] > .*fn()
+-> return 1
+   5 frames hidden .*
+# debug g()
+ENTERING RECURSIVE DEBUGGER
+[NUM] > .*
+(#) s
+--Call--
+[NUM] > .*g()
+-> def g():
+(#) ll
+NUM  ->     def g():
+NUM             a = 1
+NUM             return a
+(#) c
+LEAVING RECURSIVE DEBUGGER
+# sticky
+<CLEARSCREEN>
+[NUM] > .*(), 5 frames hidden
+
+NUM         def fn():
+NUM             g()
+NUM             set_trace()
+NUM  ->         return 1
+# debug g()
+ENTERING RECURSIVE DEBUGGER
+[1] > <string>(1)<module>()
+(#) c
+LEAVING RECURSIVE DEBUGGER
+# c
+""")
+
+
+def test_debug_thrice():
+    def fn():
+        set_trace()
+
+    check(fn, """
+--Return--
+[NUM] > .*fn()
+-> set_trace()
+   5 frames hidden .*
+# debug 1
+ENTERING RECURSIVE DEBUGGER
+[NUM] > .*
+(#) debug 2
+ENTERING RECURSIVE DEBUGGER
+[NUM] > .*
+((#)) debug 34
+ENTERING RECURSIVE DEBUGGER
+[NUM] > .*
+(((#))) p 42
+42
+(((#))) c
+LEAVING RECURSIVE DEBUGGER
+((#)) c
+LEAVING RECURSIVE DEBUGGER
+(#) c
+LEAVING RECURSIVE DEBUGGER
+# c
+""")
+
+
+def test_syntaxerror_in_command():
+    def f():
+        set_trace()
+
+    check(f, """
+--Return--
+[NUM] > .*f()
+-> set_trace
+   5 frames hidden .*
+# print(
+\\*\\*\\* SyntaxError: .*
+# debug print(
+ENTERING RECURSIVE DEBUGGER
+\\*\\*\\* SyntaxError: .*
+LEAVING RECURSIVE DEBUGGER
+# c
+""")
+
+
+def test_debug_with_overridden_continue():
+    class CustomPdb(PdbTest, object):
+        """CustomPdb that overrides do_continue like with pytest's wrapper."""
+
+        def do_continue(self, arg):
+            global count_continue
+            count_continue += 1
+            print("do_continue_%d" % count_continue)
+            return super(CustomPdb, self).do_continue(arg)
+
+        do_c = do_cont = do_continue
 
     def g():
         a = 1
@@ -4056,6 +4925,32 @@ Deleted breakpoint NUM
     ))
 
 
+def test_continue_removes_trace_from_all_frames():
+    traced = []
+
+    def previous_trace(frame, event, arg):
+        return None
+
+    def fn():
+        sys.settrace(previous_trace)
+        set_trace()
+        frame = sys._getframe()
+        while frame is not None:
+            if frame.f_trace is not None:
+                traced.append(frame.f_code.co_name)
+            frame = frame.f_back
+        traced.append(sys.gettrace())
+        sys.settrace(None)
+
+    check(fn, """
+[NUM] > .*fn()
+-> frame = sys._getframe()
+   5 frames hidden .*
+# c
+""")
+    assert traced == [previous_trace]
+
+
 @pytest.mark.skipif(sys.version_info < (3, 7), reason="header kwarg is 3.7+")
 def test_set_trace_header():
     """Handler header kwarg added with Python 3.7 in pdb.set_trace."""
@@ -4122,175 +5017,542 @@ def test_sigint_in_interaction_with_new_cmdloop():
         set_trace()
 
     check(fn, """
---Return--
+--Return--
+[NUM] > .*fn()
+-> set_trace()
+   5 frames hidden .*
+# debug inner()
+ENTERING RECURSIVE DEBUGGER
+[NUM] > .*
+(#) c
+--KeyboardInterrupt--
+# c
+""")
+
+
+@pytest.mark.skipif(hasattr(pdbpp.pdb.Pdb, "_cmdloop"),
+                    reason="_cmdloop is available")
+def test_sigint_in_interaction_without_new_cmdloop():
+    def fn():
+        def inner():
+            raise KeyboardInterrupt()
+        set_trace()
+
+    with pytest.raises(KeyboardInterrupt):
+        check(fn, """
+--Return--
+[NUM] > .*fn()
+-> set_trace()
+   5 frames hidden .*
+# debug inner()
+ENTERING RECURSIVE DEBUGGER
+[NUM] > .*
+(#) c
+""")
+
+    # Reset pdb, which did not clean up correctly.
+    # Needed for PyPy (Python 2.7.13[pypy-7.1.0-final]) with coverage and
+    # restoring trace function.
+    pdbpp.local.GLOBAL_PDB.reset()
+
+
+@pytest.mark.skipif(not hasattr(pdbpp.pdb.Pdb, "_previous_sigint_handler"),
+                    reason="_previous_sigint_handler is not available")
+def test_interaction_restores_previous_sigint_handler():
+    """Test is based on cpython's test_pdb_issue_20766."""
+    def fn():
+        i = 1
+        while i <= 2:
+            sess = PdbTest(nosigint=False)
+            sess.set_trace(sys._getframe())
+            print('pdb %d: %s' % (i, sess._previous_sigint_handler))
+            i += 1
+
+    check(fn, """
+[NUM] > .*fn()
+-> print('pdb %d: %s' % (i, sess._previous_sigint_handler))
+   5 frames hidden .*
+# c
+pdb 1: <built-in function default_int_handler>
+[NUM] > .*fn()
+-> .*
+   5 frames hidden .*
+# c
+pdb 2: <built-in function default_int_handler>
+""")
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGWINCH"), reason="needs SIGWINCH")
+def test_terminal_size_cached(monkeypatch):
+    sizes = [(80, 24), (100, 30), (120, 40)]
+    monkeypatch.setattr(Pdb, "get_terminal_size",
+                        staticmethod(lambda: sizes.pop(0)))
+    previous = signal.getsignal(signal.SIGWINCH)
+
+    p = Pdb()
+    monkeypatch.delitem(sys.modules, "readline", raising=False)
+    p._install_sigwinch_handler()
+    try:
+        assert p.terminal_size == (80, 24)
+        assert p.terminal_size == (80, 24)
+        os.kill(os.getpid(), signal.SIGWINCH)
+        assert p.terminal_size == (100, 30)
+        p.precmd("")
+        assert p.terminal_size == (100, 30)
+    finally:
+        p._uninstall_sigwinch_handler()
+    assert signal.getsignal(signal.SIGWINCH) is previous
+
+    # Invalidated at the prompt without the signal handler.
+    p.precmd("")
+    assert p.terminal_size == (120, 40)
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGWINCH"), reason="needs SIGWINCH")
+def test_terminal_size_keeps_readline_sigwinch_handler(monkeypatch):
+    monkeypatch.setitem(sys.modules, "readline", sys.modules.get("readline"))
+    previous = signal.getsignal(signal.SIGWINCH)
+
+    p = Pdb()
+    p._install_sigwinch_handler()
+    assert p._sigwinch_handler is None
+    assert signal.getsignal(signal.SIGWINCH) is previous
+
+
+def test_recursive_set_trace():
+    def fn():
+        global inner
+        global count
+        count = 0
+
+        def inner():
+            global count
+            count += 1
+
+            if count == 1:
+                set_trace()
+            else:
+                set_trace(cleanup=False)
+
+        inner()
+
+    check(fn, """
+--Return--
+[NUM] > .*inner()
+-> set_trace()
+   5 frames hidden .*
+# inner()
+# c
+""")
+
+
+def test_steps_over_set_trace():
+    def fn():
+        set_trace()
+        print(1)
+
+        set_trace(cleanup=False)
+        print(2)
+
+    check(fn, """
+[NUM] > .*fn()
+-> print(1)
+   5 frames hidden .*
+# n
+1
+[NUM] > .*fn()
+-> set_trace(cleanup=False)
+   5 frames hidden .*
+# n
+[NUM] > .*fn()
+-> print(2)
+   5 frames hidden .*
+# c
+2
+""")
+
+
+def test_break_after_set_trace():
+    def fn():
+        set_trace()
+        print(1)
+        print(2)
+
+    _, lineno = inspect.getsourcelines(fn)
+
+    check(fn, """
+[NUM] > .*fn()
+-> print(1)
+   5 frames hidden .*
+# break {lineno}
+Breakpoint . at .*:{lineno}
+# c
+1
+[NUM] > .*fn()
+-> print(2)
+   5 frames hidden .*
+# import pdb; pdbpp.local.GLOBAL_PDB.clear_all_breaks()
+# c
+2
+""".format(lineno=lineno + 3))
+
+
+def test_break_with_inner_set_trace():
+    def fn():
+        def inner():
+            set_trace(cleanup=False)
+
+        set_trace()
+        inner()
+        print(1)
+
+    _, lineno = inspect.getsourcelines(fn)
+
+    check(fn, """
+[NUM] > .*fn()
+-> inner()
+   5 frames hidden .*
+# break {lineno}
+Breakpoint . at .*:{lineno}
+# c
+--Return--
+[NUM] > .*inner()->None
+-> set_trace(cleanup=False)
+   5 frames hidden .*
+# import pdb; pdbpp.local.GLOBAL_PDB.clear_all_breaks()
+# c
+1
+""".format(lineno=lineno + 8))
+
+
+class ConfigWithMonitoring(ConfigTest):
+    trace_backend = "monitoring"
+
+
+@pytest.mark.skipif(not hasattr(sys, "monitoring"),
+                    reason="sys.monitoring is Python 3.12+")
+def test_monitoring_backend_step_next_return():
+    def g(x):
+        y = -x
+        return y
+
+    def fn():
+        set_trace(Config=ConfigWithMonitoring)
+        a = g(1)
+        return g(a)
+
+    check(fn, """
+[NUM] > .*fn()
+-> a = g(1)
+   5 frames hidden .*
+# s
+--Call--
+[NUM] > .*g()
+-> def g(x):
+   5 frames hidden .*
+# n
+[NUM] > .*g()
+-> y = -x
+   5 frames hidden .*
+# r
+--Return--
+[NUM] > .*g()->-1
+-> return y
+   5 frames hidden .*
+# n
+[NUM] > .*fn()
+-> return g(a)
+   5 frames hidden .*
+# c
+""")
+    assert sys.monitoring.get_tool(sys.monitoring.DEBUGGER_ID) is None
+
+
+@pytest.mark.skipif(not hasattr(sys, "monitoring"),
+                    reason="sys.monitoring is Python 3.12+")
+def test_monitoring_backend_break():
+    def g(x):
+        return -x
+
+    def fn():
+        set_trace(Config=ConfigWithMonitoring)
+        a = g(1)
+        return g(a)
+
+    _, lineno = inspect.getsourcelines(g)
+
+    check(fn, """
+[NUM] > .*fn()
+-> a = g(1)
+   5 frames hidden .*
+# break {lineno}
+Breakpoint . at .*:{lineno}
+# c
+[NUM] > .*g()
+-> return -x
+   5 frames hidden .*
+# x
+1
+# c
+[NUM] > .*g()
+-> return -x
+   5 frames hidden .*
+# x
+-1
+# import pdb; pdbpp.local.GLOBAL_PDB.clear_all_breaks()
+# c
+""".format(lineno=lineno + 1))
+    assert sys.monitoring.get_tool(sys.monitoring.DEBUGGER_ID) is None
+
+
+@pytest.mark.skipif(not hasattr(sys, "monitoring"),
+                    reason="sys.monitoring is Python 3.12+")
+def test_monitoring_backend_only_traces_stopframe():
+    events = []
+
+    def g():
+        mon = sys.monitoring
+        events.append((
+            mon.get_local_events(mon.DEBUGGER_ID, fn.__code__),
+            mon.get_local_events(mon.DEBUGGER_ID, g.__code__),
+            mon.get_events(mon.DEBUGGER_ID),
+        ))
+
+    def fn():
+        set_trace(Config=ConfigWithMonitoring)
+        g()
+        return 2
+
+    check(fn, """
 [NUM] > .*fn()
--> set_trace()
+-> g()
+   5 frames hidden .*
+# n
+[NUM] > .*fn()
+-> return 2
    5 frames hidden .*
-# debug inner()
-ENTERING RECURSIVE DEBUGGER
-[NUM] > .*
-(#) c
---KeyboardInterrupt--
 # c
 """)
+    E = sys.monitoring.events
+    assert events == [(
+        E.LINE | E.PY_RETURN | E.PY_YIELD, 0, E.RAISE | E.PY_UNWIND,
+    )]
+    assert sys.monitoring.get_tool(sys.monitoring.DEBUGGER_ID) is None
 
 
-@pytest.mark.skipif(hasattr(pdbpp.pdb.Pdb, "_cmdloop"),
-                    reason="_cmdloop is available")
-def test_sigint_in_interaction_without_new_cmdloop():
-    def fn():
-        def inner():
-            raise KeyboardInterrupt()
-        set_trace()
+def test_break_anywhere_uses_code_of_frame():
+    def with_break():
+        x = 1  # noqa: F841
+        return sys._getframe()
 
-    with pytest.raises(KeyboardInterrupt):
-        check(fn, """
---Return--
-[NUM] > .*fn()
--> set_trace()
-   5 frames hidden .*
-# debug inner()
-ENTERING RECURSIVE DEBUGGER
-[NUM] > .*
-(#) c
-""")
+    def without_break():
+        return sys._getframe()
 
-    # Reset pdb, which did not clean up correctly.
-    # Needed for PyPy (Python 2.7.13[pypy-7.1.0-final]) with coverage and
-    # restoring trace function.
-    pdbpp.local.GLOBAL_PDB.reset()
+    p = PdbTest()
+    filename = p.canonic(with_break.__code__.co_filename)
+    assert p.break_anywhere(with_break()) is False
 
+    p.set_break(filename, with_break.__code__.co_firstlineno + 2)
+    try:
+        assert p.break_anywhere(with_break()) is True
+        assert p.break_anywhere(without_break()) is False
+        # Calls to code without breakpoints are not traced with "continue".
+        p.reset()
+        p.botframe = sys._getframe()
+        p._set_stopinfo(p.botframe, None, -1)
+        assert p.dispatch_call(without_break(), None) is None
+        assert p.dispatch_call(with_break(), None) == p.trace_dispatch
+    finally:
+        p.clear_all_breaks()
+    assert p.break_anywhere(with_break()) is False
+
+
+def test_break_anywhere_does_not_keep_code_alive():
+    import weakref
+
+    ns = {"sys": sys}
+    exec("def fn():\n    return sys._getframe()\n", ns)
+    code_ref = weakref.ref(ns["fn"].__code__)
+
+    p = PdbTest()
+    assert p.break_anywhere(ns["fn"]()) is False
+    del ns
+    gc.collect()
+    assert code_ref() is None
+
+
+def test_break_with_condition_compiled_once(monkeypatch):
+    compiled = []
+    orig_compile_expr = pdbpp.compile_expr
+
+    def compile_expr(expr):
+        compiled.append(expr)
+        return orig_compile_expr(expr)
+
+    monkeypatch.setattr(pdbpp, "compile_expr", compile_expr)
 
-@pytest.mark.skipif(not hasattr(pdbpp.pdb.Pdb, "_previous_sigint_handler"),
-                    reason="_previous_sigint_handler is not available")
-def test_interaction_restores_previous_sigint_handler():
-    """Test is based on cpython's test_pdb_issue_20766."""
     def fn():
-        i = 1
-        while i <= 2:
-            sess = PdbTest(nosigint=False)
-            sess.set_trace(sys._getframe())
-            print('pdb %d: %s' % (i, sess._previous_sigint_handler))
-            i += 1
+        set_trace()
+        for i in range(10):
+            i  # noqa: B018
+        return i
+
+    _, lineno = inspect.getsourcelines(fn)
 
     check(fn, """
 [NUM] > .*fn()
--> print('pdb %d: %s' % (i, sess._previous_sigint_handler))
+-> for i in range(10):
    5 frames hidden .*
+# break {lineno}, i == 7
+Breakpoint NUM at .*:{lineno}
 # c
-pdb 1: <built-in function default_int_handler>
 [NUM] > .*fn()
--> .*
+-> i  # noqa: B018
    5 frames hidden .*
+# i
+7
+# import pdb; pdbpp.local.GLOBAL_PDB.clear_all_breaks()
 # c
-pdb 2: <built-in function default_int_handler>
-""")
+""".format(lineno=lineno + 3))
+    # Once when defining it, and for each of the 8 evaluations (cached).
+    assert compiled == ["i == 7"] * 9
 
 
-def test_recursive_set_trace():
+def test_break_with_invalid_condition(fresh_breakpoints):
     def fn():
-        global inner
-        global count
-        count = 0
-
-        def inner():
-            global count
-            count += 1
-
-            if count == 1:
-                set_trace()
-            else:
-                set_trace(cleanup=False)
+        set_trace()
+        a = 1
+        return a
 
-        inner()
+    _, lineno = inspect.getsourcelines(fn)
 
     check(fn, """
---Return--
-[NUM] > .*inner()
--> set_trace()
+[NUM] > .*fn()
+-> a = 1
    5 frames hidden .*
-# inner()
+# break {lineno}, a ==
+\\*\\*\\* Invalid condition a ==: .*
+# break {lineno}
+Breakpoint 1 at .*:{lineno}
+# condition 1 a ==
+\\*\\*\\* Invalid condition a ==: .*
+# condition 1 a == 1
+New condition set for breakpoint 1.
+# import pdb; pdbpp.local.GLOBAL_PDB.clear_all_breaks()
 # c
-""")
+""".format(lineno=lineno + 3))
 
 
-def test_steps_over_set_trace():
+def test_break_cleared_by_number(fresh_breakpoints):
     def fn():
         set_trace()
-        print(1)
+        for i in range(2):
+            a = i
+            b = i
+        return a + b
 
-        set_trace(cleanup=False)
-        print(2)
+    _, lineno = inspect.getsourcelines(fn)
 
     check(fn, """
 [NUM] > .*fn()
--> print(1)
+-> for i in range(2):
    5 frames hidden .*
-# n
-1
+# break {a}
+Breakpoint 1 at .*:{a}
+# break {b}
+Breakpoint 2 at .*:{b}
+# c
 [NUM] > .*fn()
--> set_trace(cleanup=False)
+-> a = i
    5 frames hidden .*
-# n
+# sorted(bp.number for bp in pdbpp.local.GLOBAL_PDB._bp_counts)
+[1]
+# clear 1
+Deleted breakpoint 1 at .*:{a}
+# sorted(bp.number for bp in pdbpp.local.GLOBAL_PDB._bp_counts)
+[]
+# c
 [NUM] > .*fn()
--> print(2)
+-> b = i
    5 frames hidden .*
 # c
-2
-""")
+[NUM] > .*fn()
+-> b = i
+   5 frames hidden .*
+# import pdb; pdbpp.local.GLOBAL_PDB.clear_all_breaks()
+# c
+""".format(a=lineno + 3, b=lineno + 4))
 
 
-def test_break_after_set_trace():
+def test_tbreak_deleted(fresh_breakpoints):
     def fn():
         set_trace()
-        print(1)
-        print(2)
+        for i in range(2):
+            a = i
+            b = i
+        return a + b
 
     _, lineno = inspect.getsourcelines(fn)
 
     check(fn, """
 [NUM] > .*fn()
--> print(1)
+-> for i in range(2):
    5 frames hidden .*
-# break {lineno}
-Breakpoint . at .*:{lineno}
+# tbreak {a}
+Breakpoint 1 at .*:{a}
+# break {b}
+Breakpoint 2 at .*:{b}
 # c
-1
+Deleted breakpoint 1 at .*:{a}
 [NUM] > .*fn()
--> print(2)
+-> a = i
+   5 frames hidden .*
+# c
+[NUM] > .*fn()
+-> b = i
+   5 frames hidden .*
+# c
+[NUM] > .*fn()
+-> b = i
    5 frames hidden .*
 # import pdb; pdbpp.local.GLOBAL_PDB.clear_all_breaks()
 # c
-2
-""".format(lineno=lineno + 3))
+""".format(a=lineno + 3, b=lineno + 4))
 
 
-def test_break_with_inner_set_trace():
+def test_info_breakpoints(fresh_breakpoints):
     def fn():
-        def inner():
-            set_trace(cleanup=False)
-
         set_trace()
-        inner()
-        print(1)
+        for i in range(10):
+            i  # noqa: B018
+        return i
 
     _, lineno = inspect.getsourcelines(fn)
 
     check(fn, """
 [NUM] > .*fn()
--> inner()
+-> for i in range(10):
    5 frames hidden .*
-# break {lineno}
-Breakpoint . at .*:{lineno}
+# info breakpoints
+No breakpoints.
+# info foo
+\\*\\*\\* Usage: info breakpoints
+# break {lineno}, i % 4 == 3
+Breakpoint 1 at .*:{lineno}
 # c
---Return--
-[NUM] > .*inner()->None
--> set_trace(cleanup=False)
+[NUM] > .*fn()
+-> i  # noqa: B018
+   5 frames hidden .*
+# c
+[NUM] > .*fn()
+-> i  # noqa: B018
    5 frames hidden .*
+# info b
+Num  Where  *Evaluated Stopped
+1    .*:{lineno} +8       2
 # import pdb; pdbpp.local.GLOBAL_PDB.clear_all_breaks()
 # c
-1
-""".format(lineno=lineno + 8))
+""".format(lineno=lineno + 3))
 
 
 @pytest.mark.skipif(
@@ -4959,19 +6221,18 @@ before_interaction_hook
 def test_compute_stack_keeps_frame():
     """With only hidden frames the last one is kept."""
     def fn():
+        __tracebackhide__ = True
+
         def raises():
+            __tracebackhide__ = True  # noqa: F841
             raise Exception("foo")
 
         try:
             raises()
         except Exception:
             tb = sys.exc_info()[2]
-            tb_ = tb
-            while tb_:
-                tb_.tb_frame.f_locals["__tracebackhide__"] = True
-                tb_ = tb_.tb_next
             pdbpp.post_mortem(tb, Pdb=PdbTest)
-        return 1
+        return __tracebackhide__
 
     check(fn, """
 [0] > .*raises()
@@ -5527,6 +6788,38 @@ config_setup
 """)
 
 
+def test_config_file_is_cached_and_reloaded(tmpdirhome, monkeypatch):
+    monkeypatch.setattr(pdbpp, "_config_cache", {})
+    loads = []
+    monkeypatch.setattr(pdbpp, "_test_config_loads", loads, raising=False)
+
+    rcfile = tmpdirhome.join(".pdbrc.py")
+    rcfile.write(textwrap.dedent("""
+        import pdbpp
+
+        pdbpp._test_config_loads.append(1)
+
+        class Config(pdbpp.DefaultConfig):
+            prompt = "(rc1) "
+    """))
+
+    p1 = PdbTest(Config=None)
+    p2 = PdbTest(Config=None)
+    assert p1.prompt == p2.prompt == "(rc1++) "
+    assert p1.config is not p2.config
+    assert loads == [1]
+
+    rcfile.write(rcfile.read().replace("(rc1) ", "(rc2) "))
+    st = rcfile.stat()
+    os.utime(str(rcfile), (st.atime, st.mtime + 10))
+    assert PdbTest(Config=None).prompt == "(rc2++) "
+    assert PdbTest(Config=None).prompt == "(rc2++) "
+    assert loads == [1, 1]
+
+    rcfile.remove()
+    assert PdbTest(Config=None).prompt == "(Pdb++) "
+
+
 def test_do_bt():
     def fn():
         set_trace()
@@ -5707,6 +7000,95 @@ def test_count_with_pp():
 """)
 
 
+def test_budgeted_repr():
+    a = [1]
+    a.append(a)
+    for obj in [[], (1,), {"a": [b"x", (2, 3)]}, set([1]), frozenset(), a]:
+        assert pdbpp.BudgetedRepr().repr(obj) == repr(obj)
+
+    budgeted_repr = pdbpp.BudgetedRepr(max_chars=30, max_depth=2, max_items=3)
+    assert budgeted_repr.repr(list(range(100))) == "[0, 1, 2, ...]"
+    assert budgeted_repr.repr([[[1]], {1: 2}]) == "[[[...]], {1: 2}]"
+    assert budgeted_repr.repr("x" * 100) == "'" + "x" * 29 + "..."
+    assert budgeted_repr.repr([1000] * 3 + ["x" * 100]) == (
+        "[1000, 1000, 1000, ...]")
+    assert budgeted_repr.repr([[1000] * 3] * 3) == (
+        "[[1000, 1000, 1000], [1000, 10...")
+    assert pdbpp.BudgetedRepr(max_seconds=0).repr([1, 2]) == "..."
+
+    assert pdbpp.BudgetedRepr(max_depth=2, max_items=3).pformat(
+        {"b": list(range(5)), "a": [[[1]]], "c": 1, "d": 2}, width=25
+    ) == "\n".join([
+        "{'b': [0, 1, 2, ...],",
+        " 'a': [[...]],",
+        " 'c': 1,",
+        " ...}",
+    ])
+    # Sorted like with pprint, if all items are shown.
+    obj = {"b": list(range(10)), "a": {"x": "y" * 30, "z": (1,)}}
+    assert pdbpp.BudgetedRepr().pformat(obj, width=30) == pprint.pformat(
+        obj, width=30)
+
+
+def test_budgeted_repr_subclasses():
+    import collections
+
+    class List(list):
+        pass
+
+    class CustomRepr(list):
+        def __repr__(self):
+            return "CustomRepr()"
+
+    Point = collections.namedtuple("Point", "x y")
+    budgeted_repr = pdbpp.BudgetedRepr(max_items=2)
+    assert budgeted_repr.repr(collections.OrderedDict(
+        (i, i) for i in range(10**6))) == "OrderedDict({0: 0, 1: 1, ...})"
+    assert budgeted_repr.repr(collections.defaultdict(
+        list, a=list(range(5)))) == "defaultdict({'a': [0, 1, ...]})"
+    assert budgeted_repr.repr(collections.deque(range(5))) == (
+        "deque([0, 1, ...])")
+    assert budgeted_repr.repr(List(range(5))) == "List([0, 1, ...])"
+    assert budgeted_repr.repr(CustomRepr(range(5))) == "CustomRepr()"
+    assert budgeted_repr.repr(Point(1, range(5))) == (
+        "Point(x=1, y=%r)" % range(5))
+    assert budgeted_repr.repr(Point(1, [2, 3, 4])) == (
+        "Point(x=1, y=[2, 3, ...])")
+    assert budgeted_repr.pformat(
+        collections.OrderedDict((i, i) for i in range(10**6)), width=20
+    ) == "OrderedDict({0: 0,\n             1: 1,\n             ...})"
+
+
+def test_p_and_pp_budgeted():
+    class Config(ConfigTest):
+        repr_max_items = 3
+
+    def fn():
+        a = list(range(5))
+        set_trace(Config=Config)
+        return a
+
+    check(fn, r"""
+[NUM] > .*fn()
+-> return a
+   5 frames hidden .*
+# p a
+[0, 1, 2, ...]
+# p! a
+[0, 1, 2, 3, 4]
+# pp a
+[0, 1, 2, ...]
+# 5pp! a
+[0,
+ 1,
+ 2,
+ 3,
+ 4]
+# display a
+# c
+""")
+
+
 def test_ArgWithCount():
     from pdbpp import ArgWithCount
 
@@ -5937,6 +7319,78 @@ def test_stdout_reconfigured(pass_stdout, monkeypatch):
 """)
 
 
+class RecordingStream(object):
+    """Output stream recording its writes."""
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def flush(self):
+        pass
+
+
+def test_output_buffer():
+    stream = RecordingStream()
+    writes = stream.writes
+    output = pdbpp.OutputBuffer(stream)
+    output.write("a\n")
+    output.write("b\n")
+    assert writes == []
+    output.flush()
+    output.write("c\n")
+    output.write("\x1b[31mred")
+    output.end(interrupted=True)
+    assert writes == ["a\nb\n", "c\n\x1b[31mred\x1b[0m\n"]
+
+
+def test_output_buffer_single_write_per_command():
+    def fn():
+        stdout = sys.stdout
+        set_trace()
+        a = 1
+        return a, stdout
+
+    check(fn, """
+[NUM] > .*fn()
+-> a = 1
+   5 frames hidden .*
+# ll
+NUM         def fn():
+NUM             stdout = sys.stdout
+NUM             set_trace()
+NUM  ->         a = 1
+NUM             return a, stdout
+# p [print("program"), 1][1]
+program
+1
+# p sys.stdout is stdout
+True
+# sys.stdout is stdout
+True
+# c
+""")
+
+    stream = RecordingStream()
+    writes = stream.writes
+    p = pdbpp.Pdb(Config=DefaultConfig, stdout=stream)
+    p._begin_output_buffer()
+    p.message("a")
+    p.message("b")
+    p._end_output_buffer()
+    assert writes == ["a\nb\n"]
+    assert p.stdout is stream
+
+    # Written before running code of the program, which uses the stream.
+    p._begin_output_buffer()
+    p.message("c")
+    assert p._flush_output_buffer() is stream
+    assert writes == ["a\nb\n", "c\n"]
+    p._end_output_buffer()
+
+
 def test_position_of_obj_unwraps():
     import contextlib
 
@@ -6002,6 +7456,56 @@ is_skipped_module\? testing.test_pdb
 """)
 
 
+def test_is_skipped_module():
+    p = PdbTest(skip=["foo", "bar.*"])
+    assert p.is_skipped_module("foo")
+    assert not p.is_skipped_module("foo.x")
+    assert p.is_skipped_module("bar.x")
+    assert not p.is_skipped_module("bar")
+    assert not p.is_skipped_module(None)
+    assert p._skip_matcher[2] == {
+        "foo": True, "foo.x": False, "bar.x": True, "bar": False,
+    }
+
+    p.skip.add("baz")
+    assert p.is_skipped_module("baz")
+    # Changed in place, with the same length.
+    p.skip.remove("baz")
+    p.skip.add("qux")
+    assert not p.is_skipped_module("baz")
+    assert p.is_skipped_module("qux")
+    p.skip = None
+    assert not p.is_skipped_module("baz")
+
+
+def test_skip_stdlib_and_site_packages(monkeypatch):
+    class Config(ConfigTest):
+        skip_stdlib = True
+
+    p = PdbTest(Config=Config)
+    assert p.is_skipped_module("os")
+    assert p.is_skipped_module("textwrap")
+    assert not p.is_skipped_module("pytest")
+    assert not p.is_skipped_module(__name__)
+    assert not p.is_skipped_module("sys")  # builtin, no file
+
+    # Modules get checked again once they are imported.
+    module = types.ModuleType("pdbpp_test_stdlib_module")
+    module.__file__ = os.path.join(os.path.dirname(os.__file__), "x.py")
+    assert not p.is_skipped_module(module.__name__)
+    monkeypatch.setitem(sys.modules, module.__name__, module)
+    assert p.is_skipped_module(module.__name__)
+
+    class Config(ConfigTest):
+        skip_site_packages = True
+
+    p = PdbTest(Config=Config, skip=["foo"])
+    assert p.skip == {"foo", pdbpp.SKIP_SITE_PACKAGES}
+    assert p.is_skipped_module("foo")
+    assert not p.is_skipped_module("os")
+    assert p.is_skipped_module("pytest")
+
+
 def test_exception_info_main(testdir):
     """Test that interaction adds __exception__ similar to user_exception."""
     p1 = testdir.makepyfile(
@@ -6178,3 +7682,176 @@ class TestCommands:
             10
             """,
         )
+
+
+def test_import_from_stdlib_uses_bytecode_cache(tmpdir, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir))
+    monkeypatch.setattr(sys, "dont_write_bytecode", False)
+
+    mod = pdbpp.import_from_stdlib("pdb")
+    assert mod.Pdb.__module__ == "pdb"
+    cache_files = tmpdir.join("pdbpp").listdir()
+    assert [x.basename.split("-")[0] for x in cache_files] == ["pdb"]
+
+    def compile_should_not_be_used(*args, **kwargs):
+        assert 0, "unexpected compile"
+
+    with monkeypatch.context() as m:
+        m.setattr(pdbpp, "compile", compile_should_not_be_used, raising=False)
+        assert pdbpp.import_from_stdlib("pdb").Pdb.__module__ == "pdb"
+
+    # Broken entries get replaced.
+    cache_files[0].write_binary(b"garbage")
+    assert pdbpp.import_from_stdlib("pdb").Pdb.__module__ == "pdb"
+    assert cache_files[0].read_binary() != b"garbage"
+
+
+def test_import_from_stdlib_with_unwritable_cache(tmpdir, monkeypatch):
+    not_a_dir = tmpdir.ensure("cache")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(not_a_dir))
+
+    assert pdbpp.import_from_stdlib("pdb").Pdb.__module__ == "pdb"
+    assert tmpdir.listdir() == [not_a_dir]
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir))
+    monkeypatch.setenv("PDBPP_BYTECODE_CACHE", "0")
+    assert pdbpp.import_from_stdlib("pdb").Pdb.__module__ == "pdb"
+    assert tmpdir.listdir() == [not_a_dir]
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="uses importlib")
+def test_path_hack_uses_cached_bytecode(tmpdir, monkeypatch):
+    src_dir = os.path.dirname(os.path.abspath(pdbpp.__file__))
+    tmpdir.ensure_dir("_pdbpp_path_hack").join("pdb.py").write(
+        py.path.local(src_dir).join("_pdbpp_path_hack", "pdb.py").read()
+    )
+    tmpdir.join("pdbpp.py").write(py.path.local(src_dir).join("pdbpp.py").read())
+    pdbpp_path = str(tmpdir.join("pdbpp.py"))
+
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join([
+        str(tmpdir.join("_pdbpp_path_hack")),
+        str(tmpdir),
+        os.environ.get("PYTHONPATH", ""),
+    ]))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir.join("cache")))
+    monkeypatch.delenv("PYTHONDONTWRITEBYTECODE", raising=False)
+
+    code = textwrap.dedent("""
+        import builtins
+
+        compiled = []
+        orig_compile = builtins.compile
+
+        def compile(source, filename, *args, **kwargs):
+            compiled.append(filename)
+            return orig_compile(source, filename, *args, **kwargs)
+
+        builtins.compile = compile
+
+        import pdb
+        import pdbpp
+
+        assert pdb.__name__ == "pdb", pdb
+        assert pdb.__file__ == pdbpp.__file__, (pdb.__file__, pdbpp.__file__)
+        print(compiled.count({pdbpp_path!r}))
+    """.format(pdbpp_path=pdbpp_path))
+
+    for expected_compiles in (b"1", b"0"):
+        out = subprocess.check_output([sys.executable, "-c", code])
+        assert out.strip() == expected_compiles
+        assert tmpdir.join("__pycache__").listdir("pdbpp.*.pyc")
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="requires PEP 562")
+def test_path_hack_lazy(monkeypatch):
+    src_dir = os.path.dirname(os.path.abspath(pdbpp.__file__))
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join([
+        os.path.join(src_dir, "_pdbpp_path_hack"),
+        src_dir,
+        os.environ.get("PYTHONPATH", ""),
+    ]))
+    monkeypatch.setenv("PDBPP_HIJACK_PDB_LAZY", "1")
+
+    code = textwrap.dedent("""
+        import sys
+        import pdb
+
+        assert "fancycompleter" not in sys.modules
+        assert not hasattr(pdb, "__path__")
+        assert "fancycompleter" not in sys.modules
+
+        from pdb import Pdb
+        assert "fancycompleter" in sys.modules
+        assert Pdb.__module__ == "pdb", Pdb.__module__
+        assert pdb.Pdb is Pdb
+        assert "post_mortem" in dir(pdb)
+        assert pdb.GLOBAL_PDB is None
+        try:
+            pdb.doesnotexist
+        except AttributeError as exc:
+            print(exc)
+    """)
+    out = subprocess.check_output([sys.executable, "-c", code])
+    assert out.decode().strip() == "module 'pdb' has no attribute 'doesnotexist'"
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="requires PEP 562")
+def test_path_hack_lazy_with_error(tmpdir, monkeypatch):
+    src_dir = os.path.dirname(os.path.abspath(pdbpp.__file__))
+    path_hack_dir = tmpdir.mkdir("_pdbpp_path_hack")
+    with open(os.path.join(src_dir, "_pdbpp_path_hack", "pdb.py")) as f:
+        path_hack_dir.join("pdb.py").write(f.read())
+    tmpdir.join("pdbpp.py").write("raise ImportError('broken')\n")
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join([
+        str(path_hack_dir),
+        os.environ.get("PYTHONPATH", ""),
+    ]))
+    monkeypatch.setenv("PDBPP_HIJACK_PDB_LAZY", "1")
+
+    code = textwrap.dedent("""
+        import pdb
+
+        for i in range(2):
+            try:
+                pdb.set_trace
+            except ImportError as exc:
+                print(exc)
+    """)
+    out = subprocess.check_output([sys.executable, "-c", code])
+    assert out.decode().split() == ["broken", "broken"]
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="requires -X importtime")
+def test_import_time_budget(monkeypatch):
+    """Importing pdbpp should only import what is needed to get to the prompt.
+
+    Modules are compared against the ones imported by the stdlib's pdb, using
+    `-X importtime`.
+    """
+    src_dir = os.path.dirname(os.path.abspath(pdbpp.__file__))
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join([
+        src_dir, os.environ.get("PYTHONPATH", ""),
+    ]))
+    monkeypatch.setenv("PDBPP_HIJACK_PDB", "0")
+
+    def get_imported_modules(code):
+        p = subprocess.Popen(
+            [sys.executable, "-X", "importtime", "-c", code],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        _, stderr = p.communicate()
+        assert p.returncode == 0, stderr
+        return set(
+            line.rsplit("|", 1)[-1].strip()
+            for line in stderr.decode().splitlines()
+            if line.startswith("import time:")
+        )
+
+    stdlib_pdb_modules = get_imported_modules("import pdb")
+    assert "pdbpp" not in stdlib_pdb_modules
+    extra_modules = get_imported_modules("import pdbpp") - stdlib_pdb_modules
+
+    assert "pdbpp" in extra_modules
+    for name in ("subprocess", "six", "pygments"):
+        assert name not in extra_modules
+    assert len(extra_modules) <= 12, sorted(extra_modules)